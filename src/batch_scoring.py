@@ -0,0 +1,283 @@
+"""Streaming batch scoring of feature files.
+
+Feature chunks are read from a generator and scored by a pool of worker
+threads. At most max_in_flight chunks are read but not yet written, which
+bounds the memory independently of the size of the input. The
+probabilities and flags are appended to the output in input order,
+together with the key columns (serial number and date) of the chunks.
+
+Usage:
+    python -m src.batch_scoring --input data/processed/X_test.bin \
+        --output data/processed/y_scores.csv --workers 4
+    python -m src.batch_scoring --input data/processed/X_test.csv \
+        --keys data/processed/keys_test.csv
+"""
+from logging import getLogger
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import os
+import time
+
+import pandas as pd
+
+logger = getLogger(__name__)
+
+# Columns identifying the rows, written with the scores and not passed to
+# the model
+KEY_COLUMNS = ("serial_number", "date")
+
+
+def __read_chunks(file: str, chunksize: int, columns):
+    """Chunks of a binary matrix, parquet or csv file."""
+    if file.endswith(".bin"):
+        from src.hdd_matrix import open_matrix
+
+        values, names = open_matrix(file)
+        for start in range(0, len(values), chunksize):
+            chunk = pd.DataFrame(values[start:start + chunksize],
+                                 columns=names, copy=False)
+            yield chunk if columns is None else chunk[columns]
+    elif file.endswith(".parquet"):
+        import pyarrow.parquet as pq
+
+        for batch in pq.ParquetFile(file).iter_batches(chunksize,
+                                                       columns=columns):
+            yield batch.to_pandas()
+    else:
+        yield from pd.read_csv(file, chunksize=chunksize, usecols=columns)
+
+
+def feature_chunks(file: str, chunksize=100000, columns=None, keys=None):
+    """Read a feature file in chunks: a binary matrix (.bin, slices of the
+    memory map), a parquet file (record batches) or a csv file. The key
+    columns of the rows, as written by src.make_dataset, are added to the
+    chunks.
+
+    Args:
+        file (str): Path of the feature file
+        chunksize (int, optional): Rows per chunk. Defaults to 100000.
+        columns (list, optional): Columns to read. Defaults to None (all).
+        keys (str, optional): Csv file with the key columns of the rows,
+            e.g. data/processed/keys_test.csv. Defaults to None (the keys
+            file in the metadata of a binary matrix, otherwise no keys).
+
+    Raises:
+        ValueError: If the keys file has fewer rows than the feature file
+
+    Yields:
+        pd.DataFrame: Chunk of the features
+    """
+    if keys is None and file.endswith(".bin"):
+        from src.hdd_matrix import read_header
+
+        keys = read_header(file)["metadata"].get("keys")
+        if keys is not None:
+            keys = os.path.join(os.path.dirname(file), keys)
+    key_frame = None if keys is None else pd.read_csv(keys)
+    start = 0
+    for chunk in __read_chunks(file, chunksize, columns):
+        if key_frame is not None:
+            rows = key_frame.iloc[start:start + len(chunk)]
+            if len(rows) < len(chunk):
+                raise ValueError(f"{keys} has fewer rows than {file}")
+            chunk = chunk.assign(**{col: rows[col].values
+                                    for col in rows})
+        start += len(chunk)
+        yield chunk
+
+
+def limit_threads(model, n_threads: int):
+    """Set the number of threads of the fitted estimators of a model, so
+    that parallel workers do not oversubscribe the cores. Pipelines, grid
+    searches, stacking classifiers and their fitted estimators are searched
+    recursively, every estimator with an n_jobs parameter (XGBoost,
+    sklearn) is set.
+
+    Args:
+        model (_type_): Fitted model
+        n_threads (int): Threads per estimator
+
+    Returns:
+        _type_: The model
+    """
+    if hasattr(model, "steps"):
+        for _, step in model.steps:
+            limit_threads(step, n_threads)
+    estimators = []
+    if isinstance(getattr(model, "estimators_", None), list):
+        estimators += model.estimators_
+    if isinstance(getattr(model, "named_estimators_", None), dict):
+        estimators += list(model.named_estimators_.values())
+    # The estimators of sklearn ensembles are unfitted (name, estimator)
+    # tuples, those of stacked_classifier are fitted
+    if isinstance(getattr(model, "estimators", None), list):
+        estimators += [estimator for estimator in model.estimators
+                       if not isinstance(estimator, tuple)]
+    for estimator in estimators:
+        limit_threads(estimator, n_threads)
+    for name in ["best_estimator_", "final_estimator_", "scaling"]:
+        if getattr(model, name, None) is not None:
+            limit_threads(getattr(model, name), n_threads)
+    if hasattr(model, "final_estimator") and \
+            not hasattr(model, "final_estimator_"):
+        # Fitted final estimator of stacked_classifier
+        limit_threads(model.final_estimator, n_threads)
+    if hasattr(model, "get_params") and \
+            "n_jobs" in model.get_params(deep=False):
+        model.set_params(n_jobs=n_threads)
+    return model
+
+
+def score_chunks(model, chunks, output_file=None, threshold=0.501,
+                 n_workers=None, max_in_flight=None,
+                 key_columns=KEY_COLUMNS, feature_columns=None):
+    """Score chunks of features in a pool of worker threads and write the
+    scores incrementally. The cores are shared between the workers, every
+    estimator of the model gets cpu_count // n_workers threads.
+
+    Args:
+        model (_type_): Fitted model with predict_proba
+        chunks (_type_): Iterable of feature frames, e.g. feature_chunks
+        output_file (str, optional): Csv file the scores are appended to.
+            Defaults to None (the scores are returned).
+        threshold (float, optional): Probability threshold of a failure.
+            Defaults to 0.501.
+        n_workers (int, optional): Number of worker threads. Defaults to
+            None (number of cores).
+        max_in_flight (int, optional): Maximum number of chunks read but
+            not written. Defaults to None (2 * n_workers).
+        key_columns (tuple, optional): Columns written with the scores, if
+            present in the chunks. Defaults to KEY_COLUMNS.
+        feature_columns (list, optional): Columns passed to the model.
+            Defaults to None (the features the model was fitted on, or all
+            columns but the keys).
+
+    Returns:
+        pd.DataFrame or dict: The scores if no output file is given,
+            otherwise the number of rows and flagged rows
+    """
+    n_workers = n_workers or os.cpu_count()
+    max_in_flight = max_in_flight or 2 * n_workers
+    limit_threads(model, max(1, os.cpu_count() // n_workers))
+    if feature_columns is None:
+        feature_columns = getattr(model, "feature_names_in_", None)
+    scores = []
+    totals = {"rows": 0, "flagged": 0}
+    out = open(output_file, "w") if output_file is not None else None
+
+    def write(keys, future):
+        proba = future.result()[:, 1]
+        frame = keys.assign(proba=proba, flag=proba > threshold)
+        if out is None:
+            scores.append(frame)
+        else:
+            frame.to_csv(out, index=False, header=totals["rows"] == 0)
+        totals["rows"] += len(frame)
+        totals["flagged"] += int(frame.flag.sum())
+
+    pending = deque()
+    try:
+        with ThreadPoolExecutor(n_workers) as pool:
+            for chunk in chunks:
+                keys = chunk.loc[:, [col for col in key_columns
+                                     if col in chunk]]
+                X = (chunk.loc[:, list(feature_columns)]
+                     if feature_columns is not None
+                     else chunk.drop(columns=keys.columns))
+                pending.append((keys.reset_index(drop=True),
+                                pool.submit(model.predict_proba, X)))
+                while len(pending) >= max_in_flight:
+                    write(*pending.popleft())
+            while pending:
+                write(*pending.popleft())
+    finally:
+        if out is not None:
+            out.close()
+    if out is None:
+        return (pd.concat(scores, ignore_index=True) if scores
+                else pd.DataFrame(columns=[*key_columns, "proba", "flag"]))
+    return totals
+
+
+def benchmark_scoring(model, file: str, chunksize=100000, workers=(1, 2, 4),
+                      threshold=0.501) -> pd.DataFrame:
+    """Throughput of score_chunks against the one-shot path of
+    src.predict: reading the whole file, one predict_proba and writing the
+    flags at once.
+
+    Args:
+        model (_type_): Fitted model with predict_proba
+        file (str): Feature file, csv, parquet or binary matrix
+        chunksize (int, optional): Rows per chunk. Defaults to 100000.
+        workers (tuple, optional): Numbers of workers. Defaults to (1, 2,
+            4).
+        threshold (float, optional): Probability threshold of a failure.
+            Defaults to 0.501.
+
+    Returns:
+        pd.DataFrame: Seconds and rows per second per mode
+    """
+    import tempfile
+
+    results = []
+    with tempfile.TemporaryDirectory() as path:
+        start = time.perf_counter()
+        X = pd.concat(feature_chunks(file, chunksize), ignore_index=True)
+        X = X.drop(columns=[col for col in KEY_COLUMNS if col in X])
+        y_pred = limit_threads(model, os.cpu_count()).predict_proba(X)[:, 1]
+        pd.Series(y_pred > threshold).to_csv(f"{path}/one_shot.csv",
+                                             index=False)
+        seconds = time.perf_counter() - start
+        results.append({"mode": "one_shot", "workers": 1,
+                        "seconds": seconds, "rows_per_s": len(X) / seconds})
+        del X, y_pred
+        for n_workers in workers:
+            start = time.perf_counter()
+            totals = score_chunks(model, feature_chunks(file, chunksize),
+                                  f"{path}/batches.csv", threshold=threshold,
+                                  n_workers=n_workers)
+            seconds = time.perf_counter() - start
+            results.append({"mode": "batches", "workers": n_workers,
+                            "seconds": seconds,
+                            "rows_per_s": totals["rows"] / seconds})
+    return pd.DataFrame(results)
+
+
+if __name__ == "__main__":
+    import argparse
+    import logging
+
+    from src.score import load_scoring_model
+
+    logger = logging.getLogger()
+    logging.basicConfig(format="%(asctime)s: %(message)s")
+    logger.setLevel(logging.INFO)
+
+    parser = argparse.ArgumentParser(description="Score features in batches")
+    parser.add_argument("--input", default="data/processed/X_test.csv")
+    parser.add_argument("--output", default="data/processed/y_scores.csv")
+    parser.add_argument("--keys", default=None,
+                        help="Csv file with the serial number and date of "
+                        "the rows, read from the metadata of binary matrices "
+                        "by default")
+    parser.add_argument("--model", default="models/deployment_xgb")
+    parser.add_argument("--threshold", type=float, default=0.501)
+    parser.add_argument("--chunksize", type=int, default=100000)
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--max-in-flight", type=int, default=None)
+    parser.add_argument("--benchmark", action="store_true",
+                        help="Compare the throughput with the one-shot path")
+    args = parser.parse_args()
+
+    model = load_scoring_model(args.model)
+    if args.benchmark:
+        print(benchmark_scoring(model, args.input, args.chunksize)
+              .to_string(index=False))
+    else:
+        totals = score_chunks(model,
+                              feature_chunks(args.input, args.chunksize,
+                                             keys=args.keys),
+                              args.output, threshold=args.threshold,
+                              n_workers=args.workers,
+                              max_in_flight=args.max_in_flight)
+        logger.info(f"{totals['flagged']} of {totals['rows']} rows flagged")
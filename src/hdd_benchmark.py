@@ -0,0 +1,501 @@
+from logging import getLogger
+import os
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+
+from src.hdd_synthetic import write_fleet, write_fleet_db, write_daily_files
+from src.hdd_daily import load_daily_drive_stats
+from src.hdd_matrix import write_matrix, predict_proba_matrix
+from src.hdd_sql import failure_sample_points, sample_failure_history
+from src.hdd_windows import drive_windows
+from src.hdd_evaluation import THRESHOLDS, HORIZONS, evaluate
+from src.hdd_preprocessing import (load_drive_stats, calculate_target,
+                                   remove_smart_7_outliers, drop_cols,
+                                   drop_missing_rows, drop_duplicate_rows,
+                                   train_test_splitter, countdown,
+                                   load_preprocess_data)
+from src.hdd_feature_engineering import (unwrap_smart_7, calculate_ema,
+                                         calculate_smart_999, drop_feats,
+                                         create_features)
+
+logger = getLogger(__name__)
+
+SIZES = (1000, 10000, 100000)
+# Stages with a growth of the time per row above this exponent are flagged
+SUPERLINEAR = 1.2
+# Rows of the feature round trip and evaluation benchmarks
+IO_ROWS = 2000000
+# Numbers of workers of the scaling benchmark
+WORKERS = (1, 2, 4, 8)
+
+
+def measure(func, *args, repeat=1, **kwargs):
+    """Time a function and profile its memory. The peak memory is traced in
+    a separate run before the timed runs, so that tracing does not slow
+    down the timings. The time is the best of repeat runs. Only the result
+    of one run is kept at a time.
+
+    Args:
+        func (_type_): Function to benchmark
+        *args: Arguments of the function
+        repeat (int, optional): Number of timed runs. Defaults to 1.
+        **kwargs: Keyword arguments of the function
+
+    Returns:
+        _type_, float, float: Result of the function, seconds and peak
+            memory in MB
+    """
+    tracemalloc.start()
+    try:
+        func(*args, **kwargs)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    seconds = np.inf
+    for _ in range(repeat):
+        result = None
+        start = time.perf_counter()
+        result = func(*args, **kwargs)
+        seconds = min(seconds, time.perf_counter() - start)
+    return result, seconds, peak / 2**20
+
+
+def benchmark_pipeline(n_drives=1000, n_days=60, days=30, repeat=1,
+                       model_path="models/deployment_xgb") -> pd.DataFrame:
+    """Benchmark every stage of the pipeline on a synthetic fleet. Every
+    stage is fed with the output of the previous stage, as in
+    load_preprocess_data and create_features.
+
+    Args:
+        n_drives (int, optional): Number of drives. Defaults to 1000.
+        n_days (int, optional): Number of days. Defaults to 60.
+        days (int, optional): Time interval of target and EMA. Defaults to
+            30.
+        repeat (int, optional): Number of timed runs. Defaults to 1.
+        model_path (str, optional): Model for run_predict, the stage is
+            skipped if it cannot be loaded. Defaults to
+            "models/deployment_xgb".
+
+    Returns:
+        pd.DataFrame: Seconds and peak memory in MB per stage
+    """
+    results = []
+
+    def stage(name, func, *args, **kwargs):
+        result, seconds, peak = measure(func, *args, repeat=repeat, **kwargs)
+        logger.info(f"{n_drives} drives, {name}: {seconds:.3f}s, "
+                    f"{peak:.0f}MB")
+        results.append({"stage": name, "n_drives": n_drives,
+                        "n_rows": len(args[0]) if name != "load_drive_stats"
+                        else len(result),
+                        "seconds": seconds, "peak_mb": peak})
+        return result
+
+    with tempfile.TemporaryDirectory() as path:
+        write_fleet("benchmark", path, n_drives=n_drives, n_days=n_days)
+        df = stage("load_drive_stats", load_drive_stats, "benchmark", path)
+    X, y = stage("calculate_target", calculate_target, df, days=days)
+    del df  # Only the output of the last stage is kept in memory
+    X = stage("remove_smart_7_outliers", remove_smart_7_outliers, X)
+    X = stage("drop_cols", drop_cols, X)
+    X = stage("drop_missing_rows", drop_missing_rows, X)
+    X = stage("drop_duplicate_rows", drop_duplicate_rows, X)
+    y = y[X.index]
+    X = stage("unwrap_smart_7", unwrap_smart_7, X)
+    X = stage("calculate_ema", calculate_ema, X, days=days)
+    X = stage("calculate_smart_999", calculate_smart_999, X)
+    X = drop_feats(X)
+    X_train, X_test, y_train, y_test = stage("train_test_splitter",
+                                             train_test_splitter, X, y)
+    try:
+        from src.predict import run_predict
+
+        os.stat(model_path)
+        stage("run_predict", run_predict,
+              X_test.drop("serial_number", axis=1))
+    except (ImportError, OSError) as error:
+        logger.warning(f"Skipping run_predict: {error}")
+    return pd.DataFrame(results)
+
+
+class __linear_model:
+    """Logistic model standing in for the deployed model, so that the
+    feature round trip is measured without the cost of a real model."""
+
+    def __init__(self, n_cols, seed=42):
+        self.coef = np.random.default_rng(seed).normal(size=n_cols)
+
+    def predict_proba(self, X):
+        proba = 1 / (1 + np.exp(-(np.asarray(X) @ self.coef)))
+        return np.column_stack([1 - proba, proba])
+
+
+def benchmark_feature_io(n_rows=IO_ROWS, n_cols=30, batch_size=100000,
+                         seed=42) -> pd.DataFrame:
+    """Benchmark the round trip of a feature matrix through disk: writing it
+    as make_dataset does and scoring it as src.score does, either as csv
+    parsed by pd.read_csv or as binary matrix memory-mapped and scored in
+    slices.
+
+    Args:
+        n_rows (int, optional): Number of rows. Defaults to IO_ROWS.
+        n_cols (int, optional): Number of features. Defaults to 30.
+        batch_size (int, optional): Rows per slice of the memory map.
+            Defaults to 100000.
+        seed (int, optional): Random seed. Defaults to 42.
+
+    Returns:
+        pd.DataFrame: Seconds and peak memory in MB per format and step,
+            and the size of the file in MB
+    """
+    rng = np.random.default_rng(seed)
+    X = pd.DataFrame(rng.random((n_rows, n_cols)),
+                     columns=[f"feature_{i}" for i in range(n_cols)])
+    model = __linear_model(n_cols, seed=seed)
+    results = []
+    with tempfile.TemporaryDirectory() as path:
+        csv, matrix = f"{path}/X.csv", f"{path}/X.bin"
+        steps = {"csv": [("write", lambda: X.to_csv(csv, index=False)),
+                         ("score", lambda: model.predict_proba(
+                             pd.read_csv(csv)))],
+                 "binary": [("write", lambda: write_matrix(matrix, X)),
+                            ("score", lambda: predict_proba_matrix(
+                                model, matrix, batch_size=batch_size))]}
+        for fmt, file in [("csv", csv), ("binary", matrix)]:
+            for step, func in steps[fmt]:
+                _, seconds, peak = measure(func)
+                logger.info(f"{n_rows} rows, {fmt} {step}: {seconds:.3f}s, "
+                            f"{peak:.0f}MB")
+                results.append({"format": fmt, "step": step,
+                                "n_rows": n_rows, "seconds": seconds,
+                                "peak_mb": peak,
+                                "file_mb": os.path.getsize(file) / 2**20})
+    return pd.DataFrame(results)
+
+
+def __fetch_per_point(con, points, table="2021") -> pd.DataFrame:
+    """Rows of the sample points fetched like the SQL notebook, with one
+    query per drive and sampled day."""
+    rows = []
+    for point in points.itertuples(index=False):
+        rows.append(pd.read_sql(
+            f'SELECT * FROM "{table}" WHERE date = ? AND serial_number = ?',
+            con, params=(pd.Timestamp(point.date).strftime("%Y-%m-%d"),
+                         point.serial_number)))
+    return pd.concat(rows, ignore_index=True)
+
+
+def benchmark_sql_extraction(n_drives=10000, n_days=365, n_failures=250,
+                             seed=42) -> pd.DataFrame:
+    """Benchmark the extraction of the training set of the SQL notebook
+    from a SQLite stand-in of the drive stats database: the per-drive query
+    loop against the set-based queries of sample_failure_history.
+
+    Args:
+        n_drives (int, optional): Number of drives. Defaults to 10000.
+        n_days (int, optional): Number of days. Defaults to 365.
+        n_failures (int, optional): Number of failures sampled. Defaults to
+            250.
+        seed (int, optional): Random seed. Defaults to 42.
+
+    Returns:
+        pd.DataFrame: Seconds, queries and rows per method
+    """
+    import sqlite3
+
+    results = []
+    with tempfile.TemporaryDirectory() as path:
+        write_fleet_db(f"{path}/drives.db", n_drives=n_drives,
+                       n_days=n_days, seed=seed)
+        con = sqlite3.connect(f"{path}/drives.db")
+        try:
+            failures = pd.read_sql(
+                'SELECT serial_number, date FROM "2021" WHERE failure = 1 '
+                'ORDER BY date DESC LIMIT ?', con, params=(n_failures,))
+            points = failure_sample_points(failures, seed=seed)
+            start = time.perf_counter()
+            rows = __fetch_per_point(con, points)
+            results.append({"method": "per_point_loop",
+                            "queries": len(points) + 1, "rows": len(rows),
+                            "seconds": time.perf_counter() - start})
+            start = time.perf_counter()
+            rows = sample_failure_history(con, n_failures=n_failures,
+                                          seed=seed)
+            results.append({"method": "set_based", "queries": 2,
+                            "rows": len(rows),
+                            "seconds": time.perf_counter() - start})
+        finally:
+            con.close()
+    results = pd.DataFrame(results)
+    results["n_drives"] = n_drives
+    logger.info(f"{n_drives} drives:\n{results.to_string(index=False)}")
+    return results
+
+
+def benchmark_windows(n_drives=10000, n_days=365, window=30,
+                      seed=42) -> pd.DataFrame:
+    """Benchmark building windowed model input from the features of a
+    synthetic fleet: the pivot of smart_999 by drive and countdown of the
+    autoencoder notebook against drive_windows, for smart_999 and for all
+    features.
+
+    Args:
+        n_drives (int, optional): Number of drives. Defaults to 10000.
+        n_days (int, optional): Number of days. Defaults to 365.
+        window (int, optional): Days per window. Defaults to 30.
+        seed (int, optional): Random seed. Defaults to 42.
+
+    Returns:
+        pd.DataFrame: Seconds, peak memory in MB and output size in MB per
+            method
+    """
+    with tempfile.TemporaryDirectory() as path:
+        write_fleet("benchmark", path, n_drives=n_drives, n_days=n_days,
+                    seed=seed)
+        days = countdown(load_drive_stats("benchmark", path)).countdown
+        X, _ = load_preprocess_data(filename="benchmark", path=path)
+    X = create_features(X)
+    days = days.loc[X.index]
+    methods = {
+        "pivot_smart_999": lambda: X.assign(countdown=days).pivot(
+            index="serial_number", columns="countdown", values="smart_999"),
+        "windows_smart_999": lambda: drive_windows.from_frame(
+            X, window=window, countdown=days, columns=["smart_999"]),
+        "windows_all_features": lambda: drive_windows.from_frame(
+            X, window=window, countdown=days)}
+    results = []
+    for method, func in methods.items():
+        result, seconds, peak = measure(func)
+        size = (result.memory_usage().sum() if method.startswith("pivot")
+                else result.buffer.nbytes + result.mask.nbytes)
+        logger.info(f"{n_drives} drives, {method}: {seconds:.3f}s, "
+                    f"{peak:.0f}MB")
+        results.append({"method": method, "n_drives": n_drives,
+                        "n_rows": len(X), "windows": len(result),
+                        "seconds": seconds, "peak_mb": peak,
+                        "output_mb": size / 2**20})
+    return pd.DataFrame(results)
+
+
+def __evaluate_loop(proba, countdown, serials, thresholds, horizons):
+    """Metrics of evaluate with one pass over the rows per threshold and
+    horizon and a groupby per threshold for the lead times."""
+    rows = []
+    failed = ~np.isnan(countdown)
+    for threshold in thresholds:
+        flag = proba > threshold
+        lead = pd.Series(countdown[flag & failed]).groupby(
+            serials[flag & failed]).max()
+        for horizon in horizons:
+            positive = countdown <= horizon
+            tp = np.sum(flag & positive)
+            rows.append({"horizon": horizon, "threshold": threshold,
+                         "alerts": flag.sum(), "true_positives": tp,
+                         "precision": tp / max(flag.sum(), 1),
+                         "recall": tp / positive.sum(),
+                         "mean_lead_days": lead.mean()})
+    return pd.DataFrame(rows)
+
+
+def benchmark_evaluation(n_rows=IO_ROWS, n_drives=20000, seed=42,
+                         thresholds=THRESHOLDS,
+                         horizons=HORIZONS) -> pd.DataFrame:
+    """Benchmark the evaluation of scored rows over all thresholds and
+    horizons: evaluate, with one sort and cumulative sums, against a loop
+    over the thresholds and horizons.
+
+    Args:
+        n_rows (int, optional): Number of scored rows. Defaults to IO_ROWS.
+        n_drives (int, optional): Number of drives. Defaults to 20000.
+        seed (int, optional): Random seed. Defaults to 42.
+        thresholds (_type_, optional): Probability thresholds. Defaults to
+            THRESHOLDS.
+        horizons (tuple, optional): Horizons in days. Defaults to HORIZONS.
+
+    Returns:
+        pd.DataFrame: Seconds and peak memory in MB per method
+    """
+    rng = np.random.default_rng(seed)
+    # Drives of random length, 70% of them failing at the end
+    drive = np.sort(rng.integers(0, n_drives, n_rows))
+    starts = np.searchsorted(drive, np.arange(n_drives))
+    lengths = np.diff(np.append(starts, n_rows))
+    position = np.arange(n_rows) - np.repeat(starts, lengths)
+    failing = rng.random(n_drives) < 0.7
+    countdown = np.where(failing[drive],
+                         np.repeat(lengths - 1, lengths) - position, np.nan)
+    proba = np.clip(rng.random(n_rows) * 0.6
+                    + (countdown < 30) * rng.random(n_rows) * 0.4, 0, 1)
+    serials = np.char.add("Z", drive.astype(str))
+    results = []
+    for method, func in [("evaluate", evaluate),
+                         ("threshold_loop", __evaluate_loop)]:
+        _, seconds, peak = measure(func, proba, countdown, serials,
+                                   thresholds=thresholds, horizons=horizons)
+        logger.info(f"{n_rows} rows, {method}: {seconds:.3f}s, {peak:.0f}MB")
+        results.append({"method": method, "n_rows": n_rows,
+                        "thresholds": len(thresholds),
+                        "horizons": len(horizons), "seconds": seconds,
+                        "peak_mb": peak})
+    return pd.DataFrame(results)
+
+
+def benchmark_workers(n_drives=10000, n_days=60, workers=WORKERS,
+                      days=30) -> pd.DataFrame:
+    """Scaling of the parallel stages with the number of workers: reading
+    the daily drive stats files in a process pool and creating the features
+    with the drives sharded across joblib workers. The speedup is relative
+    to the first number of workers. Workers beyond the number of cores only
+    add overhead.
+
+    Args:
+        n_drives (int, optional): Number of drives. Defaults to 10000.
+        n_days (int, optional): Number of days, one file per day. Defaults
+            to 60.
+        workers (tuple, optional): Numbers of workers. Defaults to WORKERS.
+        days (int, optional): Horizon of the target and EMA interval.
+            Defaults to 30.
+
+    Returns:
+        pd.DataFrame: Seconds, peak memory in MB and speedup per stage and
+            number of workers
+    """
+    results = []
+
+    def stage(name, n_workers, func, *args, **kwargs):
+        result, seconds, peak = measure(func, *args, **kwargs)
+        logger.info(f"{n_drives} drives, {name}, {n_workers} workers: "
+                    f"{seconds:.3f}s, {peak:.0f}MB")
+        results.append({"stage": name, "n_drives": n_drives,
+                        "n_rows": len(result), "workers": n_workers,
+                        "seconds": seconds, "peak_mb": peak})
+        return result
+
+    with tempfile.TemporaryDirectory() as path:
+        write_daily_files(path, n_drives=n_drives, n_days=n_days)
+        for n_workers in workers:
+            df = stage("load_daily_drive_stats", n_workers,
+                       load_daily_drive_stats, path, n_jobs=n_workers)
+    X, _ = calculate_target(df, days=days)
+    del df
+    X = remove_smart_7_outliers(X)
+    X = drop_duplicate_rows(drop_missing_rows(drop_cols(X)))
+    for n_workers in workers:
+        stage("create_features", n_workers, create_features, X, days=days,
+              n_jobs=n_workers)
+    results = pd.DataFrame(results)
+    results["speedup"] = (results.groupby("stage").seconds.transform("first")
+                          / results.seconds)
+    return results
+
+
+def scaling(results) -> pd.DataFrame:
+    """Growth exponent of the time of every stage between consecutive
+    sizes: 1 is linear in the number of rows, larger values are
+    superlinear.
+
+    Args:
+        results (pd.DataFrame): Output of run_benchmarks
+
+    Returns:
+        pd.DataFrame: Results with the columns exponent and superlinear
+    """
+    results = results.sort_values(["stage", "n_drives"])
+    growth = results.groupby("stage")[["seconds", "n_rows"]].transform(
+        lambda col: np.log(col) - np.log(col.shift()))
+    results["exponent"] = growth.seconds / growth.n_rows
+    results["superlinear"] = results.exponent > SUPERLINEAR
+    return results
+
+
+def run_benchmarks(sizes=SIZES, n_days=60, days=30,
+                   repeat=1) -> pd.DataFrame:
+    """Benchmark the pipeline for several fleet sizes.
+
+    Args:
+        sizes (tuple, optional): Numbers of drives. Defaults to SIZES.
+        n_days (int, optional): Number of days. Defaults to 60.
+        days (int, optional): Time interval of target and EMA. Defaults to
+            30.
+        repeat (int, optional): Number of timed runs. Defaults to 1.
+
+    Returns:
+        pd.DataFrame: Seconds, peak memory and scaling per stage and size
+    """
+    results = pd.concat([benchmark_pipeline(n_drives, n_days=n_days,
+                                            days=days, repeat=repeat)
+                         for n_drives in sizes], ignore_index=True)
+    return scaling(results)
+
+
+if __name__ == "__main__":
+    import argparse
+    import logging
+
+    logger = logging.getLogger()
+    logging.basicConfig(format="%(asctime)s: %(message)s")
+    logger.setLevel(logging.INFO)
+
+    parser = argparse.ArgumentParser(description="Benchmark the pipeline")
+    parser.add_argument("--sizes", type=int, nargs="+", default=SIZES)
+    parser.add_argument("--n-days", type=int, default=60)
+    parser.add_argument("--repeat", type=int, default=1)
+    parser.add_argument("--output", default="reports/benchmarks.csv")
+    parser.add_argument("--feature-io", action="store_true",
+                        help="Benchmark the csv and binary round trip of "
+                        "the features instead")
+    parser.add_argument("--io-rows", type=int, default=IO_ROWS)
+    parser.add_argument("--sql", action="store_true",
+                        help="Benchmark the SQL extraction instead")
+    parser.add_argument("--windows", action="store_true",
+                        help="Benchmark the windowed model input instead")
+    parser.add_argument("--evaluation", action="store_true",
+                        help="Benchmark the evaluation instead")
+    parser.add_argument("--worker-scaling", action="store_true",
+                        help="Benchmark the parallel stages for numbers of "
+                        "workers instead")
+    parser.add_argument("--workers", type=int, nargs="+", default=WORKERS)
+    args = parser.parse_args()
+
+    if args.feature_io:
+        results = benchmark_feature_io(args.io_rows)
+        os.makedirs("reports", exist_ok=True)
+        results.to_csv("reports/benchmarks_feature_io.csv", index=False)
+        print(results.to_string(index=False))
+    elif args.sql:
+        results = pd.concat([benchmark_sql_extraction(n_drives,
+                                                      n_days=args.n_days)
+                             for n_drives in args.sizes], ignore_index=True)
+        os.makedirs("reports", exist_ok=True)
+        results.to_csv("reports/benchmarks_sql.csv", index=False)
+        print(results.to_string(index=False))
+    elif args.windows:
+        results = pd.concat([benchmark_windows(n_drives, n_days=args.n_days)
+                             for n_drives in args.sizes], ignore_index=True)
+        os.makedirs("reports", exist_ok=True)
+        results.to_csv("reports/benchmarks_windows.csv", index=False)
+        print(results.to_string(index=False))
+    elif args.evaluation:
+        results = benchmark_evaluation(args.io_rows)
+        os.makedirs("reports", exist_ok=True)
+        results.to_csv("reports/benchmarks_evaluation.csv", index=False)
+        print(results.to_string(index=False))
+    elif args.worker_scaling:
+        results = pd.concat([benchmark_workers(n_drives, n_days=args.n_days,
+                                               workers=args.workers)
+                             for n_drives in args.sizes], ignore_index=True)
+        os.makedirs("reports", exist_ok=True)
+        results.to_csv("reports/benchmarks_workers.csv", index=False)
+        print(results.to_string(index=False))
+    else:
+        results = run_benchmarks(args.sizes, n_days=args.n_days,
+                                 repeat=args.repeat)
+        os.makedirs(os.path.dirname(args.output), exist_ok=True)
+        results.to_csv(args.output, index=False)
+        print(results.to_string(index=False))
+        for stage in results[results.superlinear].stage.unique():
+            logger.warning(f"{stage} scales superlinearly")
@@ -0,0 +1,223 @@
+import joblib
+import pandas as pd
+
+from functools import lru_cache
+import hashlib
+import importlib.util
+import json
+import os
+import shutil
+import sys
+
+# Modules of the preprocessing and feature code. The hash of their source
+# is part of the cache keys, so that a code change invalidates the entries.
+CODE_MODULES = ("src.hdd_preprocessing", "src.hdd_feature_engineering",
+                "src.hdd_partition", "src.hdd_schema")
+
+
+def file_hash(file: str) -> str:
+    """Calculate the content hash of a file.
+
+    Args:
+        file (str): Path of the file
+
+    Returns:
+        str: Hex digest of the file content
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    with open(file, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+@lru_cache(maxsize=None)
+def code_version(modules=CODE_MODULES) -> str:
+    """Hash of the source files of modules, computed once per process.
+    Modules that are not loaded yet are located but not imported.
+
+    Args:
+        modules (tuple, optional): Names of the modules, e.g. the __module__
+            of a function. Defaults to CODE_MODULES.
+
+    Returns:
+        str: Hex digest of the sources
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    for name in modules:
+        module = sys.modules.get(name)
+        file = (module.__file__ if module is not None
+                else importlib.util.find_spec(name).origin)
+        with open(file, "rb") as f:
+            digest.update(f.read())
+    return digest.hexdigest()
+
+
+class data_cache:
+    """Content-addressed cache for the outputs of the pipeline stages.
+
+    Every entry is a folder with one parquet file per frame. Entries are
+    keyed by the hash of the raw file, the parameters of the stage and the
+    version of the code computing it, and the least recently used entries
+    are evicted once the cache grows beyond max_bytes.
+
+    Args:
+        path (str, optional): Folder of the cache. Defaults to
+            "data/cache" inside the repo.
+        max_bytes (int, optional): Size limit of the cache. Defaults to 5 GB.
+    """
+
+    def __init__(self, path=f"{os.getcwd()}/data/cache", max_bytes=5e9):
+        self.path = path
+        self.max_bytes = max_bytes
+        os.makedirs(self.path, exist_ok=True)
+
+    def __hash_index(self) -> dict:
+        file = f"{self.path}/hashes.json"
+        if not os.path.exists(file):
+            return {}
+        with open(file) as f:
+            return json.load(f)
+
+    def input_hash(self, file: str) -> str:
+        """Content hash of an input file. Hashes are remembered by path, size
+        and modification time, so unchanged files are not read again.
+
+        Args:
+            file (str): Path of the file
+
+        Returns:
+            str: Hex digest of the file content
+        """
+        stat = os.stat(file)
+        signature = f"{os.path.abspath(file)}:{stat.st_size}:{stat.st_mtime_ns}"
+        hashes = self.__hash_index()
+        if signature not in hashes:
+            hashes[signature] = file_hash(file)
+            with open(f"{self.path}/hashes.json", "w") as f:
+                json.dump(hashes, f)
+        return hashes[signature]
+
+    def key(self, stage: str, file: str, modules=CODE_MODULES,
+            **params) -> str:
+        """Key of a stage output.
+
+        Args:
+            stage (str): Name of the stage
+            file (str): Raw input file of the pipeline
+            modules (tuple, optional): Modules of the code of the stage,
+                see code_version. Defaults to CODE_MODULES.
+            **params: Parameters of the stage, e.g. days and trigger
+
+        Returns:
+            str: Key of the entry
+        """
+        description = json.dumps(
+            {"stage": stage, "input": self.input_hash(file),
+             "code": code_version(tuple(modules)), **params},
+            sort_keys=True, default=str)
+        return hashlib.blake2b(description.encode(),
+                               digest_size=16).hexdigest()
+
+    def load(self, key: str) -> dict:
+        """Load the frames of an entry.
+
+        Args:
+            key (str): Key of the entry
+
+        Returns:
+            dict: Frames by name, None if the entry is missing
+        """
+        folder = f"{self.path}/{key}"
+        if not os.path.isdir(folder):
+            return None
+        frames = {}
+        for file in sorted(os.listdir(folder)):
+            name, ext = os.path.splitext(file)
+            if ext == ".parquet":
+                frames[name] = pd.read_parquet(f"{folder}/{file}")
+        # Mark the entry as recently used
+        os.utime(folder)
+        return frames
+
+    def save(self, key: str, frames: dict):
+        """Store the frames of an entry and evict old entries.
+
+        Args:
+            key (str): Key of the entry
+            frames (dict): Frames by name
+        """
+        folder = f"{self.path}/{key}"
+        temp = f"{folder}.tmp"
+        shutil.rmtree(temp, ignore_errors=True)
+        os.makedirs(temp)
+        for name, df in frames.items():
+            df.to_parquet(f"{temp}/{name}.parquet")
+        shutil.rmtree(folder, ignore_errors=True)
+        os.replace(temp, folder)
+        self.evict()
+
+    def load_object(self, key: str):
+        """Load a pickled object entry, e.g. a fitted model.
+
+        Args:
+            key (str): Key of the entry
+
+        Returns:
+            _type_: The object, None if the entry is missing
+        """
+        file = f"{self.path}/{key}/object.joblib"
+        if not os.path.exists(file):
+            return None
+        os.utime(f"{self.path}/{key}")
+        return joblib.load(file)
+
+    def save_object(self, key: str, obj):
+        """Store a pickled object entry and evict old entries.
+
+        Args:
+            key (str): Key of the entry
+            obj (_type_): Picklable object, e.g. a fitted model
+        """
+        folder = f"{self.path}/{key}"
+        temp = f"{folder}.tmp"
+        shutil.rmtree(temp, ignore_errors=True)
+        os.makedirs(temp)
+        joblib.dump(obj, f"{temp}/object.joblib")
+        shutil.rmtree(folder, ignore_errors=True)
+        os.replace(temp, folder)
+        self.evict()
+
+    def cached(self, key: str, func, *args, **kwargs) -> dict:
+        """Load an entry, or compute and store it on a miss.
+
+        Args:
+            key (str): Key of the entry
+            func (_type_): Function returning the frames by name
+
+        Returns:
+            dict: Frames by name
+        """
+        frames = self.load(key)
+        if frames is None:
+            frames = func(*args, **kwargs)
+            self.save(key, frames)
+        return frames
+
+    def evict(self):
+        """Remove the least recently used entries until the cache fits into
+        max_bytes."""
+        entries = []
+        for key in os.listdir(self.path):
+            folder = f"{self.path}/{key}"
+            if not os.path.isdir(folder) or key.endswith(".tmp"):
+                continue
+            size = sum(os.path.getsize(f"{folder}/{file}")
+                       for file in os.listdir(folder))
+            entries.append((os.path.getmtime(folder), size, folder))
+        total = sum(size for _, size, _ in entries)
+        for _, size, folder in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            shutil.rmtree(folder)
+            total -= size
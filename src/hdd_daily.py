@@ -0,0 +1,115 @@
+import pandas as pd
+
+import glob
+import os
+from concurrent.futures import ProcessPoolExecutor
+from pandas.api.types import union_categoricals
+
+from src.hdd_preprocessing import COLS_OF_IMPORTANCE, DRIVE_STATS_DTYPES
+
+
+def list_daily_files(folder: str, start=None, end=None) -> list:
+    """List the Backblaze daily drive stats files (YYYY-MM-DD.csv) of a
+    folder, optionally restricted to a date range.
+
+    Args:
+        folder (str): Folder with the daily csv files
+        start (str, optional): First date to include. Defaults to None.
+        end (str, optional): Last date to include. Defaults to None.
+
+    Returns:
+        list: Sorted paths of the files
+    """
+    files = []
+    for file in sorted(glob.glob(f"{folder}/*.csv")):
+        date = pd.to_datetime(os.path.basename(file)[:-4], errors="coerce",
+                              format="%Y-%m-%d")
+        if pd.isna(date):
+            continue
+        if start is not None and date < pd.Timestamp(start):
+            continue
+        if end is not None and date > pd.Timestamp(end):
+            continue
+        files.append(file)
+    return files
+
+
+def read_daily_file(file: str, model="ST4000DM000") -> pd.DataFrame:
+    """Read the drives of one model from a daily drive stats file. Only the
+    columns of importance and the failure are read. Columns missing in older
+    files are filled with NaN.
+
+    Args:
+        file (str): Path of the daily csv file
+        model (str, optional): Drive model. Defaults to "ST4000DM000".
+
+    Returns:
+        pd.DataFrame: Drive stats of the model on that day
+    """
+    columns = ["model", "failure"] + COLS_OF_IMPORTANCE
+    df = pd.read_csv(file,
+                     usecols=lambda col: col in columns,
+                     dtype={**DRIVE_STATS_DTYPES, "model": "category"},
+                     parse_dates=["date"])
+    df = df[df.model == model].drop("model", axis=1)
+    df = df.reindex(columns=["failure"] + COLS_OF_IMPORTANCE)
+    return df.astype(DRIVE_STATS_DTYPES)
+
+
+def load_daily_drive_stats(folder: str, model="ST4000DM000", start=None,
+                           end=None, n_jobs=None) -> pd.DataFrame:
+    """Load the drive history of one model from a folder of daily drive
+    stats files. The files are read and filtered in a process pool.
+
+    Args:
+        folder (str): Folder with the daily csv files
+        model (str, optional): Drive model. Defaults to "ST4000DM000".
+        start (str, optional): First date to include. Defaults to None.
+        end (str, optional): Last date to include. Defaults to None.
+        n_jobs (int, optional): Number of processes. Defaults to None (all
+            cores).
+
+    Returns:
+        pd.DataFrame: Drive stats history in the format of load_drive_stats
+    """
+    files = list_daily_files(folder, start=start, end=end)
+    if not files:
+        raise FileNotFoundError(f"No daily drive stats files in {folder}")
+    n_jobs = n_jobs or os.cpu_count()
+    # Several files per task to keep the overhead of the pool low
+    chunksize = max(1, len(files) // (4 * n_jobs))
+    with ProcessPoolExecutor(max_workers=n_jobs) as pool:
+        days = list(pool.map(read_daily_file, files,
+                             [model] * len(files), chunksize=chunksize))
+    df = pd.concat(days, ignore_index=True)
+    df["serial_number"] = union_categoricals(
+        [day.serial_number for day in days])
+    return df
+
+
+def merge_daily_drive_stats(folder: str, model="ST4000DM000",
+                            filename="ST4000DM000_history_total",
+                            path=os.getcwd(), start=None, end=None,
+                            n_jobs=None) -> pd.DataFrame:
+    """Assemble the drive history from daily drive stats files and store it
+    as data/raw/{filename}.csv for load_preprocess_data.
+
+    Args:
+        folder (str): Folder with the daily csv files
+        model (str, optional): Drive model. Defaults to "ST4000DM000".
+        filename (str, optional): Name of the csv file. Defaults to
+            "ST4000DM000_history_total".
+        path (_type_, optional): Path of the repo. Defaults to os.getcwd().
+        start (str, optional): First date to include. Defaults to None.
+        end (str, optional): Last date to include. Defaults to None.
+        n_jobs (int, optional): Number of processes. Defaults to None (all
+            cores).
+
+    Returns:
+        pd.DataFrame: Drive stats history
+    """
+    df = load_daily_drive_stats(folder, model=model, start=start, end=end,
+                                n_jobs=n_jobs)
+    os.makedirs(f"{path}/data/raw", exist_ok=True)
+    df.to_csv(f"{path}/data/raw/{filename}.csv", index=False)
+    return df
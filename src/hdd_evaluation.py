@@ -0,0 +1,129 @@
+import pandas as pd
+import numpy as np
+
+# Probability thresholds and target horizons (days of calculate_target)
+THRESHOLDS = np.round(np.arange(0.01, 1, 0.01), 2)
+HORIZONS = (7, 14, 30, 60, 90)
+
+
+def __sorted_scores(proba, countdown, serials):
+    """Scores in descending order of the probability."""
+    order = np.argsort(-np.asarray(proba, dtype=np.float64), kind="stable")
+    codes, drives = pd.factorize(np.asarray(serials)[order])
+    return (np.asarray(proba, dtype=np.float64)[order],
+            np.asarray(countdown, dtype=np.float64)[order], codes, drives)
+
+
+def __cuts(proba_sorted, thresholds) -> np.ndarray:
+    """Number of rows above every threshold, the alerts of y_proba > t."""
+    return np.searchsorted(-proba_sorted, -np.asarray(thresholds),
+                           side="left")
+
+
+def evaluate(proba, countdown, serials, thresholds=THRESHOLDS,
+             horizons=HORIZONS, threshold=0.501):
+    """Precision and recall for every threshold and horizon and the lead
+    time of the first alert of every drive, from one sort of the scores.
+
+    A row is positive for horizon h if its drive fails within h days, as
+    calculate_target(days=h). Along the rows in descending order of the
+    probability, cumulative sums give the true positives of every
+    threshold. The lead time of a drive is its largest countdown among the
+    rows above the threshold, the days before the failure of its first
+    alert; a grouped running maximum gives it for all thresholds at once.
+
+    Args:
+        proba (_type_): Predicted failure probability of every row
+        countdown (_type_): Days until the failure of the drive, as in
+            calculate_target, NaN for all rows of drives without failure
+        serials (_type_): Serial number of every row
+        thresholds (_type_, optional): Probability thresholds, a row is
+            flagged if its probability is above. Defaults to THRESHOLDS.
+        horizons (tuple, optional): Horizons of the target in days.
+            Defaults to HORIZONS.
+        threshold (float, optional): Threshold of the lead times per drive.
+            Defaults to 0.501.
+
+    Returns:
+        pd.DataFrame, pd.DataFrame: Metrics per horizon and threshold, and
+            lead time of the first alert per drive
+    """
+    proba, days, codes, drives = __sorted_scores(proba, countdown, serials)
+    thresholds = np.asarray(thresholds, dtype=np.float64)
+    cuts = __cuts(proba, thresholds)
+    # Row level: true positives of the first k rows for every horizon
+    positive = days[:, None] <= np.asarray(horizons)[None, :]
+    true_positives = np.vstack([np.zeros((1, len(horizons)), dtype=np.int64),
+                                np.cumsum(positive, axis=0)])
+    tp = true_positives[cuts]
+    n_positive = true_positives[-1]
+    alerts = cuts[:, None]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        precision = np.where(alerts > 0, tp / alerts, np.nan)
+        recall = tp / n_positive
+    # Drive level: running maximum of the countdown of every drive along
+    # the sorted rows. The increments of the running maxima sum up to the
+    # total lead time of the alerted drives, the first row of a drive adds
+    # it to the alerted drives.
+    failed = ~np.isnan(days)
+    lead = pd.Series(np.where(failed, days, 0.)).groupby(codes).cummax()
+    increment = (lead - lead.groupby(codes).shift().fillna(0.)).values
+    first = ~pd.Series(codes).duplicated().values
+    lead_sum = np.concatenate([[0.], np.cumsum(increment)])[cuts]
+    alerted = np.concatenate([[0], np.cumsum(first & failed)])[cuts]
+    false_alarms = np.concatenate([[0], np.cumsum(first & ~failed)])[cuts]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        mean_lead = np.where(alerted > 0, lead_sum / alerted, np.nan)
+    n_horizons = len(horizons)
+    metrics = pd.DataFrame({
+        "horizon": np.tile(horizons, len(thresholds)),
+        "threshold": np.repeat(thresholds, n_horizons),
+        "alerts": np.repeat(cuts, n_horizons),
+        "true_positives": tp.ravel(),
+        "false_positives": (alerts - tp).ravel(),
+        "false_negatives": (n_positive[None, :] - tp).ravel(),
+        "precision": precision.ravel(),
+        "recall": recall.ravel(),
+        "drives_alerted": np.repeat(alerted, n_horizons),
+        "drives_false_alarm": np.repeat(false_alarms, n_horizons),
+        "mean_lead_days": np.repeat(mean_lead, n_horizons)})
+    metrics = metrics.sort_values(["horizon", "threshold"], kind="stable",
+                                  ignore_index=True)
+    # Lead times at the threshold, from the rows above it
+    k = __cuts(proba, [threshold])[0]
+    first_alert = np.full(len(drives), -np.inf)
+    np.maximum.at(first_alert, codes[:k], np.where(failed[:k], days[:k],
+                                                   -np.inf))
+    drive_failed = np.zeros(len(drives), dtype=bool)
+    drive_failed[codes[failed]] = True
+    flagged = np.zeros(len(drives), dtype=bool)
+    flagged[codes[:k]] = True
+    max_proba = np.full(len(drives), -np.inf)
+    np.maximum.at(max_proba, codes, proba)
+    lead_times = pd.DataFrame({
+        "serial_number": np.asarray(drives),
+        "failed": drive_failed,
+        "flagged": flagged,
+        "max_proba": max_proba,
+        "lead_days": np.where(np.isfinite(first_alert), first_alert,
+                              np.nan)})
+    return metrics, lead_times
+
+
+def evaluate_frame(df, threshold=0.501, **kwargs):
+    """Evaluate scored drive data, see evaluate.
+
+    Args:
+        df (pd.DataFrame): Data with proba, countdown and serial_number
+            columns, e.g. the output of src.batch_scoring with the
+            countdown of calculate_target
+        threshold (float, optional): Threshold of the lead times per drive.
+            Defaults to 0.501.
+        **kwargs: Further arguments of evaluate
+
+    Returns:
+        pd.DataFrame, pd.DataFrame: Metrics per horizon and threshold, and
+            lead time of the first alert per drive
+    """
+    return evaluate(df.proba.values, df.countdown.values,
+                    df.serial_number.values, threshold=threshold, **kwargs)
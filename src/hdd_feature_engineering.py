@@ -1,84 +1,169 @@
 import pandas as pd
 import numpy as np
 
+import heapq
 import os
+from joblib import Parallel, delayed, effective_n_jobs
 from sklearn.base import BaseEstimator, TransformerMixin
 
+from src.hdd_partition import drive_frame, drive_order
+from src.hdd_instrumentation import run_stage
 
-def unwrap_smart_7(df_in) -> pd.DataFrame:
+# Drop of smart_7_raw between two days that indicates a wraparound
+SMART_7_JUMP = -5e8
+# SMART features compared with their EMA for the smart_999 feature
+TRIGGER_COLS = ['smart_4_raw', 'smart_5_raw', 'smart_12_raw',
+                'smart_183_raw', 'smart_184_raw', 'smart_187_raw',
+                'smart_188_raw', 'smart_189_raw', 'smart_193_raw',
+                'smart_192_raw', 'smart_197_raw', 'smart_198_raw',
+                'smart_199_raw']
+
+
+def __unwrap_sorted(smart_7, drive_start) -> np.ndarray:
+    """Unwrap smart_7 values that are sorted by drive and date.
+
+    Args:
+        smart_7 (np.ndarray): smart_7_raw values in drive-sorted order
+        drive_start (np.ndarray): Mask of the rows that start a new drive
+
+    Returns:
+        np.ndarray: Unwrapped values
+    """
+    # Calculate the derivate and use spikes to determine jumps
+    jumps = np.zeros(len(smart_7), dtype=bool)
+    jumps[1:] = ~drive_start[1:] & (np.diff(smart_7) < SMART_7_JUMP)
+    # The value before the jump is added to all the following values
+    offset = np.zeros(len(smart_7))
+    offset[1:] = np.where(jumps[1:], smart_7[:-1], 0)
+    # Cumulative offset per drive
+    offset = (pd.Series(offset)
+              .groupby(np.cumsum(drive_start))
+              .cumsum()
+              .values)
+    return smart_7 + offset
+
+
+def unwrap_smart_7(df_in, copy=True) -> pd.DataFrame:
     """Fix the jumps in the smart_7 feature
 
+    The drives are processed all at once: the data is sorted by drive and
+    date, a jump is detected from the per-drive difference and the value
+    before each jump is accumulated into a per-drive offset.
+
     Args:
         df_in (_type_): Drive stats data
+        copy (bool, optional): Copy the input, otherwise the column is added
+            to df_in in place. Defaults to True.
 
     Returns:
         pd.DataFrame: Data with updated feature
     """
     # Copy input dataframe
-    df = df_in.copy()
-    df["smart_7_mod"] = df.smart_7_raw
-    # Extract individual drives
-    drives = df.serial_number.unique()
-    for drive in drives:  # Loop over drives
-        # Create dataframe with time series for drive, reindex and store the
-        # old index
-        temp_data = (df[df.serial_number == drive]
-                     .sort_values("date", ascending=True)
-                     .reset_index())
-        # Calculate the derivate and use spikes to determine jumps
-        jumps = temp_data.smart_7_raw.diff() < -5e8
-        # Extract index of jumps
-        jump_idx = jumps[jumps].index
-        # Backup the smart_7_raw series
-        smart_7_temp = temp_data.smart_7_raw.copy()
-        for idx in jump_idx:  # Loop over the jumps
-            # Add the value before the jump to all the following  values
-            temp_data.loc[idx:, "smart_7_raw"] += smart_7_temp[idx-1]
-        # Restore the original index
-        temp_data = temp_data.set_index("index")
-        # Update the dataframe with the unwrapped data for this drive
-        df.loc[temp_data.index, "smart_7_mod"] = temp_data.smart_7_raw
+    df = df_in.copy() if copy else df_in
+    if isinstance(df, drive_frame):
+        # Already sorted, the offset table marks the drives
+        df.data["smart_7_mod"] = __unwrap_sorted(
+            df.data.smart_7_raw.values.astype(float), df.drive_start)
+        return df
+    # Positions of the rows ordered by drive and date
+    order = drive_order(df)
+    drive_codes = pd.factorize(df.serial_number)[0][order]
+    drive_start = np.ones(len(order), dtype=bool)
+    drive_start[1:] = drive_codes[1:] != drive_codes[:-1]
+    # Scatter the unwrapped values back to the original row order
+    smart_7_mod = np.empty(len(order))
+    smart_7_mod[order] = __unwrap_sorted(
+        df.smart_7_raw.values[order].astype(float), drive_start)
+    df["smart_7_mod"] = smart_7_mod
     return df
 
 
-def calculate_ema(df_in, days=30) -> pd.DataFrame:
+def ema_update(weighted, old_wt, cur, days=30):
+    """One step of the adjusted EMA, the same recursion as pandas'
+    ewm(span=days, adjust=True). Drives without an observation so far have a
+    NaN EMA and a weight of 1.
+
+    Args:
+        weighted (np.ndarray): Previous EMA
+        old_wt (np.ndarray): Previous weight accumulator
+        cur (np.ndarray): Current observation
+        days (_type_, optional): Time interval for EMA, can be an array that
+            broadcasts against the values. Defaults to 30.
+
+    Returns:
+        np.ndarray, np.ndarray: Updated EMA and weight accumulator
+    """
+    com = (np.asarray(days, dtype=float) - 1) / 2
+    old_wt_factor = 1. - 1. / (1. + com)
+    observed = ~np.isnan(cur)
+    started = ~np.isnan(weighted)
+    # Drives without a previous observation start with the current value
+    weighted = np.where(~started & observed, cur, weighted)
+    # Decay the weights and add the current observation
+    old_wt = np.where(started, old_wt * old_wt_factor, old_wt)
+    update = started & observed & (weighted != cur)
+    weighted = np.where(
+        update, (old_wt * weighted + cur) / (old_wt + 1.), weighted)
+    old_wt = np.where(started & observed, old_wt + 1., old_wt)
+    return weighted, old_wt
+
+
+def __ema_values(df_in, cols, days=30) -> np.ndarray:
+    """Calculate the per-drive EMA of some columns.
+
+    Args:
+        df_in (_type_): Dataframe or drive_frame with the columns
+        cols (list): Columns to smooth
+        days (int, optional): Time interval for EMA. Defaults to 30.
+
+    Returns:
+        np.ndarray: EMAs in the row order of the input
+    """
+    if isinstance(df_in, drive_frame):
+        # Grouped by the monotonic serial codes, the groups come out in the
+        # order of the data
+        return (df_in.data[cols]
+                .groupby(df_in.codes, sort=True)
+                .ewm(span=days, min_periods=0)
+                .mean()
+                .values)
+    # Positions of the rows ordered by drive and date
+    order = drive_order(df_in)
+    # Sorted values, indexed by their sorted position
+    sorted_data = (df_in[["serial_number"] + cols]
+                   .iloc[order]
+                   .reset_index(drop=True))
+    # Calculate EMA
+    ema = (sorted_data.groupby("serial_number")
+           .ewm(span=days, min_periods=0)
+           .mean())
+    # Scatter the EMAs back to the original row order, rows without serial
+    # number are not grouped and stay NaN
+    values = np.full((len(order), len(cols)), np.nan)
+    values[order[ema.index.get_level_values(1)]] = ema.values
+    return values
+
+
+def calculate_ema(df_in, days=30, copy=True) -> pd.DataFrame:
     """Calculate the EMA of the features over time.
 
     Args:
         df_in (_type_): Dataframe with some features
+        copy (bool, optional): Copy the input, otherwise the EMA columns are
+            added to df_in in place. Defaults to True.
 
     Returns:
         pd.DataFrame: Dataframe with EMA columns
     """
-    # Dataframe with only the relevant data
-    df = df_in.copy()
-    # Sort the values
-    df.sort_values(["serial_number", "date"], inplace=True)
-    # Drop date to suppress warnings
-    df = df.drop("date", axis=1)
-    # Create grouped object
-    grouped_data = df.groupby("serial_number")
-    # Calculate EMA
-    int_series = grouped_data.ewm(span=days, min_periods=0).mean()
-    # Extract index from multiindex
-    index_series = int_series.index.get_level_values(1)
-    # Fix indices
-    int_series = pd.DataFrame(
-        int_series.values,
-        index=index_series,
-        columns=int_series.columns)
-    # Merge dataframes
-    df_out = pd.merge(
-        left=df_in,
-        right=int_series,
-        how="left",
-        left_index=True,
-        right_index=True,
-        suffixes=("", "_ema"))
-    return df_out
-
-
-def calculate_smart_999(df_in, trigger=0.05) -> pd.DataFrame:
+    df = df_in.copy() if copy else df_in
+    data = df.data if isinstance(df, drive_frame) else df
+    cols = [col for col in data.columns
+            if col not in ("serial_number", "date")]
+    data[[col + "_ema" for col in cols]] = __ema_values(df, cols, days=days)
+    return df
+
+
+def calculate_smart_999(df_in, trigger=0.05, copy=True) -> pd.DataFrame:
     """Calculate the smart_999 feature. If the raw differs from the EMA by more
     than trigger_percent, the corresponding feature initiates a trigger.
     Smart_999 sums over all those triggers.
@@ -86,19 +171,18 @@ def calculate_smart_999(df_in, trigger=0.05) -> pd.DataFrame:
     Args:
         df_in (_type_): Drive stats data
         trigger (float, optional): Percentage for triggering. Defaults to 0.05.
+        copy (bool, optional): Copy the input, otherwise the columns are
+            added to df_in in place. Defaults to True.
 
     Returns:
         pd.DataFrame: Dataframe with features
     """
-    df = df_in.copy()
-    # Select columns to use for the calculation
-    cols_to_use = ['smart_4_raw', 'smart_5_raw', 'smart_12_raw',
-                   'smart_183_raw', 'smart_184_raw', 'smart_187_raw',
-                   'smart_188_raw', 'smart_189_raw', 'smart_193_raw',
-                   'smart_192_raw', 'smart_197_raw', 'smart_198_raw',
-                   'smart_199_raw']
+    if isinstance(df_in, drive_frame):
+        return df_in.with_data(
+            calculate_smart_999(df_in.data, trigger=trigger, copy=copy))
+    df = df_in.copy() if copy else df_in
     # Loop over columns
-    for col in cols_to_use:
+    for col in TRIGGER_COLS:
         # Check if raw differs from ema by more than 5%
         df[col+"_trigger"] = (
             1/2 * np.abs((df[col] + df[col+"_ema"]) / df[col+"_ema"])
@@ -114,6 +198,34 @@ def calculate_smart_999(df_in, trigger=0.05) -> pd.DataFrame:
     return df
 
 
+def calculate_smart_999_fused(df_in, days=30, trigger=0.05,
+                              copy=True) -> pd.DataFrame:
+    """Calculate the smart_999 feature in one step. Same result as
+    calculate_ema followed by calculate_smart_999, but the EMA is only
+    calculated for the trigger columns, the triggers are evaluated on one
+    array and only the smart_999 column is added.
+
+    Args:
+        df_in (_type_): Dataframe or drive_frame with the drive stats
+        days (int, optional): Time interval for EMA. Defaults to 30.
+        trigger (float, optional): Percentage for triggering. Defaults to 0.05.
+        copy (bool, optional): Copy the input, otherwise the column is added
+            to df_in in place. Defaults to True.
+
+    Returns:
+        pd.DataFrame: Dataframe with the smart_999 feature
+    """
+    df = df_in.copy() if copy else df_in
+    data = df.data if isinstance(df, drive_frame) else df
+    raw = data[TRIGGER_COLS].values.astype(float)
+    ema = __ema_values(df, TRIGGER_COLS, days=days)
+    # Check if raw differs from ema by more than the trigger and count
+    with np.errstate(divide="ignore", invalid="ignore"):
+        triggers = 1/2 * np.abs((raw + ema) / ema) > (1+trigger)
+    data["smart_999"] = triggers.sum(axis=1)
+    return df
+
+
 def drop_feats(df_in) -> pd.DataFrame:
     """Drop columns with missing values. A threshold allows to tune which
     columns are dropped.
@@ -131,6 +243,8 @@ def drop_feats(df_in) -> pd.DataFrame:
                           'smart_197_raw', 'smart_198_raw', 'smart_199_raw',
                           'smart_240_raw', 'smart_241_raw', 'smart_242_raw',
                           'smart_999', 'serial_number']
+    if isinstance(df_in, drive_frame):
+        return df_in.with_data(df_in.data.loc[:, cols_of_importance])
     df = df_in.loc[:, cols_of_importance]
     return df
 
@@ -146,44 +260,99 @@ class log_transformer(BaseEstimator, TransformerMixin):
         return np.log(X+self.offset)
 
 
-def create_features(df_in, days=30, trigger=0.05) -> pd.DataFrame:
+def shard_drives(codes, n_shards) -> np.ndarray:
+    """Assign drives to shards with balanced row counts. The largest drives
+    are assigned first, each to the shard with the fewest rows so far.
+
+    Args:
+        codes (np.ndarray): Drive code of every row
+        n_shards (int): Number of shards
+
+    Returns:
+        np.ndarray: Shard of every row
+    """
+    counts = np.bincount(codes)
+    shard_of_drive = np.zeros(len(counts), dtype=int)
+    heap = [(0, shard) for shard in range(n_shards)]
+    for drive in np.argsort(-counts, kind="stable"):
+        rows, shard = heapq.heappop(heap)
+        shard_of_drive[drive] = shard
+        heapq.heappush(heap, (rows + counts[drive], shard))
+    return shard_of_drive[codes]
+
+
+def __create_features_parallel(df_in, days, trigger, n_jobs, backend):
+    """Run create_features on shards of drives in parallel and reassemble
+    the result in the original row order.
+    """
+    n_jobs = effective_n_jobs(n_jobs)
+    if isinstance(df_in, drive_frame):
+        shards = shard_drives(df_in.codes, n_jobs)
+        pieces = [df_in.filter(shards == shard) for shard in range(n_jobs)]
+    else:
+        shards = shard_drives(pd.factorize(df_in.serial_number)[0], n_jobs)
+        pieces = [df_in.iloc[shards == shard] for shard in range(n_jobs)]
+    results = Parallel(n_jobs=n_jobs, backend=backend)(
+        delayed(create_features)(piece, days=days, trigger=trigger)
+        for piece in pieces if len(piece))
+    if isinstance(df_in, drive_frame):
+        results = [result.data for result in results]
+    # Positions of the rows of the shards in the input
+    positions = np.concatenate([np.flatnonzero(shards == shard)
+                                for shard in range(n_jobs)])
+    df = pd.concat(results).iloc[np.argsort(positions)]
+    if isinstance(df_in, drive_frame):
+        return df_in.with_data(df)
+    return df
+
+
+def create_features(df_in, days=30, trigger=0.05, n_jobs=1,
+                    backend="loky") -> pd.DataFrame:
     """Create the fancy features.
 
     Args:
-        df_in (_type_): Dataframe as output by preprocessing script
+        df_in (_type_): Dataframe or drive_frame as output by preprocessing
+        script
         interval (int, optional): Time interval for EMA. Defaults to 30.
         trigger_percentage (float, optional): Normalized distance between raw
         and EMA. Defaults to 0.05.
+        n_jobs (int, optional): Number of parallel workers, the drives are
+            sharded across them. Defaults to 1.
+        backend (str, optional): joblib backend of the workers. Defaults to
+            "loky".
 
     Returns:
         pd.DataFrame: Dataset with new features
     """
-    df = df_in.copy()
-    # print("Feature engineering")
-    # print("Unwrapping smart_7_raw")
-    df = unwrap_smart_7(df)
-    # print("Calculating of EMAs")
-    df = calculate_ema(df, days=days)
-    # print("Calculating smart_999 feature")
-    df = calculate_smart_999(df, trigger=trigger)
-    # print("Dropping unused columns")
-    df = drop_feats(df)
-    # print("Feature engineering finished")
-    # print("Size if the dataframe:", df.shape)
-    # print("-----------------------------------------------------")
+    if effective_n_jobs(n_jobs) > 1:
+        return run_stage("features_parallel", __create_features_parallel,
+                         df_in, days, trigger, n_jobs, backend)
+    # The stages only add columns, so a shallow copy protects the input and
+    # the stages can work in place
+    df = df_in.copy(deep=False)
+    df = run_stage("unwrap", unwrap_smart_7, df, copy=False)
+    # EMA and smart_999 are calculated in one fused stage
+    df = run_stage("ema_smart_999", calculate_smart_999_fused, df, days=days,
+                   trigger=trigger, copy=False)
+    df = run_stage("drop_feats", drop_feats, df)
     return df
 
 
 class hdd_preprocessor(BaseEstimator, TransformerMixin):
-    def __init__(self, days=30, trigger=0.05):
+    def __init__(self, days=30, trigger=0.05, n_jobs=1, backend="loky"):
         self.days = days
         self.trigger = trigger
+        self.n_jobs = n_jobs
+        self.backend = backend
 
     def fit(self, X, y=None):
         return self
 
     def transform(self, X, y=None):
-        X = create_features(X, days=self.days, trigger=self.trigger)
+        X = create_features(X, days=self.days, trigger=self.trigger,
+                            n_jobs=self.n_jobs, backend=self.backend)
+        if isinstance(X, drive_frame):
+            X = X.data
         X = X.drop("serial_number", axis=1)
         return X
 
@@ -0,0 +1,122 @@
+import pandas as pd
+import numpy as np
+
+from src.hdd_preprocessing import (drop_cols, drop_missing_rows,
+                                   drop_duplicate_rows)
+from src.hdd_schema import to_dates
+from src.hdd_feature_engineering import (SMART_7_JUMP, TRIGGER_COLS,
+                                         calculate_smart_999, drop_feats,
+                                         ema_update)
+
+
+class feature_state:
+    """Per-drive state of the feature engineering to score daily drive stats
+    snapshots without recomputing the history.
+
+    For every drive the state holds the last date, the last smart_7_raw value
+    and the accumulated smart_7 offset of the unwrapping, and for every
+    trigger column the last EMA and the weight accumulator of the adjusted
+    EMA. Updating with a new day reproduces the features create_features
+    calculates on the full history.
+
+    Args:
+        days (int, optional): Time interval for EMA. Defaults to 30.
+        trigger (float, optional): Normalized distance between raw and EMA.
+            Defaults to 0.05.
+    """
+
+    def __init__(self, days=30, trigger=0.05):
+        self.days = days
+        self.trigger = trigger
+        columns = (["last_date", "smart_7_last", "smart_7_offset"]
+                   + [col + "_ema" for col in TRIGGER_COLS]
+                   + [col + "_weight" for col in TRIGGER_COLS])
+        self.state = pd.DataFrame(
+            columns=columns, index=pd.Index([], name="serial_number"))
+        self.state = self.state.astype(float).astype(
+            {"last_date": "datetime64[ns]"})
+
+    def save(self, file):
+        """Persist the state in a pickle file.
+
+        Args:
+            file (str): Path of the file
+        """
+        pd.to_pickle(self, file)
+
+    @classmethod
+    def load(cls, file):
+        """Load a persisted state.
+
+        Args:
+            file (str): Path of the file
+
+        Returns:
+            feature_state: The state
+        """
+        return pd.read_pickle(file)
+
+    def __update_day(self, df):
+        """Update the state with the rows of a single day, one per drive.
+
+        Args:
+            df (pd.DataFrame): Preprocessed drive stats of one day
+
+        Returns:
+            pd.DataFrame: Data with smart_7_mod and EMA columns
+        """
+        serials = df.serial_number.values
+        state = self.state.reindex(serials)
+        known = state.last_date.notna().values
+        if (state.last_date.values[known] >= df.date.values[known]).any():
+            raise ValueError("Snapshot is not newer than the feature state")
+        # Unwrap smart_7: add the value before a jump to the offset
+        smart_7 = df.smart_7_raw.values.astype(float)
+        last = state.smart_7_last.values
+        offset = state.smart_7_offset.fillna(0).values
+        offset = offset + np.where(smart_7 - last < SMART_7_JUMP, last, 0)
+        df["smart_7_mod"] = smart_7 + offset
+        # Adjusted EMA, new drives start with a weight of 1
+        cur = df[TRIGGER_COLS].values.astype(float)
+        weighted = state[[col + "_ema" for col in TRIGGER_COLS]].values
+        old_wt = state[[col + "_weight" for col in TRIGGER_COLS]].values
+        old_wt = np.where(np.isnan(old_wt), 1., old_wt)
+        weighted, old_wt = ema_update(weighted, old_wt, cur, days=self.days)
+        df[[col + "_ema" for col in TRIGGER_COLS]] = weighted
+        # Store the new state
+        new_state = pd.DataFrame(
+            np.hstack([weighted, old_wt]),
+            index=pd.Index(serials, name="serial_number"),
+            columns=([col + "_ema" for col in TRIGGER_COLS]
+                     + [col + "_weight" for col in TRIGGER_COLS]))
+        new_state.insert(0, "smart_7_offset", offset)
+        new_state.insert(0, "smart_7_last", smart_7)
+        new_state.insert(0, "last_date", df.date.values)
+        kept = self.state[~self.state.index.isin(serials)]
+        self.state = new_state if kept.empty else pd.concat([kept, new_state])
+        return df
+
+    def update(self, df_in) -> pd.DataFrame:
+        """Feed new drive stats snapshots into the state and create the
+        features for them. The snapshots have to be newer than the data
+        already seen for each drive.
+
+        Args:
+            df_in (pd.DataFrame): Raw drive stats of one or more days
+
+        Returns:
+            pd.DataFrame: Dataset with new features
+        """
+        df = drop_cols(df_in)
+        df = drop_missing_rows(df)
+        df = drop_duplicate_rows(df)
+        if pd.api.types.is_integer_dtype(df.date):
+            # Compact schema, the state holds dates
+            df = df.assign(date=to_dates(df.date))
+        # Days in chronological order, an empty snapshot is passed through
+        days = [df_day for _, df_day in df.groupby("date", sort=True)]
+        days = [self.__update_day(df_day.copy()) for df_day in days or [df]]
+        df = pd.concat(days).loc[df.index]
+        df = calculate_smart_999(df, trigger=self.trigger)
+        df = drop_feats(df)
+        return df
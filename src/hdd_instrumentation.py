@@ -0,0 +1,167 @@
+from logging import getLogger
+import json
+import resource
+import sys
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+logger = getLogger(__name__)
+
+# Active sinks, stages are only measured if there is at least one
+SINKS = []
+# Traced peaks of the running stages, innermost last. tracemalloc has a
+# single peak, which a nested stage resets, so the peak of the enclosing
+# stage so far is kept here.
+PEAKS = []
+
+
+class log_sink:
+    """Sink writing every stage record as a structured log message.
+
+    Args:
+        level (int, optional): Logging level. Defaults to 20 (INFO).
+    """
+
+    def __init__(self, level=20):
+        self.level = level
+
+    def __call__(self, record):
+        logger.log(self.level, json.dumps(record))
+
+
+class memory_sink:
+    """Sink collecting the stage records in a list, e.g. for tests."""
+
+    def __init__(self):
+        self.records = []
+
+    def __call__(self, record):
+        self.records.append(record)
+
+
+class json_sink:
+    """Sink collecting the stage records for a JSON report, written to the
+    file after every stage.
+
+    Args:
+        file (str): Path of the JSON report
+    """
+
+    def __init__(self, file):
+        self.file = file
+        self.records = []
+
+    def __call__(self, record):
+        self.records.append(record)
+        with open(self.file, "w") as f:
+            json.dump(self.records, f, indent=2)
+
+
+def add_sink(sink):
+    """Send the stage records to a sink.
+
+    Args:
+        sink (_type_): Callable taking the record of a stage as dict
+    """
+    SINKS.append(sink)
+
+
+def remove_sink(sink):
+    """Stop sending the stage records to a sink.
+
+    Args:
+        sink (_type_): Sink added with add_sink
+    """
+    SINKS.remove(sink)
+
+
+@contextmanager
+def instrument(*sinks):
+    """Measure the pipeline stages run inside the with block.
+
+    Args:
+        *sinks: Sinks receiving the stage records
+
+    Yields:
+        tuple: The sinks
+    """
+    for sink in sinks:
+        add_sink(sink)
+    try:
+        yield sinks
+    finally:
+        for sink in sinks:
+            remove_sink(sink)
+
+
+def __rows(value):
+    """Number of rows of a frame, or of the first frame of a tuple."""
+    if isinstance(value, tuple):
+        value = value[0] if value else None
+    if isinstance(value, str):
+        return None
+    try:
+        return len(value)
+    except TypeError:
+        return None
+
+
+def __max_rss_mb():
+    """High-water mark of the resident memory of the process in MB."""
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Bytes on macOS, kilobytes elsewhere
+    return max_rss / 2**20 if sys.platform == "darwin" else max_rss / 2**10
+
+
+def run_stage(name, func, *args, **kwargs):
+    """Run a pipeline stage. If sinks are active, the wall time, CPU time,
+    rows in and out and memory of the stage are sent to them. Without
+    sinks the function is simply called.
+
+    The peak memory allocated by the stage is traced with tracemalloc only
+    if tracing was started by the caller (e.g. tracemalloc.start()), as
+    tracing slows down the stages. The peak of a stage includes the peaks
+    of the stages nested in it. The high-water mark of the resident memory
+    of the process at the end of the stage is always reported, it is not
+    specific to the stage.
+
+    Args:
+        name (str): Name of the stage
+        func (_type_): Function of the stage, its first argument is the
+            input data
+        *args: Arguments of the function
+        **kwargs: Keyword arguments of the function
+
+    Returns:
+        _type_: Result of the function
+    """
+    if not SINKS:
+        return func(*args, **kwargs)
+    tracing = tracemalloc.is_tracing()
+    if tracing:
+        current, peak = tracemalloc.get_traced_memory()
+        if PEAKS:
+            # Keep the peak of the enclosing stage before the reset
+            PEAKS[-1] = max(PEAKS[-1], peak)
+        PEAKS.append(0)
+        tracemalloc.reset_peak()
+    wall = time.perf_counter()
+    cpu = time.process_time()
+    try:
+        result = func(*args, **kwargs)
+    finally:
+        if tracing:
+            peak = max(tracemalloc.get_traced_memory()[1], PEAKS.pop())
+            if PEAKS:
+                PEAKS[-1] = max(PEAKS[-1], peak)
+    record = {"stage": name,
+              "wall_s": time.perf_counter() - wall,
+              "cpu_s": time.process_time() - cpu,
+              "rows_in": __rows(args[0]) if args else None,
+              "rows_out": __rows(result),
+              "peak_mb": (peak - current) / 2**20 if tracing else None,
+              "process_max_rss_mb": __max_rss_mb()}
+    for sink in SINKS:
+        sink(record)
+    return result
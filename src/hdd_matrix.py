@@ -0,0 +1,164 @@
+"""Binary feature matrix format.
+
+A feature matrix file holds a small header followed by the values of a
+frame as one contiguous row-major array, so that it can be memory-mapped
+and sliced by rows without parsing or copying.
+
+Layout:
+    b"HDDMAT01"         magic and version
+    uint64 (little)     length of the JSON metadata
+    JSON metadata       columns, dtype, shape and user metadata
+    padding             up to a multiple of 64 bytes
+    values              shape[0] x shape[1] values of dtype, C order
+"""
+import json
+import os
+
+import numpy as np
+
+MAGIC = b"HDDMAT01"
+ALIGNMENT = 64
+# Rows converted and written at once
+WRITE_ROWS = 100000
+
+
+def write_matrix(file: str, X, dtype=None, metadata=None) -> str:
+    """Write a frame, series or array as binary feature matrix. The rows are
+    converted and written in blocks of WRITE_ROWS, so that the matrix is not
+    copied as a whole. The file is written to a temporary name and renamed,
+    so readers never see a partial matrix.
+
+    Args:
+        file (str): Path of the matrix file
+        X (_type_): Dataframe, series or 2-D array
+        dtype (_type_, optional): dtype of the values. Defaults to None (the
+            common dtype of the columns).
+        metadata (dict, optional): Additional JSON metadata. Defaults to
+            None.
+
+    Raises:
+        ValueError: If the values are not numeric or boolean
+
+    Returns:
+        str: Path of the matrix file
+    """
+    if hasattr(X, "columns"):
+        columns = [str(col) for col in X.columns]
+    elif hasattr(X, "name"):
+        columns = [str(X.name)]
+    else:
+        columns = [str(i) for i in range(np.shape(X)[1])]
+    rows = X.iloc if hasattr(X, "iloc") else X
+    if dtype is None:
+        dtypes = X.dtypes if hasattr(X, "columns") else [np.asarray(X).dtype]
+        try:
+            dtype = np.result_type(*dtypes)
+        except TypeError:
+            # Extension dtypes, e.g. categories
+            dtype = np.dtype(object)
+    dtype = np.dtype(dtype)
+    if dtype.hasobject:
+        raise ValueError("Only numeric and boolean columns can be written "
+                         "as feature matrix")
+    header = json.dumps({"columns": columns,
+                         "dtype": dtype.str,
+                         "shape": (len(X), len(columns)),
+                         "metadata": metadata or {}}).encode()
+    offset = len(MAGIC) + 8 + len(header)
+    padding = -offset % ALIGNMENT
+    with open(f"{file}.tmp", "wb") as f:
+        f.write(MAGIC)
+        f.write(len(header).to_bytes(8, "little"))
+        f.write(header)
+        f.write(b"\0" * padding)
+        for start in range(0, len(X), WRITE_ROWS):
+            np.ascontiguousarray(rows[start:start + WRITE_ROWS],
+                                 dtype=dtype).tofile(f)
+    os.replace(f"{file}.tmp", file)
+    return file
+
+
+def read_header(file: str) -> dict:
+    """Read the header of a matrix file.
+
+    Args:
+        file (str): Path of the matrix file
+
+    Raises:
+        ValueError: If the file is not a matrix file
+
+    Returns:
+        dict: Columns, dtype, shape, metadata and offset of the values
+    """
+    with open(file, "rb") as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f"{file} is not a feature matrix file")
+        length = int.from_bytes(f.read(8), "little")
+        header = json.loads(f.read(length))
+    offset = len(MAGIC) + 8 + length
+    header["offset"] = offset + (-offset % ALIGNMENT)
+    header["shape"] = tuple(header["shape"])
+    return header
+
+
+def open_matrix(file: str, mode="r"):
+    """Memory-map the values of a matrix file. Slices of the map are views,
+    only the touched pages are read from disk.
+
+    Args:
+        file (str): Path of the matrix file
+        mode (str, optional): Mode of np.memmap. Defaults to "r"
+            (read-only).
+
+    Returns:
+        np.memmap, list: Values and column names
+    """
+    header = read_header(file)
+    values = np.memmap(file, dtype=np.dtype(header["dtype"]), mode=mode,
+                       offset=header["offset"], shape=header["shape"])
+    return values, header["columns"]
+
+
+def read_frame(file: str, start=0, stop=None):
+    """Rows of a matrix file as dataframe on top of the memory map, without
+    copying the values.
+
+    Args:
+        file (str): Path of the matrix file
+        start (int, optional): First row. Defaults to 0.
+        stop (int, optional): End of the rows. Defaults to None (all).
+
+    Returns:
+        pd.DataFrame: Rows of the matrix
+    """
+    import pandas as pd
+
+    values, columns = open_matrix(file)
+    return pd.DataFrame(values[start:stop], columns=columns, copy=False)
+
+
+def predict_proba_matrix(model, file: str, batch_size=100000,
+                         frame=True) -> np.ndarray:
+    """Score a matrix file in slices of the memory map.
+
+    Args:
+        model (_type_): Model with predict_proba
+        file (str): Path of the matrix file
+        batch_size (int, optional): Rows per slice. Defaults to 100000.
+        frame (bool, optional): Pass the slices as dataframes with the
+            column names, as expected by sklearn pipelines fitted on
+            dataframes. Defaults to True.
+
+    Returns:
+        np.ndarray: Predicted probabilities
+    """
+    values, columns = open_matrix(file)
+    if frame:
+        import pandas as pd
+    proba = []
+    for start in range(0, len(values), batch_size):
+        X = values[start:start + batch_size]
+        if frame:
+            X = pd.DataFrame(X, columns=columns, copy=False)
+        proba.append(model.predict_proba(X))
+    return np.concatenate(proba) if proba else np.empty((0, 2))
@@ -0,0 +1,184 @@
+import pandas as pd
+import numpy as np
+
+
+def drive_offsets(codes, categories) -> pd.DataFrame:
+    """Calculate the start and stop row of every drive in drive-sorted data.
+
+    Args:
+        codes (np.ndarray): Sorted categorical codes of the serial numbers
+        categories (pd.Index): Categories belonging to the codes
+
+    Returns:
+        pd.DataFrame: Offset table indexed by serial number
+    """
+    counts = np.bincount(codes, minlength=len(categories))
+    present = np.flatnonzero(counts)
+    stops = np.cumsum(counts[present])
+    offsets = pd.DataFrame(
+        {"start": stops - counts[present], "stop": stops},
+        index=pd.Index(categories[present], name="serial_number"))
+    return offsets
+
+
+def drive_order(df) -> np.ndarray:
+    """Row positions of drive stats data ordered by serial number and date.
+
+    Args:
+        df (pd.DataFrame): Drive stats data
+
+    Returns:
+        np.ndarray: Positions of the rows in drive-sorted order
+    """
+    return (df[["serial_number", "date"]]
+            .reset_index(drop=True)
+            .sort_values(["serial_number", "date"], kind="stable")
+            .index.values)
+
+
+class drive_frame:
+    """Drive stats data sorted once by serial number and date.
+
+    The serial numbers are stored as categorical codes and an offset table
+    holds the start and stop row of every drive, so that a single drive is
+    a slice of the data instead of a boolean mask over the whole frame.
+
+    Args:
+        data (pd.DataFrame): Data sorted by serial number and date with a
+            categorical serial_number column
+        offsets (pd.DataFrame): Start and stop row per drive
+        appearance (pd.Series, optional): Rank of every drive by its first
+            row in the unsorted data. Defaults to None (sorted order).
+    """
+
+    def __init__(self, data, offsets, appearance=None):
+        self.data = data
+        self.offsets = offsets
+        self.appearance = appearance
+
+    @classmethod
+    def from_frame(cls, df):
+        """Sort drive stats data by serial number and date and build the
+        offset table.
+
+        Args:
+            df (pd.DataFrame): Drive stats data
+
+        Returns:
+            drive_frame: Partitioned drive stats data
+        """
+        data = df.sort_values(["serial_number", "date"], kind="stable")
+        data["serial_number"] = data.serial_number.astype("category")
+        serials = data.serial_number.cat
+        first_seen = pd.unique(df.serial_number.values)
+        appearance = pd.Series(np.arange(len(first_seen)), index=first_seen)
+        return cls(data, drive_offsets(serials.codes.values,
+                                       serials.categories), appearance)
+
+    def __len__(self):
+        return len(self.data)
+
+    @property
+    def index(self) -> pd.Index:
+        """Original index of the rows in drive-sorted order."""
+        return self.data.index
+
+    @property
+    def serials(self) -> pd.Index:
+        """Serial numbers of the drives in sorted order."""
+        return self.offsets.index
+
+    @property
+    def drives(self) -> pd.Index:
+        """Serial numbers of the drives in order of their first row in the
+        unsorted data, as unique() of the serial_number column."""
+        if self.appearance is None:
+            return self.serials
+        rank = self.appearance.reindex(self.serials).values
+        return self.serials[np.argsort(rank, kind="stable")]
+
+    @property
+    def codes(self) -> np.ndarray:
+        """Categorical code of the serial number of every row."""
+        return self.data.serial_number.cat.codes.values
+
+    @property
+    def drive_start(self) -> np.ndarray:
+        """Boolean mask of the rows that start a new drive."""
+        mask = np.zeros(len(self.data), dtype=bool)
+        mask[self.offsets.start.values] = True
+        return mask
+
+    def copy(self, deep=True):
+        return drive_frame(self.data.copy(deep=deep), self.offsets,
+                           self.appearance)
+
+    def with_data(self, data):
+        """Replace the data by a frame with the same rows in the same order,
+        e.g. after adding or removing columns.
+
+        Args:
+            data (pd.DataFrame): New data
+
+        Returns:
+            drive_frame: Partitioned data sharing the offset table
+        """
+        return drive_frame(data, self.offsets, self.appearance)
+
+    def filter(self, mask):
+        """Keep the rows selected by a boolean mask. The order is
+        preserved, so only the offsets need to be recalculated.
+
+        Args:
+            mask (np.ndarray): Boolean mask aligned with the rows
+
+        Returns:
+            drive_frame: Partitioned data with the selected rows
+        """
+        data = self.data[np.asarray(mask, dtype=bool)]
+        serials = data.serial_number.cat
+        return drive_frame(data, drive_offsets(serials.codes.values,
+                                               serials.categories),
+                           self.appearance)
+
+    def positions(self, serials) -> np.ndarray:
+        """Row positions of the given drives, without scanning the data.
+
+        Args:
+            serials (_type_): Serial numbers of the drives
+
+        Returns:
+            np.ndarray: Row positions in drive-sorted order
+        """
+        offsets = self.offsets.loc[np.sort(np.asarray(serials))]
+        lengths = (offsets.stop - offsets.start).values
+        # Concatenated ranges start:stop of all the selected drives
+        shift = offsets.start.values - np.cumsum(lengths) + lengths
+        return np.repeat(shift, lengths) + np.arange(lengths.sum())
+
+    def drive(self, serial) -> pd.DataFrame:
+        """Time series of a single drive.
+
+        Args:
+            serial (str): Serial number of the drive
+
+        Returns:
+            pd.DataFrame: Data of the drive
+        """
+        start, stop = self.offsets.loc[serial, ["start", "stop"]]
+        return self.data.iloc[start:stop]
+
+    def select(self, serials):
+        """Subset of the drives.
+
+        Args:
+            serials (_type_): Serial numbers of the drives
+
+        Returns:
+            drive_frame: Partitioned data of the selected drives
+        """
+        data = self.data.iloc[self.positions(serials)]
+        serials = data.serial_number.cat
+        return drive_frame(data, drive_offsets(serials.codes.values,
+                                               serials.categories),
+                           self.appearance)
@@ -1,52 +1,186 @@
 import pandas as pd
+import numpy as np
+import hashlib
 import os
-
-
-def load_drive_stats(filename: str, path: str) -> pd.DataFrame:
+from pandas.api.types import union_categoricals
+
+from src.hdd_partition import drive_frame
+from src.hdd_instrumentation import run_stage
+from src.hdd_schema import SMART_DTYPES, compact_frame, day_numbers
+
+COLS_OF_IMPORTANCE = ['smart_4_raw', 'smart_5_raw', 'smart_7_raw',
+                      'smart_9_raw', 'smart_12_raw', 'smart_183_raw',
+                      'smart_184_raw', 'smart_187_raw', 'smart_188_raw',
+                      'smart_189_raw', 'smart_190_raw', 'smart_192_raw',
+                      'smart_193_raw', 'smart_194_raw', 'smart_197_raw',
+                      'smart_198_raw', 'smart_199_raw', 'smart_240_raw',
+                      'smart_241_raw', 'smart_242_raw', 'serial_number',
+                      'date']
+# Compact dtypes for the columns read by the chunked loader, see hdd_schema
+DRIVE_STATS_DTYPES = {**SMART_DTYPES,
+                      'serial_number': "category",
+                      'failure': "uint8"}
+
+
+def load_drive_stats(filename: str, path: str, compact=False) -> pd.DataFrame:
     """Load drive stats file
 
     Args:
         filename (str): Name of the csv file
         path (str): Path of the repo
+        compact (bool, optional): Read the data with the compact schema of
+            hdd_schema, e.g. dates as day offsets. Defaults to False.
 
     Returns:
         pd.DataFrame: Dataframe containing the drive stats
     """
     file = f"{path}/data/raw/{filename}.csv"
+    if compact:
+        df = pd.read_csv(file, parse_dates=["date"],
+                         dtype={**DRIVE_STATS_DTYPES, "model": "category"})
+        return compact_frame(df)
     df = pd.read_csv(file, parse_dates=["date"])
     return df
 
 
+def read_drive_stats(filename: str, path: str, chunksize=500000):
+    """Stream the drive stats file in chunks. Only the columns of importance
+    and the failure are read, with the compact dtypes of DRIVE_STATS_DTYPES.
+
+    Args:
+        filename (str): Name of the csv file
+        path (str): Path of the repo
+        chunksize (int, optional): Number of rows per chunk. Defaults to
+            500000.
+
+    Yields:
+        pd.DataFrame: Chunk of the drive stats
+    """
+    file = f"{path}/data/raw/{filename}.csv"
+    reader = pd.read_csv(file,
+                         usecols=list(DRIVE_STATS_DTYPES) + ["date"],
+                         dtype=DRIVE_STATS_DTYPES,
+                         parse_dates=["date"],
+                         chunksize=chunksize)
+    with reader:
+        for chunk in reader:
+            yield chunk
+
+
+def __countdown_values(df_in, failures=None) -> np.ndarray:
+    """Days until the first failure of the drive for every row, NaN for
+    drives without failure.
+
+    Args:
+        df_in (_type_): Dataframe or drive_frame with the drive stats
+        failures (pd.DataFrame, optional): Serial number and date of the
+            failures, if the failure rows are not all in df_in, e.g. when
+            rows are dropped chunk by chunk. Defaults to None (failure
+            column of df_in).
+
+    Returns:
+        np.ndarray: Countdown aligned with the rows
+    """
+    if failures is not None:
+        df = df_in.data if isinstance(df_in, drive_frame) else df_in
+        # First failure day per hdd, assigned via the categorical codes
+        first_failure = (pd.Series(day_numbers(failures.date),
+                                   index=failures.serial_number.values)
+                         .groupby(level=0).min())
+        serials = pd.Categorical(df.serial_number)
+        first_failure = np.where(
+            serials.codes >= 0,
+            first_failure.reindex(serials.categories).values[serials.codes],
+            np.nan)
+        return first_failure - day_numbers(df.date)
+    if isinstance(df_in, drive_frame):
+        df = df_in.data
+        dates = day_numbers(df.date)
+        # Failure dates as integers, not failed days are set to the maximum
+        no_failure = np.iinfo(np.int64).max
+        failure = np.where(df.failure.values == 1, dates, no_failure)
+        # First failure per hdd is a reduction over the drive's slice
+        first_failure = np.minimum.reduceat(failure,
+                                            df_in.offsets.start.values)
+        first_failure = np.repeat(
+            first_failure, (df_in.offsets.stop - df_in.offsets.start).values)
+        return np.where(first_failure != no_failure,
+                        first_failure - dates, np.nan)
+    df = df_in
+    dates = day_numbers(df.date)
+    # First failure day per hdd, broadcast to all the rows of the drive
+    failure = pd.Series(np.where(df.failure.values == 1, dates, np.nan))
+    first_failure = (failure.groupby(df.serial_number.values, sort=False)
+                     .transform("min").values)
+    # Days to fail, NaN for drives without failure
+    return first_failure - dates
+
+
+def countdown(df_in) -> pd.DataFrame:
+    """Add the countdown column: days until the first failure of the drive,
+    NaN for drives without failure.
+
+    Args:
+        df_in (_type_): Dataframe or drive_frame with the drive stats
+
+    Returns:
+        pd.DataFrame: Drive stats with countdown column
+    """
+    if isinstance(df_in, drive_frame):
+        return df_in.with_data(
+            df_in.data.assign(countdown=__countdown_values(df_in)))
+    return df_in.assign(countdown=__countdown_values(df_in))
+
+
 def calculate_target(df_in, days=30):
-    """Merge failure date, calculate the countdown and the target.
+    """Calculate the countdown and the target. Observations with negative
+    countdown (repaired drives), with more than 800 days left and of drives
+    without failure are removed.
 
     Args:
-        df (pd.DataFrame): Drive stats file
+        df_in (_type_): Dataframe or drive_frame with the drive stats
         days (int): Time interval for the target calculation
 
     Returns:
-        pd.Series: Target variable
-    """
-    df = df_in.copy()  # Copy to protect input dataframe
-    # Series of all the hdds the day they failed to obtain failure date
-    failure = df[df.failure == 1]
-    # Only use first failure per hdd
-    failure = failure.sort_values('date')
-    failure = failure.drop_duplicates(keep='first', subset="serial_number")
-    # Assign failure dates
-    date_failure = (df['serial_number']
-                    .map(failure.set_index('serial_number')
-                    ['date']))
-    # Days to fail as int
-    countdown = (date_failure - df.date).dt.days
-    # Remove observations with negative countdown (repaired drives) and with
-    # more than 800 days left
-    df = df[(countdown >= 0) & (countdown < 800)]
-    target = (countdown <= days)[(countdown >= 0) & (countdown < 800)]
-    return df, target
+        _type_, pd.Series: Data and target variable
+    """
+    days_to_fail = __countdown_values(df_in)
+    keep = (days_to_fail >= 0) & (days_to_fail < 800)
+    index = df_in.index[keep]
+    target = pd.Series(days_to_fail[keep] <= days, index=index)
+    if isinstance(df_in, drive_frame):
+        return df_in.filter(keep), target
+    return df_in[keep], target
+
+
+def drive_hash(serials, seed=42) -> np.ndarray:
+    """Stable hash of the serial numbers, mapped uniformly to [0, 1). The
+    value of a drive depends only on its serial number and the seed, so
+    it is the same in every chunk, file and run.
 
+    Args:
+        serials (_type_): Serial numbers
+        seed (int, optional): Seed of the hash. Defaults to 42.
 
-def train_test_splitter(X, y, test_size=0.3, random_state=42) -> pd.DataFrame:
+    Returns:
+        np.ndarray: Hash value of every serial number, NaN for missing
+            serial numbers
+    """
+    # Every distinct serial number is hashed once
+    serials = pd.Categorical(serials)
+    key = str(seed).encode()
+    hashes = np.array(
+        [int.from_bytes(hashlib.blake2b(str(serial).encode(), digest_size=8,
+                                        key=key).digest(), "little")
+         for serial in serials.categories], dtype=np.uint64)
+    # The upper 53 bits are exact in a float
+    values = (hashes >> np.uint64(11)) / 2.0**53
+    # Missing serial numbers have the code -1
+    return np.where(serials.codes >= 0, values[serials.codes], np.nan)
+
+
+def train_test_splitter(X, y, test_size=0.3, random_state=42,
+                        method="sample") -> pd.DataFrame:
     """Train test split of the drive data
 
     Args:
@@ -55,10 +189,24 @@ def train_test_splitter(X, y, test_size=0.3, random_state=42) -> pd.DataFrame:
         test_size (float, optional): Size of the test subset. Defaults to 0.3.
         random_state (int, optional): Random state for comparability over
         different runs. Defaults to 42.
+        method (str, optional): "sample" draws test_size of the drives,
+            "hash" assigns every drive by the hash of its serial number,
+            seeded with random_state. The hash split needs no global
+            state, so it can be applied chunk by chunk or file by file.
+            Rows without serial number are in neither subset of the hash
+            split. Defaults to "sample".
 
     Returns:
         pd.DataFrame: _description_
     """
+    if method == "hash":
+        return __train_test_splitter_hashed(
+            X, y, test_size=test_size, random_state=random_state)
+    if method != "sample":
+        raise ValueError(f"Unknown split method {method}")
+    if isinstance(X, drive_frame):
+        return __train_test_splitter_partitioned(
+            X, y, test_size=test_size, random_state=random_state)
     # All the unique serial numbers
     drives = pd.Series(X.serial_number.unique(), name="HDD")
     # Random sampling of drives
@@ -74,6 +222,120 @@ def train_test_splitter(X, y, test_size=0.3, random_state=42) -> pd.DataFrame:
     return X_train, X_test, y_train, y_test
 
 
+def __train_test_splitter_partitioned(X, y, test_size=0.3, random_state=42):
+    """Train test split of drive-sorted data. The drives are selected via
+    the offset table instead of membership tests over all the rows.
+
+    Args:
+        X (drive_frame): Partitioned feature variable
+        y (pd.Series): Target variable aligned with X
+        test_size (float, optional): Size of the test subset. Defaults to 0.3.
+        random_state (int, optional): Random state. Defaults to 42.
+
+    Returns:
+        _type_: Train and test subsets of X and y
+    """
+    # All the unique serial numbers, in the order of the unsorted data so
+    # that the sample is the same as for a dataframe
+    drives = pd.Series(X.drives, name="HDD")
+    # Random sampling of drives
+    drives_test = drives.sample(int(test_size * len(drives)),
+                                random_state=random_state)
+    # Remaining drives end up in the train set
+    drives_train = drives.drop(drives_test.index, axis=0)
+    # Row positions of the drives
+    idx_train = X.positions(drives_train)
+    idx_test = X.positions(drives_test)
+    X_train = X.select(drives_train)
+    X_test = X.select(drives_test)
+    y_train = y.iloc[idx_train]
+    y_test = y.iloc[idx_test]
+    return X_train, X_test, y_train, y_test
+
+
+def __train_test_splitter_hashed(X, y, test_size=0.3, random_state=42):
+    """Train test split by the hash of the serial numbers.
+
+    Args:
+        X (_type_): Feature variable as dataframe or drive_frame
+        y (pd.Series): Target variable aligned with X
+        test_size (float, optional): Expected size of the test subset.
+            Defaults to 0.3.
+        random_state (int, optional): Seed of the hash. Defaults to 42.
+
+    Returns:
+        _type_: Train and test subsets of X and y, without the rows of
+            missing serial numbers
+    """
+    if isinstance(X, drive_frame):
+        drives = pd.Series(X.serials, name="HDD")
+        in_test = drive_hash(drives.values, seed=random_state) < test_size
+        drives_train, drives_test = drives[~in_test], drives[in_test]
+        return (X.select(drives_train), X.select(drives_test),
+                y.iloc[X.positions(drives_train)],
+                y.iloc[X.positions(drives_test)])
+    values = drive_hash(X.serial_number.values, seed=random_state)
+    in_test, in_train = values < test_size, values >= test_size
+    return X[in_train], X[in_test], y[in_train], y[in_test]
+
+
+class drive_hash_kfold:
+    """Grouped k-fold cross-validation by the hash of the serial numbers.
+    All the rows of a drive are in the same fold, and a drive is always
+    in the same fold for a given seed. Can be passed as cv to sklearn.
+
+    Args:
+        n_splits (int, optional): Number of folds. Defaults to 5.
+        seed (int, optional): Seed of the hash. Defaults to 42.
+    """
+
+    def __init__(self, n_splits=5, seed=42):
+        self.n_splits = n_splits
+        self.seed = seed
+
+    def get_n_splits(self, X=None, y=None, groups=None):
+        return self.n_splits
+
+    def folds(self, serials) -> np.ndarray:
+        """Fold of every row.
+
+        Args:
+            serials (_type_): Serial numbers of the rows
+
+        Raises:
+            ValueError: If a serial number is missing
+
+        Returns:
+            np.ndarray: Fold numbers
+        """
+        values = drive_hash(serials, seed=self.seed)
+        if np.isnan(values).any():
+            raise ValueError("Every row needs a serial number for its fold")
+        return (values * self.n_splits).astype(int)
+
+    def split(self, X, y=None, groups=None):
+        """Generate the row positions of the train and test folds.
+
+        Args:
+            X (_type_): Data as dataframe or drive_frame
+            y (_type_, optional): Ignored. Defaults to None.
+            groups (_type_, optional): Serial numbers of the rows. Defaults
+                to None (serial_number column of X).
+
+        Yields:
+            np.ndarray, np.ndarray: Train and test positions
+        """
+        if groups is None:
+            data = X.data if isinstance(X, drive_frame) else X
+            if "serial_number" not in data:
+                raise ValueError("groups are required without a "
+                                 "serial_number column")
+            groups = data.serial_number.values
+        folds = self.folds(groups)
+        for fold in range(self.n_splits):
+            yield np.flatnonzero(folds != fold), np.flatnonzero(folds == fold)
+
+
 def drop_cols(df_in) -> pd.DataFrame:
     """Drop columns with missing values. A threshold allows to tune
     which columns are dropped.
@@ -84,15 +346,9 @@ def drop_cols(df_in) -> pd.DataFrame:
     Returns:
         pd.DataFrame: Drive stats file with dropped columns
     """
-    cols_of_importance = ['smart_4_raw', 'smart_5_raw', 'smart_7_raw',
-                          'smart_9_raw', 'smart_12_raw', 'smart_183_raw',
-                          'smart_184_raw', 'smart_187_raw', 'smart_188_raw',
-                          'smart_189_raw', 'smart_190_raw', 'smart_192_raw',
-                          'smart_193_raw', 'smart_194_raw', 'smart_197_raw',
-                          'smart_198_raw', 'smart_199_raw', 'smart_240_raw',
-                          'smart_241_raw', 'smart_242_raw', 'serial_number',
-                          'date']
-    df = df_in.loc[:, cols_of_importance]
+    if isinstance(df_in, drive_frame):
+        return df_in.with_data(df_in.data.loc[:, COLS_OF_IMPORTANCE])
+    df = df_in.loc[:, COLS_OF_IMPORTANCE]
     return df
 
 
@@ -105,7 +361,9 @@ def drop_missing_rows(df_in) -> pd.DataFrame:
     Returns:
         pd.DataFrame: Drive stats data with removed rows
     """
-    df = df_in.copy().dropna(how="any")
+    if isinstance(df_in, drive_frame):
+        return df_in.filter(df_in.data.notna().all(axis=1).values)
+    df = df_in.dropna(how="any")
     return df
 
 
@@ -118,31 +376,108 @@ def drop_duplicate_rows(df_in) -> pd.DataFrame:
     Returns:
         pd.DataFrame: Drive stats data with removed rows
     """
-    df = (df_in.copy()
-          .drop_duplicates(keep='first', subset=["serial_number", "date"]))
+    if isinstance(df_in, drive_frame):
+        # Duplicates are neighbours in drive-sorted data
+        codes = df_in.codes
+        dates = df_in.data.date.values
+        duplicated = np.zeros(len(df_in), dtype=bool)
+        duplicated[1:] = (codes[1:] == codes[:-1]) & (dates[1:] == dates[:-1])
+        return df_in.filter(~duplicated)
+    df = df_in.drop_duplicates(keep='first', subset=["serial_number", "date"])
     return df
 
 
-def remove_smart_7_outliers(df_in, threshold=5e10) -> pd.DataFrame:
-    """_summary_
+def remove_smart_7_outliers(df_in, threshold=5e10, copy=True) -> pd.DataFrame:
+    """Remove the drives with smart_7_raw outliers.
 
     Args:
-        df_in (_type_): _description_
-        threshold (_type_, optional): _description_. Defaults to 5e10.
+        df_in (_type_): Dataframe or drive_frame with the drive stats
+        threshold (_type_, optional): smart_7_raw values above the threshold
+            are outliers. Defaults to 5e10.
+        copy (bool, optional): Copy the input. Without copy the input itself
+            is returned if there are no outliers. Defaults to True.
 
     Returns:
-        pd.DataFrame: _description_
+        pd.DataFrame: Drive stats without the outlier drives
     """
-    df = df_in.copy()
-    sn_to_drop = df[df.smart_7_raw > threshold].serial_number.unique()
-    for sn in sn_to_drop:
-        df = df.drop(df[df.serial_number == sn].index)
-    return df
+    if isinstance(df_in, drive_frame):
+        # Drives with at least one outlier, dropped by their codes
+        outlier = df_in.data.smart_7_raw.values > threshold
+        codes_to_drop = np.unique(df_in.codes[outlier])
+        return df_in.filter(~np.isin(df_in.codes, codes_to_drop))
+    # Drives with at least one outlier, dropped with one membership test
+    sn_to_drop = df_in.serial_number[df_in.smart_7_raw > threshold].unique()
+    if len(sn_to_drop) == 0:
+        return df_in.copy() if copy else df_in
+    return df_in[~df_in.serial_number.isin(sn_to_drop)]
+
+
+def __load_preprocess_chunked(filename, path, days=30, chunksize=500000,
+                              threshold=5e10):
+    """Load and preprocess drive stats data chunk by chunk. Rows with
+    missing values and smart_7 outliers are dropped per chunk, the failure
+    dates and the outliers are recorded beforehand, so that the target and
+    the removal of outlier drives give the same result as on the whole file.
+
+    Args:
+        filename (str): Name of the csv file
+        path (str): Path of the repo
+        days (int, optional): Time interval for the target calculation.
+            Defaults to 30.
+        chunksize (int, optional): Number of rows per chunk. Defaults to
+            500000.
+        threshold (float, optional): smart_7 outlier threshold. Defaults to
+            5e10.
+
+    Returns:
+        pd.DataFrame, pd.Series: Preprocessed data and target
+    """
+    chunks, failures, outliers = [], [], []
+    for chunk in read_drive_stats(filename, path, chunksize=chunksize):
+        failures.append(chunk.loc[chunk.failure == 1,
+                                  ["serial_number", "date"]])
+        outlier = chunk.smart_7_raw > threshold
+        outliers.append(chunk.loc[outlier, ["serial_number", "date"]])
+        chunks.append(chunk[~outlier].drop("failure", axis=1)
+                      .dropna(how="any"))
+    X = pd.concat(chunks)
+    X["serial_number"] = union_categoricals(
+        [chunk.serial_number for chunk in chunks])
+    X = X.loc[:, COLS_OF_IMPORTANCE]
+    # The recorded rows are few, plain strings are good enough for them
+    failures = pd.concat(failures).astype({"serial_number": str})
+    outliers = pd.concat(outliers).astype({"serial_number": str})
+    # Days to fail from the recorded failures, as in calculate_target
+    days_to_fail = __countdown_values(X, failures)
+    # Remove observations with negative countdown (repaired drives) and with
+    # more than 800 days left
+    window = (days_to_fail >= 0) & (days_to_fail < 800)
+    X = X[window]
+    y = pd.Series(days_to_fail[window] <= days, index=X.index)
+    # Drop the drives with outliers inside the window
+    days_to_fail = __countdown_values(outliers, failures)
+    sn_to_drop = outliers[(days_to_fail >= 0)
+                          & (days_to_fail < 800)].serial_number
+    X = X[~X.serial_number.isin(sn_to_drop)]
+    X = drop_duplicate_rows(X)
+    y = y[X.index]
+    return X, y
+
+
+def __preprocessed_frames(filename, path, days, chunksize, compact) -> dict:
+    """Preprocessed data and target as frames for the cache."""
+    X, y = load_preprocess_data(filename=filename, path=path, days=days,
+                                chunksize=chunksize, compact=compact)
+    return {"X": X, "y": y.to_frame("target")}
 
 
 def load_preprocess_data(filename="ST4000DM000_history_total",
                          path=os.getcwd(),
-                         days=30
+                         days=30,
+                         partition=False,
+                         chunksize=None,
+                         cache=None,
+                         compact=False
                          ) -> pd.DataFrame:
     """Load and preprocess drive stats data
 
@@ -150,32 +485,55 @@ def load_preprocess_data(filename="ST4000DM000_history_total",
         filename (str, optional): Name of the csv file. Defaults to
             "ST4000DM000_history".
         path (_type_, optional): Path of the repo. Defaults to os.getcwd().
+        partition (bool, optional): Sort the data once by drive and date
+            and return a drive_frame. Defaults to False.
+        chunksize (int, optional): Stream the file in chunks of this many
+            rows with compact dtypes. Defaults to None (read at once).
+        cache (data_cache, optional): Cache for the preprocessed data, keyed
+            by the hash of the file, days, the schema and whether it is read
+            in chunks, which returns compact dtypes. Defaults to None.
+        compact (bool, optional): Use the compact schema of hdd_schema,
+            e.g. dates as day offsets. Defaults to False.
 
     Returns:
         pd.DataFrame: Dataframe with the drive stats data
     """
-    # print("Preprocessing")
-    # print("Loading file", filename)
-    X = load_drive_stats(filename, path)
-    # print("Calculate the target variable")
-    X, y = calculate_target(X)
-    # print("Removing smart_7_raw outliers")
-    X = remove_smart_7_outliers(X)
-    # print("Dropping unused columns")
-    X = drop_cols(X)
-    # print("Dropping missings")
-    X = drop_missing_rows(X)
-    # print("Dropping dublicated observations")
-    X = drop_duplicate_rows(X)
+    if cache is not None:
+        key = cache.key("preprocessed", f"{path}/data/raw/{filename}.csv",
+                        days=days, compact=compact,
+                        chunked=chunksize is not None)
+        frames = cache.cached(key, __preprocessed_frames,
+                              filename, path, days, chunksize, compact)
+        X, y = frames["X"], frames["y"].target.rename(None)
+        if partition:
+            X = drive_frame.from_frame(X)
+            y = y[X.index]
+        return X, y
+    if chunksize is not None:
+        X, y = run_stage("load_chunked", __load_preprocess_chunked, filename,
+                         path, days=days, chunksize=chunksize)
+        if compact:
+            X = compact_frame(X)
+        if partition:
+            X = drive_frame.from_frame(X)
+            y = y[X.index]
+        return X, y
+    X = run_stage("load", load_drive_stats, filename, path, compact=compact)
+    if partition:
+        X = run_stage("partition", drive_frame.from_frame, X)
+    X, y = run_stage("target", calculate_target, X, days=days)
+    X = run_stage("outliers", remove_smart_7_outliers, X, copy=False)
+    X = run_stage("drop_cols", drop_cols, X)
+    X = run_stage("drop_missing", drop_missing_rows, X)
+    X = run_stage("drop_duplicates", drop_duplicate_rows, X)
     y = y[X.index]
-    # print("Preprocessing finished")
-    # print("-----------------------------------------------------")
     return X, y
 
 
 def load_preprocess_testdata(filename="ST4000DM000_history_total",
                              path=os.getcwd(),
-                             days=30
+                             days=30,
+                             partition=False
                              ) -> pd.DataFrame:
     """Load and preprocess drive stats data that does not contain information
     about the target.
@@ -184,21 +542,18 @@ def load_preprocess_testdata(filename="ST4000DM000_history_total",
         filename (str, optional): Name of the csv file. Defaults to
             "ST4000DM000_history".
         path (_type_, optional): Path of the repo. Defaults to os.getcwd().
+        partition (bool, optional): Sort the data once by drive and date
+            and return a drive_frame. Defaults to False.
 
     Returns:
         pd.DataFrame: Dataframe with the drive stats data
     """
-    # print("Preprocessing")
-    # print("Loading file", filename)
     df = load_drive_stats(filename, path)
-    # print("Dropping unused columns")
+    if partition:
+        df = drive_frame.from_frame(df)
     df = drop_cols(df)
-    # print("Dropping missings")
     df = drop_missing_rows(df)
-    # print("Dropping dublicated observations")
     df = drop_duplicate_rows(df)
-    # print("Preprocessing finished")
-    # print("-----------------------------------------------------")
     return df
 
 
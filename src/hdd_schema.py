@@ -0,0 +1,127 @@
+import pandas as pd
+import numpy as np
+
+from pandas.api.types import is_integer_dtype
+
+# Day offsets count the days since the Unix epoch, which is also the epoch of
+# numpy's datetime64[D], so the conversion is a cast
+EPOCH = pd.Timestamp("1970-01-01")
+# The SMART values can be missing, so they stay floats: float32 holds the
+# small counters exactly, the wide counters (LBAs, packed values, smart_7)
+# need float64.
+SMART_DTYPES = {col: "float32" for col in [
+    'smart_4_raw', 'smart_5_raw', 'smart_9_raw', 'smart_12_raw',
+    'smart_183_raw', 'smart_184_raw', 'smart_187_raw', 'smart_189_raw',
+    'smart_190_raw', 'smart_192_raw', 'smart_193_raw', 'smart_194_raw',
+    'smart_197_raw', 'smart_198_raw', 'smart_199_raw']}
+SMART_DTYPES.update({'smart_7_raw': "float64",
+                     'smart_188_raw': "float64",
+                     'smart_240_raw': "float64",
+                     'smart_241_raw': "float64",
+                     'smart_242_raw': "float64"})
+# Compact schema of the drive histories
+COMPACT_DTYPES = {**SMART_DTYPES,
+                  'serial_number': "category",
+                  'model': "category",
+                  'failure': "uint8",
+                  'date': "int32"}
+
+
+def to_day_offsets(dates) -> np.ndarray:
+    """Convert dates to day offsets from EPOCH.
+
+    Args:
+        dates (_type_): Dates
+
+    Returns:
+        np.ndarray: Days since EPOCH as int32
+    """
+    return (np.asarray(dates, dtype="datetime64[D]")
+            .astype(np.int64).astype(np.int32))
+
+
+def to_dates(days) -> np.ndarray:
+    """Convert day offsets from EPOCH back to dates.
+
+    Args:
+        days (_type_): Days since EPOCH
+
+    Returns:
+        np.ndarray: Dates as datetime64[ns]
+    """
+    return np.asarray(days, dtype=np.int64).astype(
+        "datetime64[D]").astype("datetime64[ns]")
+
+
+def day_numbers(dates) -> np.ndarray:
+    """Days since EPOCH of a date column, either dates or day offsets.
+
+    Args:
+        dates (pd.Series): Date column
+
+    Returns:
+        np.ndarray: Days since EPOCH as int64
+    """
+    if is_integer_dtype(dates):
+        return np.asarray(dates, dtype=np.int64)
+    return np.asarray(dates, dtype="datetime64[D]").astype(np.int64)
+
+
+def compact_frame(df) -> pd.DataFrame:
+    """Apply the compact schema to the columns of drive stats data: serial
+    numbers and models as categories, SMART values as float32 where exact,
+    dates as int32 day offsets, failures as uint8 and trigger columns as
+    booleans.
+
+    Args:
+        df (pd.DataFrame): Drive stats data
+
+    Returns:
+        pd.DataFrame: Data with compact dtypes
+    """
+    dtypes = {col: dtype for col, dtype in COMPACT_DTYPES.items()
+              if col in df and col != "date"}
+    dtypes.update({col: "bool" for col in df.columns
+                   if col.endswith("_trigger")})
+    df = df.astype(dtypes)
+    for col in ["serial_number", "model"]:
+        # Sorted categories, so that the codes sort like the strings
+        if col in df and not df[col].cat.categories.is_monotonic_increasing:
+            df[col] = df[col].cat.reorder_categories(
+                df[col].cat.categories.sort_values())
+    if "date" in df and not is_integer_dtype(df.date):
+        df["date"] = to_day_offsets(df.date)
+    return df
+
+
+def memory_report(df) -> pd.DataFrame:
+    """Memory of drive stats data per column.
+
+    Args:
+        df (pd.DataFrame): Drive stats data
+
+    Returns:
+        pd.DataFrame: dtype, bytes and bytes per row of every column, the
+            total in the last row
+    """
+    memory = df.memory_usage(index=True, deep=True)
+    report = pd.DataFrame({"dtype": df.dtypes.astype(str),
+                           "bytes": memory,
+                           "bytes_per_row": memory / max(len(df), 1)})
+    report.loc["Index", "dtype"] = type(df.index).__name__
+    report.loc["total"] = ["", memory.sum(), memory.sum() / max(len(df), 1)]
+    return report
+
+
+if __name__ == "__main__":
+    import os
+    import sys
+
+    from src.hdd_preprocessing import load_drive_stats
+
+    filename = sys.argv[1] if len(sys.argv) > 1 else \
+        "ST4000DM000_history_total"
+    before = memory_report(load_drive_stats(filename, os.getcwd()))
+    after = memory_report(load_drive_stats(filename, os.getcwd(),
+                                           compact=True))
+    print(pd.concat({"before": before, "after": after}, axis=1).to_string())
@@ -0,0 +1,104 @@
+import pandas as pd
+import numpy as np
+
+from sklearn.model_selection import GroupKFold, cross_val_score
+
+from src.hdd_partition import drive_frame, drive_order
+from src.hdd_feature_engineering import (TRIGGER_COLS, drop_feats,
+                                         ema_update, unwrap_smart_7)
+
+
+def sweep_smart_999(df_in, days=(30,), triggers=(0.05,)) -> np.ndarray:
+    """Calculate the smart_999 feature for every combination of EMA time
+    interval and trigger in a single pass over the drive-sorted data.
+
+    The EMAs of all the time intervals are advanced together, one day of
+    drive history per step for all the drives at once, and every trigger is
+    evaluated on the same EMAs.
+
+    Args:
+        df_in (_type_): Dataframe or drive_frame as output by preprocessing
+            script
+        days (tuple, optional): Time intervals for EMA. Defaults to (30,).
+        triggers (tuple, optional): Normalized distances between raw and
+            EMA. Defaults to (0.05,).
+
+    Returns:
+        np.ndarray: smart_999 with shape (rows, days, triggers) in the row
+            order of the input
+    """
+    if isinstance(df_in, drive_frame):
+        df = df_in.data
+        order = np.arange(len(df))
+        starts = df_in.offsets.start.values
+        lengths = (df_in.offsets.stop - df_in.offsets.start).values
+    else:
+        df = df_in
+        order = drive_order(df)
+        codes = pd.factorize(df.serial_number.values[order])[0]
+        starts = np.flatnonzero(np.diff(codes, prepend=-1))
+        lengths = np.diff(np.append(starts, len(order)))
+    raw = df[TRIGGER_COLS].values.astype(float)[order]
+    spans = np.asarray(days, dtype=float)[None, :, None]
+    limits = 1 + np.asarray(triggers, dtype=float)
+    # Longest drives first, the active drives of a day are a prefix
+    longest = np.argsort(-lengths, kind="stable")
+    starts, lengths = starts[longest], lengths[longest]
+    shape = (len(starts), len(days), len(TRIGGER_COLS))
+    weighted = np.full(shape, np.nan)
+    old_wt = np.ones(shape)
+    smart_999 = np.zeros((len(order), len(days), len(triggers)), dtype=np.int8)
+    for day in range(lengths.max() if len(lengths) else 0):
+        n_active = np.count_nonzero(lengths > day)
+        rows = starts[:n_active] + day
+        cur = raw[rows][:, None, :]
+        weighted[:n_active], old_wt[:n_active] = ema_update(
+            weighted[:n_active], old_wt[:n_active], cur, days=spans)
+        ema = weighted[:n_active]
+        # Check if raw differs from ema by more than the triggers and count
+        with np.errstate(divide="ignore", invalid="ignore"):
+            ratio = 1/2 * np.abs((cur + ema) / ema)
+        smart_999[rows] = (ratio[..., None] > limits).sum(axis=2)
+    # Back to the original row order
+    result = np.empty_like(smart_999)
+    result[order] = smart_999
+    return result
+
+
+def evaluate_sweep(X, y, estimator, days=(30,), triggers=(0.05,), cv=5,
+                   scoring="recall") -> pd.DataFrame:
+    """Cross-validate a model for every combination of EMA time interval and
+    trigger. The features are created once, only smart_999 is swapped per
+    combination. The folds are grouped by drive.
+
+    Args:
+        X (_type_): Dataframe or drive_frame as output by preprocessing
+            script
+        y (pd.Series): Target variable aligned with X
+        estimator (_type_): Model or pipeline to evaluate
+        days (tuple, optional): Time intervals for EMA. Defaults to (30,).
+        triggers (tuple, optional): Normalized distances between raw and
+            EMA. Defaults to (0.05,).
+        cv (int, optional): Number of folds. Defaults to 5.
+        scoring (str, optional): Scoring of cross_val_score. Defaults to
+            "recall".
+
+    Returns:
+        pd.DataFrame: Mean and standard deviation of the score per days and
+            trigger
+    """
+    smart_999 = sweep_smart_999(X, days=days, triggers=triggers)
+    df = unwrap_smart_7(X)
+    df = df.data if isinstance(df, drive_frame) else df
+    features = drop_feats(df.assign(smart_999=0))
+    groups = features.pop("serial_number")
+    scores = []
+    for i, span in enumerate(days):
+        for j, trigger in enumerate(triggers):
+            features["smart_999"] = smart_999[:, i, j]
+            score = cross_val_score(estimator, features, y, groups=groups,
+                                    cv=GroupKFold(n_splits=cv),
+                                    scoring=scoring)
+            scores.append({"days": span, "trigger": trigger,
+                           "mean": score.mean(), "std": score.std()})
+    return pd.DataFrame(scores).set_index(["days", "trigger"])
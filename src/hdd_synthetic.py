@@ -0,0 +1,223 @@
+import pandas as pd
+import numpy as np
+
+import os
+import sqlite3
+
+from src.hdd_preprocessing import COLS_OF_IMPORTANCE
+
+# smart_7_raw is a 32 bit counter that wraps around on Seagate drives
+SMART_7_WRAP = 2**32
+
+
+def generate_fleet(n_drives=1000, n_days=365, failure_rate=0.9,
+                   duplicate_rate=0.001, missing_rate=0.001,
+                   outlier_rate=0.002, start="2019-01-01",
+                   model="ST4000DM000", seed=42) -> pd.DataFrame:
+    """Generate synthetic drive stats in the Backblaze schema.
+
+    Every drive reports once a day for a random part of the time range.
+    Failing drives report a failure on their last day and their error
+    counters ramp up before. smart_7_raw wraps around at 2**32, a few
+    drives have smart_7 outliers, some rows are reported twice and some
+    rows have missing SMART values.
+
+    Args:
+        n_drives (int, optional): Number of drives. Defaults to 1000.
+        n_days (int, optional): Number of days in the time range. Defaults
+            to 365.
+        failure_rate (float, optional): Share of failing drives. Defaults
+            to 0.9.
+        duplicate_rate (float, optional): Share of duplicated rows. Defaults
+            to 0.001.
+        missing_rate (float, optional): Share of rows with missing SMART
+            values. Defaults to 0.001.
+        outlier_rate (float, optional): Share of drives with a smart_7
+            outlier. Defaults to 0.002.
+        start (str, optional): First day. Defaults to "2019-01-01".
+        model (str, optional): Drive model. Defaults to "ST4000DM000".
+        seed (int, optional): Random seed. Defaults to 42.
+
+    Returns:
+        pd.DataFrame: Drive stats ordered by date like the merged daily files
+    """
+    rng = np.random.default_rng(seed)
+    # History of every drive: first day and number of days
+    lengths = rng.integers(max(1, n_days // 4), n_days + 1, n_drives)
+    first_day = (rng.random(n_drives) * (n_days - lengths + 1)).astype(int)
+    failing = rng.random(n_drives) < failure_rate
+    drive = np.repeat(np.arange(n_drives), lengths)
+    starts = np.cumsum(lengths) - lengths
+    age = np.arange(len(drive)) - np.repeat(starts, lengths)
+    day = np.repeat(first_day, lengths) + age
+    last = age == np.repeat(lengths - 1, lengths)
+    # Days until the failure, large for the healthy drives
+    countdown = np.where(failing[drive], np.repeat(lengths - 1, lengths) - age,
+                         10**6)
+
+    def per_drive(low, high):
+        return rng.uniform(low, high, n_drives)[drive]
+
+    def counter(rate):
+        """Counter increasing per drive with a random daily rate."""
+        increments = rng.poisson(per_drive(0, 2 * rate))
+        return per_drive(0, 1000 * rate).round() + (
+            pd.Series(increments).groupby(drive).cumsum().values)
+
+    def errors(scale):
+        """Error counter ramping up in the last month before a failure on
+        half of the failing drives, with rare errors on all drives."""
+        affected = rng.random(n_drives)[drive] < 0.5
+        ramp = np.clip(30 - countdown, 0, None) * per_drive(0, scale / 30)
+        noise = rng.random(len(drive)) < 0.001
+        return np.floor(affected * ramp + noise * scale)
+
+    # smart_7 seek errors: daily increments, wrapped at 32 bits
+    seek = per_drive(1e7, 3e8) * rng.uniform(0.5, 1.5, len(drive))
+    smart_7 = np.floor(per_drive(0, SMART_7_WRAP)
+                       + pd.Series(seek).groupby(drive).cumsum().values
+                       ) % SMART_7_WRAP
+    outlier_drive = rng.random(n_drives) < outlier_rate
+    outlier_row = outlier_drive[drive] & (rng.random(len(drive)) < 0.05)
+    smart_7[outlier_row] = np.floor(
+        rng.uniform(1e11, 2.8e14, outlier_row.sum()))
+    hours = per_drive(0, 30000).round() + 24 * age
+    temperature = np.round(per_drive(20, 35) + rng.normal(0, 2, len(drive)))
+    lbas = per_drive(1e10, 1e11)
+    values = {
+        'smart_4_raw': counter(0.05),
+        'smart_5_raw': errors(50),
+        'smart_7_raw': smart_7,
+        'smart_9_raw': hours,
+        'smart_12_raw': counter(0.05),
+        'smart_183_raw': errors(1),
+        'smart_184_raw': errors(0.1),
+        'smart_187_raw': errors(5),
+        'smart_188_raw': errors(0.5),
+        'smart_189_raw': errors(2),
+        'smart_190_raw': temperature,
+        'smart_192_raw': counter(0.02),
+        'smart_193_raw': counter(50),
+        'smart_194_raw': temperature,
+        'smart_197_raw': errors(10),
+        'smart_198_raw': errors(10),
+        'smart_199_raw': errors(0.05),
+        'smart_240_raw': np.clip(hours + per_drive(-100, 0).round(), 0,
+                                 None),
+        'smart_241_raw': np.floor(lbas * (hours + 1) / 24),
+        'smart_242_raw': np.floor(0.8 * lbas * (hours + 1) / 24),
+    }
+    df = pd.DataFrame({
+        "date": pd.Timestamp(start) + pd.to_timedelta(day, unit="D"),
+        "serial_number": np.char.add("Z", np.char.zfill(
+            np.arange(n_drives).astype(str), 7))[drive],
+        "model": model,
+        "capacity_bytes": 4000787030016,
+        "failure": (last & failing[drive]).astype(int),
+        **values})
+    # Rows with missing SMART values
+    missing = rng.random(len(df)) < missing_rate
+    df.loc[missing, COLS_OF_IMPORTANCE[:-2]] = np.nan
+    # Rows reported twice
+    duplicates = df[rng.random(len(df)) < duplicate_rate]
+    df = pd.concat([df, duplicates], ignore_index=True)
+    return df.sort_values("date", kind="stable", ignore_index=True)
+
+
+def write_fleet(filename="synthetic_fleet", path=os.getcwd(), n_drives=1000,
+                n_days=365, block_drives=10000, seed=42, **kwargs) -> str:
+    """Write a synthetic drive history to data/raw/{filename}.csv, so that it
+    can be loaded with load_drive_stats or load_preprocess_data. Large
+    fleets are generated and written in blocks of drives.
+
+    Args:
+        filename (str, optional): Name of the csv file. Defaults to
+            "synthetic_fleet".
+        path (_type_, optional): Path of the repo. Defaults to os.getcwd().
+        n_drives (int, optional): Number of drives. Defaults to 1000.
+        n_days (int, optional): Number of days. Defaults to 365.
+        block_drives (int, optional): Drives generated at once. Defaults to
+            10000.
+        seed (int, optional): Random seed. Defaults to 42.
+        **kwargs: Further arguments of generate_fleet
+
+    Returns:
+        str: Path of the csv file
+    """
+    os.makedirs(f"{path}/data/raw", exist_ok=True)
+    file = f"{path}/data/raw/{filename}.csv"
+    for i, block_start in enumerate(range(0, n_drives, block_drives)):
+        block = generate_fleet(
+            n_drives=min(block_drives, n_drives - block_start),
+            n_days=n_days, seed=seed + i, **kwargs)
+        # Unique serial numbers over the blocks
+        block["serial_number"] = "Z" + (
+            block.serial_number.str[1:].astype(int) + block_start
+        ).astype(str).str.zfill(7)
+        block.to_csv(file, mode="w" if i == 0 else "a", header=i == 0,
+                     index=False)
+    return file
+
+
+def write_daily_files(folder: str, n_drives=1000, n_days=365, seed=42,
+                      **kwargs) -> list:
+    """Write a synthetic drive history as Backblaze daily drive stats files,
+    one YYYY-MM-DD.csv per day, as input of load_daily_drive_stats.
+
+    Args:
+        folder (str): Folder of the daily csv files
+        n_drives (int, optional): Number of drives. Defaults to 1000.
+        n_days (int, optional): Number of days. Defaults to 365.
+        seed (int, optional): Random seed. Defaults to 42.
+        **kwargs: Further arguments of generate_fleet
+
+    Returns:
+        list: Paths of the csv files
+    """
+    os.makedirs(folder, exist_ok=True)
+    df = generate_fleet(n_drives=n_drives, n_days=n_days, seed=seed,
+                        **kwargs)
+    files = []
+    for date, day in df.groupby("date", sort=True):
+        files.append(f"{folder}/{date:%Y-%m-%d}.csv")
+        day.to_csv(files[-1], index=False)
+    return files
+
+
+def write_fleet_db(db_file: str, table="2021", n_drives=1000, n_days=365,
+                   block_drives=10000, seed=42, **kwargs) -> str:
+    """Write a synthetic drive history to a SQLite database, as stand-in for
+    the drive stats database of the SQL notebook. Dates are stored as
+    YYYY-MM-DD strings, the table is indexed by serial number and date and
+    by model and failure.
+
+    Args:
+        db_file (str): Path of the database file
+        table (str, optional): Name of the table. Defaults to "2021".
+        n_drives (int, optional): Number of drives. Defaults to 1000.
+        n_days (int, optional): Number of days. Defaults to 365.
+        block_drives (int, optional): Drives generated at once. Defaults to
+            10000.
+        seed (int, optional): Random seed. Defaults to 42.
+        **kwargs: Further arguments of generate_fleet
+
+    Returns:
+        str: Path of the database file
+    """
+    with sqlite3.connect(db_file) as con:
+        for i, block_start in enumerate(range(0, n_drives, block_drives)):
+            block = generate_fleet(
+                n_drives=min(block_drives, n_drives - block_start),
+                n_days=n_days, seed=seed + i, **kwargs)
+            block["serial_number"] = "Z" + (
+                block.serial_number.str[1:].astype(int) + block_start
+            ).astype(str).str.zfill(7)
+            block["date"] = block.date.dt.strftime("%Y-%m-%d")
+            block.to_sql(table, con, if_exists="replace" if i == 0
+                         else "append", index=False, chunksize=100000)
+        con.execute(f'CREATE INDEX "{table}_serial_date" '
+                    f'ON "{table}" (serial_number, date)')
+        con.execute(f'CREATE INDEX "{table}_model_failure" '
+                    f'ON "{table}" (model, failure)')
+    con.close()
+    return db_file
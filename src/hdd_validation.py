@@ -0,0 +1,367 @@
+"""Regression checks of the optimized pipeline on synthetic fleets.
+
+Every check compares an optimized code path with the implementation it
+replaces or mirrors, raises an AssertionError if they differ and returns
+the largest difference. All checks run with `make validate`.
+
+Usage:
+    python -m src.hdd_validation
+    python -m src.hdd_validation --checks numpy_parity
+"""
+from logging import getLogger
+
+import numpy as np
+import pandas as pd
+
+from src.hdd_synthetic import generate_fleet
+from src.hdd_preprocessing import (calculate_target, remove_smart_7_outliers,
+                                   drop_cols, drop_missing_rows,
+                                   drop_duplicate_rows, train_test_splitter,
+                                   load_preprocess_data)
+from src.hdd_feature_engineering import (SMART_7_JUMP, calculate_ema,
+                                         calculate_smart_999,
+                                         calculate_smart_999_fused,
+                                         create_features, hdd_preprocessor,
+                                         log_transformer, unwrap_smart_7)
+from src.hdd_feature_state import feature_state
+from src.hdd_partition import drive_frame
+
+logger = getLogger(__name__)
+
+
+def __preprocessed(n_drives, n_days, seed):
+    """Preprocessed synthetic fleet and its target, as in
+    load_preprocess_data."""
+    X, y = calculate_target(generate_fleet(n_drives=n_drives, n_days=n_days,
+                                           seed=seed), days=30)
+    X = remove_smart_7_outliers(X)
+    X = drop_duplicate_rows(drop_missing_rows(drop_cols(X)))
+    return X, y[X.index]
+
+
+def __calculate_target_map(df, days=30):
+    """Reference implementation of calculate_target with a map of the
+    first failure dates."""
+    failure = df[df.failure == 1].sort_values("date")
+    failure = failure.drop_duplicates(keep="first", subset="serial_number")
+    date_failure = df.serial_number.map(
+        failure.set_index("serial_number").date)
+    countdown = (date_failure - df.date).dt.days
+    window = (countdown >= 0) & (countdown < 800)
+    return df[window], (countdown <= days)[window]
+
+
+def __remove_smart_7_outliers_loop(df, threshold=5e10):
+    """Reference implementation of remove_smart_7_outliers with a drop per
+    outlier drive."""
+    df = df.copy()
+    for sn in df[df.smart_7_raw > threshold].serial_number.unique():
+        df = df.drop(df[df.serial_number == sn].index)
+    return df
+
+
+def __unwrap_smart_7_loop(df_in):
+    """Reference implementation of unwrap_smart_7 with a loop over the
+    drives and their jumps."""
+    df = df_in.copy()
+    df["smart_7_mod"] = df.smart_7_raw.astype(float)
+    for drive in df.serial_number.unique():
+        temp_data = (df[df.serial_number == drive]
+                     .sort_values("date", ascending=True)
+                     .reset_index())
+        jumps = temp_data.smart_7_raw.diff() < SMART_7_JUMP
+        smart_7_temp = temp_data.smart_7_raw.copy()
+        for idx in jumps[jumps].index:
+            temp_data.loc[idx:, "smart_7_mod"] += smart_7_temp[idx - 1]
+        df.loc[temp_data["index"].values, "smart_7_mod"] = \
+            temp_data.smart_7_mod.values
+    return df
+
+
+def check_partitioned_split(n_drives=300, n_days=90, seed=42) -> float:
+    """train_test_splitter on a drive_frame against the split of the
+    dataframe with the same random state.
+
+    Args:
+        n_drives (int, optional): Number of drives. Defaults to 300.
+        n_days (int, optional): Number of days. Defaults to 90.
+        seed (int, optional): Random seed. Defaults to 42.
+
+    Raises:
+        AssertionError: If the splits differ
+
+    Returns:
+        float: Number of test drives that differ
+    """
+    X, y = __preprocessed(n_drives, n_days, seed)
+    X_partitioned = drive_frame.from_frame(X)
+    expected = train_test_splitter(X, y, random_state=seed)
+    result = train_test_splitter(X_partitioned, y[X_partitioned.index],
+                                 random_state=seed)
+    diff = float(len(set(expected[1].serial_number)
+                     ^ set(result[1].data.serial_number)))
+    if diff > 0:
+        raise AssertionError(f"{diff:.0f} test drives differ")
+    for expected_y, result_y in zip(expected[2:], result[2:]):
+        if not result_y.sort_index().equals(expected_y.sort_index()):
+            raise AssertionError("The targets of the split differ")
+    return diff
+
+
+def check_target_outliers(n_drives=200, n_days=120, seed=42,
+                          n_outliers=20) -> float:
+    """calculate_target and remove_smart_7_outliers on shuffled rows, on a
+    drive_frame and in the chunked loader against the map of the first
+    failure dates and the drop loop over the outlier drives.
+
+    Args:
+        n_drives (int, optional): Number of drives. Defaults to 200.
+        n_days (int, optional): Number of days. Defaults to 120.
+        seed (int, optional): Random seed. Defaults to 42.
+        n_outliers (int, optional): Rows set to a smart_7 outlier.
+            Defaults to 20.
+
+    Raises:
+        AssertionError: If the rows or the targets differ
+
+    Returns:
+        float: Number of rows that differ
+    """
+    import os
+    import tempfile
+
+    raw = generate_fleet(n_drives=n_drives, n_days=n_days, seed=seed)
+    # Shuffled, with the row positions of the csv file as index
+    raw = raw.sample(frac=1, random_state=seed).reset_index(drop=True)
+    rng = np.random.default_rng(seed)
+    outliers = rng.choice(len(raw), n_outliers, replace=False)
+    raw.loc[raw.index[outliers], "smart_7_raw"] = 1e11
+    expected_X, expected_y = __calculate_target_map(raw)
+    expected_X = __remove_smart_7_outliers_loop(expected_X)
+    expected_y = expected_y[expected_X.index]
+    X, y = calculate_target(raw)
+    X = remove_smart_7_outliers(X)
+    if not (X.equals(expected_X) and y[X.index].equals(expected_y)):
+        raise AssertionError("The preprocessed dataframes differ")
+    X, y = calculate_target(drive_frame.from_frame(raw))
+    X = remove_smart_7_outliers(X)
+    results = [(X.index, y[X.index])]
+    with tempfile.TemporaryDirectory() as path:
+        os.makedirs(f"{path}/data/raw")
+        raw.to_csv(f"{path}/data/raw/fleet.csv", index=False)
+        X, y = load_preprocess_data("fleet", path, chunksize=len(raw) // 7)
+    results.append((X.index, y))
+    # The chunked loader also drops the missing and duplicate rows
+    cleaned = drop_duplicate_rows(drop_missing_rows(drop_cols(expected_X)))
+    diff = 0.
+    for (index, result), expected in zip(
+            results, [expected_y, expected_y[cleaned.index]]):
+        result = pd.Series(result.values, index=index).sort_index()
+        expected = expected.sort_index()
+        diff = max(diff, float(len(index.symmetric_difference(
+            expected.index))))
+        if diff == 0:
+            diff = float((result.values != expected.values).sum())
+    if diff > 0:
+        raise AssertionError(f"{diff:.0f} rows differ")
+    return diff
+
+
+def check_unwrap_smart_7(n_drives=100, n_days=120, seed=42) -> float:
+    """unwrap_smart_7 on shuffled rows and on a drive_frame against the
+    loop over the drives and jumps.
+
+    Args:
+        n_drives (int, optional): Number of drives. Defaults to 100.
+        n_days (int, optional): Number of days. Defaults to 120.
+        seed (int, optional): Random seed. Defaults to 42.
+
+    Raises:
+        AssertionError: If the unwrapped values differ
+
+    Returns:
+        float: Maximum absolute difference of smart_7_mod
+    """
+    X, _ = __preprocessed(n_drives, n_days, seed)
+    X = X.sample(frac=1, random_state=seed)
+    expected = __unwrap_smart_7_loop(X).smart_7_mod
+    diff = 0.
+    for result in [unwrap_smart_7(X),
+                   unwrap_smart_7(drive_frame.from_frame(X)).data]:
+        diff = max(diff, float(np.abs(
+            result.smart_7_mod - expected[result.index]).max()))
+    if diff > 0:
+        raise AssertionError(f"smart_7_mod differs by {diff}")
+    return diff
+
+
+def check_smart_999_fused(n_drives=200, n_days=120, seed=42) -> float:
+    """calculate_smart_999_fused against calculate_ema followed by
+    calculate_smart_999, on a dataframe with float64 and with float32
+    values and on a drive_frame.
+
+    Args:
+        n_drives (int, optional): Number of drives. Defaults to 200.
+        n_days (int, optional): Number of days. Defaults to 120.
+        seed (int, optional): Random seed. Defaults to 42.
+
+    Raises:
+        AssertionError: If the smart_999 values differ
+
+    Returns:
+        float: Maximum absolute difference of smart_999
+    """
+    X, _ = __preprocessed(n_drives, n_days, seed)
+    X = unwrap_smart_7(X).sample(frac=1, random_state=seed)
+    smart = [col for col in X if col.startswith("smart_")]
+    diff = 0.
+    for data in [X, X.astype({col: np.float32 for col in smart})]:
+        expected = calculate_smart_999(calculate_ema(data)).smart_999
+        for result in [calculate_smart_999_fused(data),
+                       calculate_smart_999_fused(
+                           drive_frame.from_frame(data)).data]:
+            diff = max(diff, float(np.abs(
+                result.smart_999 - expected[result.index]).max()))
+    if diff > 0:
+        raise AssertionError(f"smart_999 differs by {diff}")
+    return diff
+
+
+def check_feature_state(n_drives=100, n_days=60, seed=42) -> float:
+    """Features of feature_state, fed day by day and persisted after every
+    day, against create_features on the full history.
+
+    Args:
+        n_drives (int, optional): Number of drives. Defaults to 100.
+        n_days (int, optional): Number of days. Defaults to 60.
+        seed (int, optional): Random seed. Defaults to 42.
+
+    Raises:
+        AssertionError: If the features differ
+
+    Returns:
+        float: Maximum absolute difference of the features
+    """
+    import tempfile
+
+    raw = generate_fleet(n_drives=n_drives, n_days=n_days, seed=seed)
+    expected = create_features(
+        drop_duplicate_rows(drop_missing_rows(drop_cols(raw))))
+    state = feature_state(days=30, trigger=0.05)
+    days = []
+    with tempfile.TemporaryDirectory() as path:
+        for _, snapshot in raw.groupby("date", sort=True):
+            days.append(state.update(snapshot))
+            state.save(f"{path}/state.pkl")
+            state = feature_state.load(f"{path}/state.pkl")
+    result = pd.concat(days).loc[expected.index, expected.columns]
+    if not result.serial_number.equals(expected.serial_number):
+        raise AssertionError("The rows of the features differ")
+    features = result.columns.drop("serial_number")
+    diff = float(np.abs(result[features].values.astype(float)
+                        - expected[features].values.astype(float)).max())
+    if diff > 0:
+        raise AssertionError(f"The features differ by {diff}")
+    return diff
+
+
+def check_numpy_parity(n_drives=200, n_days=90, seed=42, atol=1e-5) -> float:
+    """Probabilities of the numpy inference engine against predict_proba of
+    the original models: the grid search of deployment_xgb and the nested
+    scaling and stacking pipeline of run_training, with a logistic
+    regression in place of the Keras network.
+
+    Args:
+        n_drives (int, optional): Number of drives. Defaults to 200.
+        n_days (int, optional): Number of days. Defaults to 90.
+        seed (int, optional): Random seed. Defaults to 42.
+        atol (float, optional): Tolerated absolute difference. Defaults to
+            1e-5.
+
+    Raises:
+        AssertionError: If the probabilities differ by more than atol
+
+    Returns:
+        float: Maximum absolute difference of the probabilities
+    """
+    from sklearn.ensemble import StackingClassifier
+    from sklearn.linear_model import LogisticRegression
+    from sklearn.model_selection import GridSearchCV
+    from sklearn.pipeline import Pipeline
+    from sklearn.preprocessing import MinMaxScaler
+    from xgboost import XGBClassifier
+
+    from src.numpy_inference import check_parity, compile_estimator, \
+        numpy_model
+
+    X, y = __preprocessed(n_drives, n_days, seed)
+    X = hdd_preprocessor(days=30, trigger=0.05).fit_transform(X)
+
+    def scaling():
+        return Pipeline([('scaler_log', log_transformer(offset=1)),
+                         ('scaler_minmax ', MinMaxScaler())])
+
+    models = {
+        "grid_search": GridSearchCV(
+            Pipeline(scaling().steps + [
+                ('xgb', XGBClassifier(n_estimators=20, max_depth=4))]),
+            {"xgb__eta": [0.1, 0.3]}, cv=2),
+        "nested_stacking": Pipeline([
+            ('scaling', scaling()),
+            ('stacking', StackingClassifier(
+                estimators=[
+                    ('xgb', XGBClassifier(n_estimators=20, max_depth=4)),
+                    ('lr', LogisticRegression())],
+                final_estimator=LogisticRegression()))])}
+    diff = 0.
+    for name, model in models.items():
+        model.fit(X, y)
+        arrays = {}
+        compiled = numpy_model(compile_estimator(model, arrays), arrays)
+        diff = max(diff, check_parity(model, compiled, X, atol=atol))
+    return diff
+
+
+# Checks by name
+CHECKS = {"partitioned_split": check_partitioned_split,
+          "target_outliers": check_target_outliers,
+          "unwrap_smart_7": check_unwrap_smart_7,
+          "smart_999_fused": check_smart_999_fused,
+          "feature_state": check_feature_state,
+          "numpy_parity": check_numpy_parity}
+
+
+def run_checks(names=None) -> dict:
+    """Run the checks and log their differences.
+
+    Args:
+        names (list, optional): Names of the checks. Defaults to None (all
+            of CHECKS).
+
+    Raises:
+        AssertionError: If a check fails
+
+    Returns:
+        dict: Maximum difference per check
+    """
+    results = {}
+    for name in names or CHECKS:
+        results[name] = CHECKS[name]()
+        logger.info(f"{name}: max diff {results[name]:.2e}")
+    return results
+
+
+if __name__ == "__main__":
+    import argparse
+    import logging
+
+    logger = logging.getLogger()
+    logging.basicConfig(format="%(asctime)s: %(message)s")
+    logger.setLevel(logging.INFO)
+
+    parser = argparse.ArgumentParser(description="Run the regression checks")
+    parser.add_argument("--checks", nargs="+", choices=list(CHECKS),
+                        default=None)
+    args = parser.parse_args()
+
+    run_checks(args.checks)
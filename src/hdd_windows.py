@@ -0,0 +1,229 @@
+import pandas as pd
+import numpy as np
+
+from numpy.lib.stride_tricks import sliding_window_view
+
+from src.hdd_partition import drive_frame
+from src.hdd_schema import day_numbers
+
+# Rows converted at once when the buffer is filled
+BLOCK_ROWS = 500000
+
+
+class drive_windows:
+    """Fixed-length windows over the daily histories of the drives.
+
+    The features of all drives are copied once into a padded buffer. Every
+    drive is a contiguous block of the buffer on its own day grid, preceded
+    by window - 1 padding days, and days without data are padding as well.
+    The windows are a strided view of the buffer, days x features per
+    window, so they are not materialized and a window never spans two
+    drives. The mask marks the observed days.
+
+    Args:
+        buffer (np.ndarray): Padded features, days x features
+        mask (np.ndarray): Observed days of the buffer
+        ends (np.ndarray): Buffer position of the last day of every window
+        serials (np.ndarray): Serial number of every window
+        countdown (np.ndarray): Countdown at the last day of every window,
+            None if the windows are not aligned on a countdown
+        columns (list): Names of the features
+        window (int): Days per window
+    """
+
+    def __init__(self, buffer, mask, ends, serials, countdown, columns,
+                 window):
+        self.buffer = buffer
+        self.mask = mask
+        self.ends = ends
+        self.serials = serials
+        self.countdown = countdown
+        self.columns = columns
+        self.window = window
+
+    @classmethod
+    def from_frame(cls, df_in, window=30, countdown="countdown", columns=None,
+                   fill_value=0., dtype=np.float32):
+        """Build the windows ending at every row of drive stats or feature
+        data. The days of a drive are placed by the countdown of
+        calculate_target, so that the windows are aligned on the failure.
+        As preprocessing drops the failures, the countdown is given as
+        series of the raw data, e.g. countdown(load_drive_stats(...))
+        .countdown, aligned by the index. Without countdown the dates are
+        used if present, otherwise the rows of a drive are consecutive
+        days.
+
+        Args:
+            df_in (_type_): Dataframe or drive_frame with a serial_number
+                column
+            window (int, optional): Days per window. Defaults to 30.
+            countdown (_type_, optional): Column name, series aligned by the
+                index or array aligned with the rows, None to align on the
+                dates. Defaults to "countdown" (used if the column exists).
+            columns (list, optional): Feature columns. Defaults to None (all
+                numeric columns but countdown and failure).
+            fill_value (float, optional): Features of the padding days.
+                Defaults to 0.
+            dtype (_type_, optional): dtype of the buffer. Defaults to
+                np.float32.
+
+        Raises:
+            ValueError: If the countdown is missing for some rows
+
+        Returns:
+            drive_windows: Windows ending at every row
+        """
+        df = df_in.data if isinstance(df_in, drive_frame) else df_in
+        if isinstance(countdown, str):
+            countdown = df[countdown].values if countdown in df else None
+        elif isinstance(countdown, pd.Series):
+            countdown = countdown.loc[df.index].values
+        if columns is None:
+            columns = [col for col in df.select_dtypes("number").columns
+                       if col not in ("countdown", "failure", "date")]
+        codes, serials = pd.factorize(df.serial_number)
+        # Day of every row, increasing in time within a drive
+        if countdown is not None:
+            countdown = np.asarray(countdown, dtype=np.float64)
+            if np.isnan(countdown).any():
+                raise ValueError("The countdown is missing for some rows, "
+                                 "e.g. of drives without failure")
+            day = -countdown.astype(np.int64)
+        elif "date" in df:
+            day = day_numbers(df.date)
+        else:
+            day = pd.Series(codes).groupby(codes).cumcount().values
+        n_drives = len(serials)
+        first = np.full(n_drives, np.iinfo(np.int64).max)
+        last = np.full(n_drives, np.iinfo(np.int64).min)
+        np.minimum.at(first, codes, day)
+        np.maximum.at(last, codes, day)
+        # Block of every drive: padding days, then its day grid
+        lengths = last - first + window
+        block_start = np.cumsum(lengths) - lengths
+        position = block_start[codes] + window - 1 + day - first[codes]
+        buffer = np.full((lengths.sum(), len(columns)), fill_value,
+                         dtype=dtype)
+        # In blocks of rows, so that the features are not converted at once
+        for start in range(0, len(df), BLOCK_ROWS):
+            rows = slice(start, start + BLOCK_ROWS)
+            buffer[position[rows]] = df[columns].iloc[rows].to_numpy(
+                dtype=dtype)
+        mask = np.zeros(len(buffer), dtype=bool)
+        mask[position] = True
+        # Windows in the order of the drives and days
+        order = np.argsort(position, kind="stable")
+        return cls(buffer, mask, position[order],
+                   np.asarray(serials)[codes[order]],
+                   None if countdown is None else countdown[order],
+                   list(columns), window)
+
+    def __len__(self):
+        return len(self.ends)
+
+    @property
+    def strided(self) -> np.ndarray:
+        """View of all windows of the buffer, positions x days x features,
+        the window ending at buffer position p is strided[p - window + 1].
+        """
+        return sliding_window_view(self.buffer, self.window,
+                                   axis=0).transpose(0, 2, 1)
+
+    @property
+    def strided_mask(self) -> np.ndarray:
+        """View of the masks of all windows of the buffer."""
+        return sliding_window_view(self.mask, self.window)
+
+    def windows(self, index=None) -> np.ndarray:
+        """Features of the windows, windows x days x features. Only the
+        selected windows are copied out of the strided view.
+
+        Args:
+            index (_type_, optional): Positions or boolean mask of the
+                windows. Defaults to None (all).
+
+        Returns:
+            np.ndarray: Windows
+        """
+        ends = self.ends if index is None else self.ends[index]
+        return self.strided[ends - self.window + 1]
+
+    def masks(self, index=None) -> np.ndarray:
+        """Observed days of the windows, windows x days.
+
+        Args:
+            index (_type_, optional): Positions or boolean mask of the
+                windows. Defaults to None (all).
+
+        Returns:
+            np.ndarray: Padding masks, True for observed days
+        """
+        ends = self.ends if index is None else self.ends[index]
+        return self.strided_mask[ends - self.window + 1]
+
+    def filter(self, keep):
+        """Keep a subset of the windows, e.g. by countdown or by drive. The
+        buffer is shared.
+
+        Args:
+            keep (np.ndarray): Boolean mask of the windows
+
+        Returns:
+            drive_windows: Selected windows
+        """
+        keep = np.asarray(keep, dtype=bool)
+        return drive_windows(self.buffer, self.mask, self.ends[keep],
+                             self.serials[keep],
+                             None if self.countdown is None
+                             else self.countdown[keep],
+                             self.columns, self.window)
+
+    def target(self, days=30) -> np.ndarray:
+        """Target of the windows as in calculate_target: failure within
+        days after the last day of the window.
+
+        Args:
+            days (int, optional): Time interval of the target. Defaults to
+                30.
+
+        Raises:
+            ValueError: If the windows are not aligned on a countdown
+
+        Returns:
+            np.ndarray: Target of every window
+        """
+        if self.countdown is None:
+            raise ValueError("The windows are not aligned on a countdown")
+        return self.countdown <= days
+
+
+def batch_generator(windows, targets=None, batch_size=256, epochs=None,
+                    shuffle=True, seed=42):
+    """Batches of windows for Keras. Only the windows of a batch are copied
+    out of the strided view. Without targets the windows are their own
+    target, as for an autoencoder.
+
+    Args:
+        windows (drive_windows): Windows
+        targets (np.ndarray, optional): Target of every window. Defaults to
+            None (autoencoder).
+        batch_size (int, optional): Windows per batch. Defaults to 256.
+        epochs (int, optional): Passes over the windows. Defaults to None
+            (endless, as expected by keras fit with steps_per_epoch).
+        shuffle (bool, optional): Shuffle the windows. Defaults to True.
+        seed (int, optional): Seed of the shuffling. Defaults to 42.
+
+    Yields:
+        np.ndarray, np.ndarray: Windows and target of a batch
+    """
+    rng = np.random.default_rng(seed)
+    epoch = 0
+    while epochs is None or epoch < epochs:
+        order = (rng.permutation(len(windows)) if shuffle
+                 else np.arange(len(windows)))
+        for start in range(0, len(order), batch_size):
+            batch = np.sort(order[start:start + batch_size])
+            X = windows.windows(batch)
+            yield X, (X if targets is None
+                      else np.asarray(targets)[batch].astype(np.float32))
+        epoch += 1
@@ -1,7 +1,26 @@
+import argparse
+
 from src.train import __get_data
+from src.hdd_matrix import write_matrix
+
+parser = argparse.ArgumentParser(description="Make the processed dataset")
+parser.add_argument("--format", choices=["csv", "binary"], default="csv",
+                    help="csv files, or binary matrix files (.bin) that can "
+                    "be memory-mapped, see src.hdd_matrix")
+args = parser.parse_args()
 
-X_train, X_test, y_train, y_test = __get_data()
-X_train.to_csv("data/processed/X_train.csv", index=False)
-y_train.to_csv("data/processed/y_train.csv", index=False)
-X_test.to_csv("data/processed/X_test.csv", index=False)
-y_test.to_csv("data/processed/y_test.csv", index=False)
+X_train, X_test, y_train, y_test, keys_train, keys_test = __get_data(
+    keys=True)
+# Serial number and date of the rows of the features, the key columns of
+# src.batch_scoring
+for name, keys in [("keys_train", keys_train), ("keys_test", keys_test)]:
+    keys.to_csv(f"data/processed/{name}.csv", index=False)
+for name, data, keys in [("X_train", X_train, "keys_train.csv"),
+                         ("y_train", y_train, None),
+                         ("X_test", X_test, "keys_test.csv"),
+                         ("y_test", y_test, None)]:
+    if args.format == "binary":
+        write_matrix(f"data/processed/{name}.bin", data,
+                     metadata={"keys": keys} if keys else None)
+    else:
+        data.to_csv(f"data/processed/{name}.csv", index=False)
@@ -0,0 +1,324 @@
+import json
+import os
+import tempfile
+
+import numpy as np
+
+
+def __xgb_trees(booster, arrays, prefix) -> dict:
+    """Convert the trees of an XGBoost booster into padded node arrays.
+    Nodes go left if the feature is smaller than the threshold, missing
+    values follow the default direction. For leaves, the threshold holds
+    the leaf value, as in the JSON model of XGBoost.
+    """
+    with tempfile.TemporaryDirectory() as folder:
+        booster.save_model(f"{folder}/model.json")
+        with open(f"{folder}/model.json") as f:
+            learner = json.load(f)["learner"]
+    trees = learner["gradient_booster"]["model"]["trees"]
+    n_nodes = max(len(tree["left_children"]) for tree in trees)
+    shape = (len(trees), n_nodes)
+    left = np.full(shape, -1, dtype=np.int32)
+    right = np.full(shape, -1, dtype=np.int32)
+    feature = np.zeros(shape, dtype=np.int32)
+    threshold = np.zeros(shape, dtype=np.float32)
+    default_left = np.zeros(shape, dtype=bool)
+    for i, tree in enumerate(trees):
+        n = len(tree["left_children"])
+        left[i, :n] = tree["left_children"]
+        right[i, :n] = tree["right_children"]
+        feature[i, :n] = tree["split_indices"]
+        threshold[i, :n] = tree["split_conditions"]
+        default_left[i, :n] = np.asarray(tree["default_left"], dtype=bool)
+    # Base score in probability space, stored as "5E-1" or "[5E-1]"
+    base_score = float(
+        str(learner["learner_model_param"]["base_score"]).strip("[]"))
+    for name, array in [("left", left), ("right", right),
+                        ("feature", feature), ("threshold", threshold),
+                        ("default_left", default_left)]:
+        arrays[f"{prefix}_{name}"] = array
+    return {"type": "xgb", "arrays": prefix,
+            "base_margin": float(np.log(base_score / (1 - base_score)))}
+
+
+def compile_estimator(estimator, arrays, prefix="m") -> dict:
+    """Compile a fitted model into a framework-free description. The
+    parameters are stored as arrays in arrays, the returned description
+    refers to them by name.
+
+    Supported are Pipeline, GridSearchCV, MinMaxScaler, log_transformer,
+    XGBClassifier, KerasClassifier (dense layers), LogisticRegression and
+    StackingClassifier.
+
+    Args:
+        estimator (_type_): Fitted model
+        arrays (dict): Arrays of the compiled model, updated in place
+        prefix (str, optional): Prefix of the array names. Defaults to "m".
+
+    Returns:
+        dict: Description of the compiled model
+    """
+    kind = type(estimator).__name__
+    if kind == "GridSearchCV":
+        return compile_estimator(estimator.best_estimator_, arrays, prefix)
+    if kind == "Pipeline":
+        return {"type": "pipeline",
+                "steps": [compile_estimator(step, arrays, f"{prefix}_{i}")
+                          for i, (_, step) in enumerate(estimator.steps)]}
+    if kind == "log_transformer":
+        return {"type": "log", "offset": float(estimator.offset)}
+    if kind == "MinMaxScaler":
+        arrays[f"{prefix}_scale"] = estimator.scale_
+        arrays[f"{prefix}_min"] = estimator.min_
+        return {"type": "minmax", "arrays": prefix}
+    if kind == "XGBClassifier":
+        return __xgb_trees(estimator.get_booster(), arrays, prefix)
+    if kind == "KerasClassifier":
+        layers = []
+        for layer in estimator.model.layers:
+            weights = layer.get_weights()
+            if not weights:  # Dropout is inactive for predictions
+                continue
+            i = len(layers)
+            arrays[f"{prefix}_w{i}"] = weights[0].astype(np.float32)
+            arrays[f"{prefix}_b{i}"] = weights[1].astype(np.float32)
+            layers.append(layer.get_config()["activation"])
+        return {"type": "dense", "arrays": prefix, "activations": layers}
+    if kind == "LogisticRegression":
+        arrays[f"{prefix}_coef"] = estimator.coef_
+        arrays[f"{prefix}_intercept"] = estimator.intercept_
+        return {"type": "logistic", "arrays": prefix}
+    if kind == "StackingClassifier":
+        return {"type": "stacking",
+                "estimators": [compile_estimator(est, arrays, f"{prefix}_{i}")
+                               for i, est in enumerate(estimator.estimators_)],
+                "final": compile_estimator(estimator.final_estimator_, arrays,
+                                           f"{prefix}_final"),
+                "passthrough": bool(estimator.passthrough)}
+    raise TypeError(f"Cannot compile {kind}")
+
+
+def export_model(model_path: str, file=None) -> str:
+    """Compile a model saved with mlflow into a numpy file (.npz) that can be
+    scored with numpy_model, without mlflow, sklearn, xgboost or keras.
+
+    Args:
+        model_path (str): Folder of the saved model, e.g.
+            "models/deployment_xgb"
+        file (str, optional): Output file. Defaults to model.npz in the
+            model folder.
+
+    Returns:
+        str: Path of the output file
+    """
+    from mlflow.sklearn import load_model
+
+    file = file or f"{model_path}/model.npz"
+    arrays = {}
+    spec = compile_estimator(load_model(model_path), arrays)
+    np.savez(file, spec=np.array(json.dumps(spec)), **arrays)
+    return file
+
+
+def sigmoid(x):
+    return 1 / (1 + np.exp(-x))
+
+
+class numpy_model:
+    """Vectorized numpy scoring of a compiled model.
+
+    Args:
+        spec (dict): Description of the compiled model
+        arrays (dict): Arrays of the compiled model
+    """
+
+    def __init__(self, spec, arrays):
+        self.spec = spec
+        self.arrays = arrays
+
+    @classmethod
+    def load(cls, file):
+        """Load a model exported by export_model.
+
+        Args:
+            file (str): Path of the .npz file, or of the model folder
+
+        Returns:
+            numpy_model: The model
+        """
+        if os.path.isdir(file):
+            file = f"{file}/model.npz"
+        with np.load(file) as data:
+            arrays = {key: data[key] for key in data.files if key != "spec"}
+            spec = json.loads(str(data["spec"]))
+        return cls(spec, arrays)
+
+    def __transform(self, spec, X):
+        kind = spec["type"]
+        if kind == "pipeline":
+            # Nested pipeline of transformers, e.g. the scaling of
+            # run_training
+            for step in spec["steps"]:
+                X = self.__transform(step, X)
+            return X
+        if kind == "log":
+            return np.log(X + spec["offset"])
+        if kind == "minmax":
+            prefix = spec["arrays"]
+            return (X * self.arrays[f"{prefix}_scale"]
+                    + self.arrays[f"{prefix}_min"])
+        raise TypeError(f"{kind} is not a transformer")
+
+    def __xgb(self, spec, X):
+        arrays = {name: self.arrays[f"{spec['arrays']}_{name}"]
+                  for name in ["left", "right", "feature", "threshold",
+                               "default_left"]}
+        X = X.astype(np.float32)
+        n_trees, n_nodes = arrays["left"].shape
+        arrays = {name: array.ravel() for name, array in arrays.items()}
+        # Flat node index of every row in every tree, all start at the root
+        node = np.tile(np.arange(n_trees, dtype=np.int64) * n_nodes,
+                       (len(X), 1))
+        rows = np.arange(len(X))[:, None] * X.shape[1]
+        X = X.ravel()
+        # Walk all rows down all trees at once until all reached a leaf
+        while True:
+            left = arrays["left"].take(node)
+            inner = left >= 0
+            if not inner.any():
+                break
+            value = X.take(rows + arrays["feature"].take(node))
+            go_left = np.where(np.isnan(value),
+                               arrays["default_left"].take(node),
+                               value < arrays["threshold"].take(node))
+            child = np.where(go_left, left, arrays["right"].take(node))
+            node = np.where(inner, node - node % n_nodes + child, node)
+        margin = (arrays["threshold"].take(node)
+                  .astype(np.float64).sum(axis=1) + spec["base_margin"])
+        return sigmoid(margin)
+
+    def __dense(self, spec, X):
+        X = X.astype(np.float32)
+        for i, activation in enumerate(spec["activations"]):
+            X = (X @ self.arrays[f"{spec['arrays']}_w{i}"]
+                 + self.arrays[f"{spec['arrays']}_b{i}"])
+            if activation == "relu":
+                X = np.maximum(X, 0)
+            elif activation == "sigmoid":
+                X = sigmoid(X)
+            elif activation != "linear":
+                raise TypeError(f"Unsupported activation {activation}")
+        return X[:, 0].astype(np.float64)
+
+    def __logistic(self, spec, X):
+        prefix = spec["arrays"]
+        margin = X @ self.arrays[f"{prefix}_coef"][0] + \
+            self.arrays[f"{prefix}_intercept"][0]
+        return sigmoid(margin)
+
+    def __proba(self, spec, X):
+        """Probability of the positive class."""
+        kind = spec["type"]
+        if kind == "pipeline":
+            for step in spec["steps"][:-1]:
+                X = self.__transform(step, X)
+            return self.__proba(spec["steps"][-1], X)
+        if kind == "xgb":
+            return self.__xgb(spec, X)
+        if kind == "dense":
+            return self.__dense(spec, X)
+        if kind == "logistic":
+            return self.__logistic(spec, X)
+        if kind == "stacking":
+            Z = np.column_stack([self.__proba(est, X)
+                                 for est in spec["estimators"]])
+            if spec["passthrough"]:
+                Z = np.hstack([Z, X])
+            return self.__proba(spec["final"], Z)
+        raise TypeError(f"{kind} is not a classifier")
+
+    def predict_proba(self, X, batch_size=100000) -> np.ndarray:
+        """Predict the class probabilities like the original model.
+
+        Args:
+            X (_type_): Features as dataframe or array
+            batch_size (int, optional): Rows scored at once. Defaults to
+                100000.
+
+        Returns:
+            np.ndarray: Probabilities of the classes 0 and 1
+        """
+        X = np.asarray(X, dtype=np.float64)
+        proba = np.concatenate(
+            [self.__proba(self.spec, X[start:start + batch_size])
+             for start in range(0, len(X), batch_size)] or [np.empty(0)])
+        return np.column_stack([1 - proba, proba])
+
+    def predict(self, X, threshold=0.501) -> np.ndarray:
+        """Predict the class with the threshold of run_predict."""
+        return self.predict_proba(X)[:, 1] > threshold
+
+
+def check_parity(model, compiled, X, atol=1e-5) -> float:
+    """Compare the probabilities of a compiled model with the original.
+
+    Args:
+        model (_type_): Original model
+        compiled (numpy_model): Compiled model
+        X (_type_): Features
+        atol (float, optional): Tolerated absolute difference. Defaults to
+            1e-5.
+
+    Raises:
+        AssertionError: If the difference is larger than atol
+
+    Returns:
+        float: Maximum absolute difference of the probabilities
+    """
+    diff = np.abs(model.predict_proba(X) - compiled.predict_proba(X)).max()
+    if diff > atol:
+        raise AssertionError(f"Probabilities differ by {diff} > {atol}")
+    return float(diff)
+
+
+if __name__ == "__main__":
+    import logging
+    import subprocess
+    import sys
+    import time
+
+    import pandas as pd
+    from mlflow.sklearn import load_model
+
+    logger = logging.getLogger()
+    logging.basicConfig(format="%(asctime)s: %(message)s")
+    logger.setLevel(logging.INFO)
+
+    X_test = pd.read_csv("data/processed/X_test.csv")
+    for name in ["deployment_xgb", "deployment_ann", "deployment_stacked"]:
+        model_path = f"models/{name}"
+        file = export_model(model_path)
+        model = load_model(model_path)
+        compiled = numpy_model.load(file)
+        diff = check_parity(model, compiled, X_test)
+        start = time.perf_counter()
+        model.predict_proba(X_test)
+        original = time.perf_counter() - start
+        start = time.perf_counter()
+        compiled.predict_proba(X_test)
+        numpy_time = time.perf_counter() - start
+        # Cold start: fresh interpreter, load the model and score one row
+        cold = {}
+        for kind, code in [
+                ("mlflow", "from mlflow.sklearn import load_model; "
+                 f"load_model('{model_path}')"),
+                ("numpy", "from src.numpy_inference import numpy_model; "
+                 f"numpy_model.load('{file}')")]:
+            start = time.perf_counter()
+            subprocess.run([sys.executable, "-c", code], check=True)
+            cold[kind] = time.perf_counter() - start
+        logger.info(f"{name}: max diff {diff:.2e}, "
+                    f"rows/s {len(X_test) / original:.0f} -> "
+                    f"{len(X_test) / numpy_time:.0f}, "
+                    f"cold start {cold['mlflow']:.2f}s -> "
+                    f"{cold['numpy']:.2f}s")
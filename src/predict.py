@@ -1,7 +1,6 @@
 from logging import getLogger
 import warnings
 import os
-from mlflow.sklearn import load_model
 
 from src.hdd_preprocessing import load_preprocess_testdata
 
@@ -29,6 +28,8 @@ def __get_model():
     Returns:
         _type_: Model
     """
+    from mlflow.sklearn import load_model
+
     model_path = "models/deployment_xgb"
     model = load_model(model_path)
     return model
@@ -53,6 +54,7 @@ def run_predict(X_test):
 
 
 if __name__ == "__main__":
+    import argparse
     import logging
     import pandas as pd
 
@@ -61,7 +63,20 @@ if __name__ == "__main__":
     # avoid excessive logs
     logging.getLogger("pyhive").setLevel(logging.CRITICAL)
     logger.setLevel(logging.INFO)
-    X_test = pd.read_csv("data/processed/X_test.csv")
+
+    parser = argparse.ArgumentParser(description="Predict HDD failures")
+    parser.add_argument("--format", choices=["csv", "binary"], default="csv",
+                        help="Format of the processed test data written by "
+                        "src.make_dataset")
+    args = parser.parse_args()
+
+    if args.format == "binary":
+        from src.hdd_matrix import read_frame
+
+        # Memory-mapped, the values are not copied
+        X_test = read_frame("data/processed/X_test.bin")
+    else:
+        X_test = pd.read_csv("data/processed/X_test.csv")
     y_pred = run_predict(X_test)
     print(y_pred)
     pd.Series(y_pred[:, 0]).to_csv("data/processed/y_pred.csv", index=False)
@@ -0,0 +1,158 @@
+"""Fast-start scoring of processed features.
+
+Only the standard library is imported at module level. numpy and pandas are
+imported when scoring, mlflow only if the model has not been exported with
+src.numpy_inference.export_model. Nothing from src.train is imported.
+
+Usage:
+    python -m src.score --input data/processed/X_test.csv \
+        --output data/processed/y_pred.csv
+    python -m src.score --input data/processed/X_test.bin
+    python -m src.score --check-imports
+"""
+from logging import getLogger
+import argparse
+import os
+import re
+import subprocess
+import sys
+
+logger = getLogger(__name__)
+
+# Modules that must not be imported when scoring with an exported model
+HEAVY_MODULES = ("mlflow", "keras", "tensorflow", "xgboost", "sklearn",
+                 "src.train")
+# Budgets of the import time in seconds of the prediction entry points
+IMPORT_BUDGETS = {"src.score": 0.1, "src.predict": 1.0}
+
+
+def load_scoring_model(model_path: str):
+    """Load a model for scoring. An exported model (model.npz) is loaded with
+    numpy only, otherwise the model is loaded with mlflow.
+
+    Args:
+        model_path (str): Folder of the saved model
+
+    Returns:
+        _type_: Model with predict_proba
+    """
+    if os.path.exists(f"{model_path}/model.npz"):
+        from src.numpy_inference import numpy_model
+
+        return numpy_model.load(model_path)
+    logger.info("No exported model found, loading with mlflow")
+    from mlflow.sklearn import load_model
+
+    return load_model(model_path)
+
+
+def score(input_file: str, output_file=None,
+          model_path="models/deployment_xgb", threshold=0.501):
+    """Predict the failures for a csv or binary matrix file of processed
+    features. Matrix files (.bin, see src.hdd_matrix) are memory-mapped and
+    scored in slices without parsing or copying.
+
+    Args:
+        input_file (str): Csv or matrix file of the features, e.g.
+            X_test.csv
+        output_file (str, optional): Csv file for the predictions. Defaults
+            to None (not written).
+        model_path (str, optional): Folder of the saved model. Defaults to
+            "models/deployment_xgb".
+        threshold (float, optional): Probability threshold of a failure.
+            Defaults to 0.501.
+
+    Returns:
+        np.ndarray: Predicted targets
+    """
+    import pandas as pd
+
+    model = load_scoring_model(model_path)
+    if input_file.endswith(".bin"):
+        from src.hdd_matrix import predict_proba_matrix
+
+        y_proba = predict_proba_matrix(model, input_file)
+    else:
+        y_proba = model.predict_proba(pd.read_csv(input_file))
+    y_pred = y_proba[:, 1] > threshold
+    if output_file is not None:
+        pd.Series(y_pred).to_csv(output_file, index=False)
+    return y_pred
+
+
+def import_times(module="src.score") -> dict:
+    """Import a module in a fresh interpreter with -X importtime.
+
+    Args:
+        module (str, optional): Module to import. Defaults to "src.score".
+
+    Returns:
+        dict: Cumulative import time in seconds per imported module
+    """
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c",
+                             f"import {module}"],
+                            capture_output=True, text=True, check=True)
+    times = {}
+    for line in result.stderr.splitlines():
+        match = re.match(r"import time:\s+\d+ \|\s+(\d+) \|(\s*)(\S+)", line)
+        if match:
+            times[match.group(3)] = int(match.group(1)) / 1e6
+    return times
+
+
+def check_import_budget(module="src.score", budget=None,
+                        forbidden=HEAVY_MODULES) -> float:
+    """Enforce the startup budget of a module: its import time must stay
+    below the budget and none of the heavy modules may be imported.
+
+    Args:
+        module (str, optional): Module to check. Defaults to "src.score".
+        budget (float, optional): Maximum import time in seconds. Defaults
+            to None (budget of the module in IMPORT_BUDGETS).
+        forbidden (tuple, optional): Modules that must not be imported.
+            Defaults to HEAVY_MODULES.
+
+    Raises:
+        AssertionError: If the budget is exceeded or a heavy module is
+            imported
+
+    Returns:
+        float: Import time of the module in seconds
+    """
+    budget = budget or IMPORT_BUDGETS[module]
+    times = import_times(module)
+    heavy = sorted(name for name in times
+                   if name.split(".")[0] in forbidden or name in forbidden)
+    if heavy:
+        raise AssertionError(f"{module} imports {', '.join(heavy)}")
+    if times[module] > budget:
+        raise AssertionError(
+            f"Import of {module} took {times[module]:.3f}s > {budget}s")
+    return times[module]
+
+
+if __name__ == "__main__":
+    import logging
+
+    logger = logging.getLogger()
+    logging.basicConfig(format="%(asctime)s: %(message)s")
+    logger.setLevel(logging.INFO)
+
+    parser = argparse.ArgumentParser(description="Predict HDD failures")
+    parser.add_argument("--input", default="data/processed/X_test.csv")
+    parser.add_argument("--output", default="data/processed/y_pred.csv")
+    parser.add_argument("--model", default="models/deployment_xgb")
+    parser.add_argument("--threshold", type=float, default=0.501)
+    parser.add_argument("--check-imports", action="store_true",
+                        help="Check the import time budget and exit")
+    args = parser.parse_args()
+
+    if args.check_imports:
+        for module in IMPORT_BUDGETS:
+            logger.info(f"Import of {module}: "
+                        f"{check_import_budget(module):.3f}s")
+    else:
+        y_pred = score(args.input, args.output, model_path=args.model,
+                       threshold=args.threshold)
+        logger.info(f"{y_pred.sum()} of {len(y_pred)} drives predicted to "
+                    "fail")
@@ -0,0 +1,259 @@
+from logging import getLogger
+import asyncio
+import os
+import time
+from collections import deque
+
+import numpy as np
+import pandas as pd
+
+logger = getLogger(__name__)
+
+MODELS = ("deployment_xgb", "deployment_ann", "deployment_stacked")
+
+
+def model_signature(model_path: str) -> int:
+    """Latest modification time of the files of a saved model, used to detect
+    a changed model.
+
+    Args:
+        model_path (str): Folder of the saved model
+
+    Returns:
+        int: Modification time in nanoseconds
+    """
+    return max(os.stat(f"{model_path}/{file}").st_mtime_ns
+               for file in os.listdir(model_path))
+
+
+class model_registry:
+    """Keep the deployed models in memory. Every model is loaded once and
+    reloaded when the files in its folder change.
+
+    Args:
+        path (str, optional): Folder of the models. Defaults to "models".
+        names (tuple, optional): Models to serve. Defaults to MODELS.
+        loader (_type_, optional): Function loading a model from its folder.
+            Defaults to None (mlflow.sklearn.load_model).
+        check_interval (float, optional): Seconds between checks for changed
+            models. Defaults to 5.
+    """
+
+    def __init__(self, path="models", names=MODELS, loader=None,
+                 check_interval=5.):
+        if loader is None:
+            from mlflow.sklearn import load_model as loader
+        self.path = path
+        self.names = names
+        self.loader = loader
+        self.check_interval = check_interval
+        self.models = {}
+        self.signatures = {}
+        self.checked = {}
+        for name in names:
+            self.__load(name)
+
+    def __load(self, name):
+        model_path = f"{self.path}/{name}"
+        signature = model_signature(model_path)
+        logger.info(f"Loading model {name}")
+        self.models[name] = self.loader(model_path)
+        self.signatures[name] = signature
+        self.checked[name] = time.monotonic()
+
+    def get(self, name):
+        """Model by name, hot-swapped if its folder changed. If the changed
+        model cannot be loaded, e.g. while its files are being written, the
+        previous model is kept and the reload is retried at the next check.
+
+        Args:
+            name (str): Name of the model
+
+        Returns:
+            _type_: The model
+        """
+        if name not in self.models:
+            raise KeyError(f"Unknown model {name}")
+        if time.monotonic() - self.checked[name] >= self.check_interval:
+            self.checked[name] = time.monotonic()
+            try:
+                if model_signature(f"{self.path}/{name}") != \
+                        self.signatures[name]:
+                    self.__load(name)
+            except Exception:
+                logger.exception(f"Reloading model {name} failed, keeping "
+                                 "the loaded model")
+        return self.models[name]
+
+
+class scoring_server:
+    """In-process scoring server. Concurrent requests for the same model are
+    coalesced into one predict_proba call, either when max_batch rows are
+    waiting or when the oldest request waited max_wait seconds.
+
+    Args:
+        registry (model_registry): Models to serve
+        max_batch (int, optional): Maximum rows per batch. Defaults to 10000.
+        max_wait (float, optional): Maximum seconds a request waits for a
+            batch. Defaults to 0.005.
+        history (int, optional): Number of latencies kept for the stats.
+            Defaults to 100000.
+    """
+
+    def __init__(self, registry, max_batch=10000, max_wait=0.005,
+                 history=100000):
+        self.registry = registry
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.latencies = deque(maxlen=history)
+        self.queues = {}
+        self.workers = {}
+        self.n_requests = 0
+        self.n_rows = 0
+        self.n_batches = 0
+        self.started = time.perf_counter()
+
+    async def predict_proba(self, X, name="deployment_xgb") -> np.ndarray:
+        """Score a request.
+
+        Args:
+            X (pd.DataFrame): Features
+            name (str, optional): Name of the model. Defaults to
+                "deployment_xgb".
+
+        Returns:
+            np.ndarray: Predicted probabilities
+        """
+        start = time.perf_counter()
+        n_rows = len(X)
+        if name not in self.workers:
+            self.queues[name] = asyncio.Queue()
+            self.workers[name] = asyncio.create_task(self.__batcher(name))
+        future = asyncio.get_running_loop().create_future()
+        await self.queues[name].put((X, n_rows, future))
+        y_proba = await future
+        self.latencies.append(time.perf_counter() - start)
+        self.n_requests += 1
+        self.n_rows += n_rows
+        return y_proba
+
+    async def predict(self, X, name="deployment_xgb", threshold=0.501):
+        """Score a request and apply the threshold of run_predict."""
+        return await self.predict_proba(X, name=name) > threshold
+
+    async def __batcher(self, name):
+        queue = self.queues[name]
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await queue.get()]
+            rows = batch[0][1]
+            deadline = loop.time() + self.max_wait
+            # Collect more requests until the batch is full or the oldest
+            # request has waited long enough
+            while rows < self.max_batch:
+                try:
+                    request = queue.get_nowait()
+                except asyncio.QueueEmpty:
+                    timeout = deadline - loop.time()
+                    if timeout <= 0:
+                        break
+                    try:
+                        request = await asyncio.wait_for(queue.get(), timeout)
+                    except asyncio.TimeoutError:
+                        break
+                batch.append(request)
+                rows += request[1]
+            try:
+                # Reload and run the model off the event loop
+                model = await loop.run_in_executor(None, self.registry.get,
+                                                   name)
+                features = pd.concat([X for X, _, _ in batch],
+                                     ignore_index=True)
+                y_proba = await loop.run_in_executor(
+                    None, model.predict_proba, features)
+            except Exception as error:
+                # Fail the requests of the batch, not the batcher
+                for _, _, future in batch:
+                    if not future.done():
+                        future.set_exception(error)
+                continue
+            self.n_batches += 1
+            split = np.cumsum([n_rows for _, n_rows, _ in batch])[:-1]
+            for (_, _, future), part in zip(batch,
+                                            np.split(y_proba, split)):
+                # Requests may have been cancelled while waiting
+                if not future.done():
+                    future.set_result(part)
+
+    def stats(self) -> dict:
+        """Latency percentiles and throughput since the start.
+
+        Returns:
+            dict: Statistics of the server
+        """
+        latencies = np.array(self.latencies) if self.latencies else np.nan
+        elapsed = time.perf_counter() - self.started
+        return {"requests": self.n_requests,
+                "batches": self.n_batches,
+                "p50_ms": 1000 * np.percentile(latencies, 50),
+                "p99_ms": 1000 * np.percentile(latencies, 99),
+                "requests_per_s": self.n_requests / elapsed,
+                "rows_per_s": self.n_rows / elapsed}
+
+    async def close(self):
+        """Stop the batchers."""
+        for worker in self.workers.values():
+            worker.cancel()
+        await asyncio.gather(*self.workers.values(), return_exceptions=True)
+        self.workers = {}
+
+
+async def load_test(server, X, n_requests=1000, concurrency=50,
+                    rows_per_request=1, name="deployment_xgb") -> dict:
+    """Generate load on the scoring server with concurrent clients sending
+    small requests.
+
+    Args:
+        server (scoring_server): Server under test
+        X (pd.DataFrame): Features to sample the requests from
+        n_requests (int, optional): Number of requests. Defaults to 1000.
+        concurrency (int, optional): Number of concurrent clients. Defaults
+            to 50.
+        rows_per_request (int, optional): Rows per request. Defaults to 1.
+        name (str, optional): Name of the model. Defaults to
+            "deployment_xgb".
+
+    Returns:
+        dict: Statistics of the server
+    """
+    rng = np.random.default_rng(42)
+    remaining = iter(range(n_requests))
+
+    async def client():
+        for _ in remaining:
+            start = rng.integers(0, len(X) - rows_per_request + 1)
+            await server.predict_proba(
+                X.iloc[start:start + rows_per_request], name=name)
+
+    await asyncio.gather(*[client() for _ in range(concurrency)])
+    return server.stats()
+
+
+if __name__ == "__main__":
+    import logging
+
+    logger = logging.getLogger()
+    logging.basicConfig(format="%(asctime)s: %(message)s")
+    logger.setLevel(logging.INFO)
+
+    X_test = pd.read_csv("data/processed/X_test.csv")
+    registry = model_registry()
+
+    async def benchmark():
+        for max_wait in (0., 0.002, 0.01):
+            server = scoring_server(registry, max_wait=max_wait)
+            stats = await load_test(server, X_test)
+            await server.close()
+            logger.info(f"max_wait={max_wait}: {stats}")
+
+    asyncio.run(benchmark())
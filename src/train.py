@@ -9,6 +9,9 @@ from keras.wrappers.scikit_learn import KerasClassifier
 
 from src.hdd_preprocessing import load_preprocess_data, train_test_splitter
 from src.hdd_feature_engineering import hdd_preprocessor, log_transformer
+from src.hdd_cache import CODE_MODULES, data_cache
+from src.batch_scoring import KEY_COLUMNS
+from src.hdd_instrumentation import add_sink, log_sink, run_stage
 
 from sklearn.preprocessing import MinMaxScaler
 from sklearn.pipeline import Pipeline
@@ -55,37 +58,95 @@ def __create_ann_model__(input_dim=19):
     return model
 
 
-def __get_data():
+def __get_data(cache=None, keys=False):
     """Load and preprocess the data for the modeling. The data is loaded and
     split into train and test datasets. Afterward, we preprocess the data and
     create the features for both datasets.
 
+    Args:
+        cache (data_cache, optional): Cache for the preprocessed data and the
+            features. Defaults to None.
+        keys (bool, optional): Also return the serial number and date of
+            the rows of the train and test datasets. Defaults to False.
+
     Returns:
-        _type_: Train and test datasets.
+        _type_: Train and test datasets, and their keys if requested.
+    """
+    if cache is not None:
+        # The data preparation of this module is part of the stage
+        key = cache.key(
+            "features",
+            f"{os.getcwd()}/data/raw/ST4000DM000_history_total.csv",
+            modules=CODE_MODULES + ("src.train",),
+            days=30, trigger=0.05, test_size=0.30, random_state=RSEED)
+        frames = cache.cached(key, __get_data_frames, cache)
+        data = (frames["X_train"], frames["X_test"],
+                frames["y_train"].target.rename(None),
+                frames["y_test"].target.rename(None),
+                frames["keys_train"], frames["keys_test"])
+    else:
+        data = __prepare_data()
+    return data if keys else data[:4]
+
+
+def __get_data_frames(cache):
+    """Train and test datasets as frames for the cache."""
+    X_train, X_test, y_train, y_test, keys_train, keys_test = \
+        __prepare_data(cache)
+    return {"X_train": X_train, "X_test": X_test,
+            "y_train": y_train.to_frame("target"),
+            "y_test": y_test.to_frame("target"),
+            "keys_train": keys_train, "keys_test": keys_test}
+
+
+def __keys(X):
+    """Serial number and date of the rows of drive-sorted data, the
+    features keep its rows and their order."""
+    return X.data.loc[:, list(KEY_COLUMNS)].astype({"serial_number": str})
+
+
+def __prepare_data(cache=None):
+    """Run the data preparation of __get_data.
+
+    Args:
+        cache (data_cache, optional): Cache for the preprocessed data.
+            Defaults to None.
+
+    Returns:
+        _type_: Train and test datasets and their keys.
     """
     logger.info("Loading and preprocessing data")
     X, y = load_preprocess_data(
         days=30,
         filename="ST4000DM000_history_total",
-        path=os.getcwd())
+        path=os.getcwd(),
+        partition=True,
+        cache=cache)
     logger.info("Train-test splitting")
-    X_train, X_test, y_train, y_test = train_test_splitter(
-        X, y, test_size=0.30, random_state=RSEED)
+    X_train, X_test, y_train, y_test = run_stage(
+        "split", train_test_splitter, X, y, test_size=0.30,
+        random_state=RSEED)
     logger.info("Feature engineering on train")
     # Create instance of our preprocessor
     preprocessor = hdd_preprocessor(days=30, trigger=0.05)
+    keys_train, keys_test = __keys(X_train), __keys(X_test)
     X_train = preprocessor.fit_transform(X_train)
     logger.info("Feature engineering on test")
     X_test = preprocessor.transform(X_test)
-    return X_train, X_test, y_train, y_test
+    return X_train, X_test, y_train, y_test, keys_train, keys_test
 
 
-def run_training():
+def run_training(use_cache=True):
     """Load the data, construct the model and fit it. Save the model for
     deployment.
+
+    Args:
+        use_cache (bool, optional): Reuse the cached data preparation of
+            previous runs. Defaults to True.
     """
     logger.info("Getting the data")
-    X_train, X_test, y_train, y_test = __get_data()
+    X_train, X_test, y_train, y_test = __get_data(
+        cache=data_cache() if use_cache else None)
     logger.info("Training")
     # Scaling pipeline
     scaling_pipe = Pipeline([
@@ -127,7 +188,7 @@ def run_training():
         ('scaling', scaling_pipe),
         ('stacking', clf)])
     logger.info("Fitting in progress")
-    model.fit(X_train, y_train)
+    run_stage("fit", model.fit, X_train, y_train)
     # logger.info("Pickle")
     # filename = 'deployment.bin'
     # with open(filename, 'wb') as file_out:
@@ -146,5 +207,7 @@ if __name__ == "__main__":
     # avoid excessive logs
     logging.getLogger("pyhive").setLevel(logging.CRITICAL)
     logger.setLevel(logging.INFO)
+    # Time and memory of every stage in the logs
+    add_sink(log_sink())
 
     run_training()
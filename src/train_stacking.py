@@ -0,0 +1,370 @@
+"""Stacking with drive-grouped, cached out-of-fold predictions.
+
+StackingClassifier refits every base learner for each of its internal
+row-wise folds, in every run. Here the folds are computed once by drive
+(drive_hash_kfold), every base learner is fitted once per fold and once on
+all rows, and its out-of-fold predictions and full fit are cached. A
+change of the final estimator only refits the final estimator on the
+cached predictions.
+
+All fits run under one CPU budget: the fits are spread over
+n_cpus // threads worker processes and every fit gets threads threads for
+XGBoost, TensorFlow and the BLAS libraries.
+"""
+from logging import getLogger
+import hashlib
+import json
+import os
+import time
+
+import numpy as np
+import pandas as pd
+from joblib import Parallel, delayed
+from sklearn.base import clone
+from sklearn.linear_model import LogisticRegression
+from sklearn.pipeline import Pipeline
+from sklearn.preprocessing import MinMaxScaler
+from xgboost import XGBClassifier
+
+from src.hdd_cache import code_version, data_cache
+from src.hdd_feature_engineering import hdd_preprocessor, log_transformer
+from src.hdd_instrumentation import run_stage
+from src.hdd_preprocessing import (drive_hash_kfold, load_preprocess_data,
+                                   train_test_splitter)
+from src.train_streaming import stacked_classifier
+
+logger = getLogger(__name__)
+
+RSEED = 42
+# Parameters of the base learners of run_training
+XGB_PARAMS = {"objective": "binary:logistic", "colsample_bytree": 0.4,
+              "subsample": 0.3, "eta": 0.01, "gamma": 1, "max_depth": 6,
+              "n_estimators": 50, "min_child_weight": 2, "reg_lambda": 0.7,
+              "reg_alpha": 1}
+ANN_PARAMS = {"epochs": 150, "batch_size": 40000}
+
+
+def xgb_learner(n_threads: int, weight: float, **params) -> XGBClassifier:
+    """XGBoost base learner.
+
+    Args:
+        n_threads (int): Threads of the fit
+        weight (float): Weight of the failures
+        **params: XGBoost parameters
+
+    Returns:
+        XGBClassifier: Unfitted model
+    """
+    return XGBClassifier(scale_pos_weight=weight, n_jobs=n_threads, **params)
+
+
+def ann_learner(n_threads: int, weight: float, **params):
+    """ANN base learner of run_training. Keras is only imported here.
+
+    Args:
+        n_threads (int): Threads of the fit, set through the thread limits
+            of the worker
+        weight (float): Weight of the failures
+        **params: Parameters of KerasClassifier, e.g. epochs
+
+    Returns:
+        _type_: Unfitted KerasClassifier
+    """
+    from keras.wrappers.scikit_learn import KerasClassifier
+
+    from src.train import __create_ann_model__
+
+    model = KerasClassifier(build_fn=__create_ann_model__,
+                            class_weight={0: 1.0, 1: weight}, verbose=0,
+                            **params)
+    model._estimator_type = "classifier"
+    return model
+
+
+# Base learners by name: factory and JSON parameters, which are part of the
+# cache key
+BASE_LEARNERS = {"xgb": (xgb_learner, XGB_PARAMS),
+                 "ann": (ann_learner, ANN_PARAMS)}
+
+
+def plan_budget(n_tasks: int, n_cpus=None, threads=None):
+    """Split a CPU budget between parallel fits.
+
+    Args:
+        n_tasks (int): Number of fits
+        n_cpus (int, optional): Cores of the budget. Defaults to None (all
+            cores).
+        threads (int, optional): Threads per fit. Defaults to None (the
+            cores are spread evenly over the parallel fits).
+
+    Returns:
+        int, int: Number of worker processes and threads per fit
+    """
+    n_cpus = n_cpus or os.cpu_count()
+    if threads is None:
+        n_workers = max(1, min(n_tasks, n_cpus))
+        return n_workers, max(1, n_cpus // n_workers)
+    return max(1, min(n_tasks, n_cpus // threads)), threads
+
+
+def __limit_threads(n_threads: int):
+    """Limit the threads of the BLAS libraries and TensorFlow in a worker."""
+    from threadpoolctl import threadpool_limits
+
+    threadpool_limits(n_threads)
+    for var in ["OMP_NUM_THREADS", "MKL_NUM_THREADS",
+                "OPENBLAS_NUM_THREADS"]:
+        os.environ[var] = str(n_threads)
+    try:
+        import tensorflow as tf
+
+        tf.config.threading.set_intra_op_parallelism_threads(n_threads)
+        tf.config.threading.set_inter_op_parallelism_threads(1)
+    except (ImportError, RuntimeError):
+        # Not installed, or already initialized in a reused worker
+        pass
+
+
+def __fit_task(factory, params, weight, n_threads, X, y, train, test):
+    """Fit a base learner on the train rows. Returns the probabilities of
+    the test rows, or the fitted model if there are no test rows."""
+    __limit_threads(n_threads)
+    model = factory(n_threads, weight, **params)
+    model.fit(X[train], y[train])
+    if test is None:
+        return model
+    return model.predict_proba(X[test])[:, 1]
+
+
+def data_key(X, y, folds) -> str:
+    """Content hash of the training data and the fold assignment.
+
+    Args:
+        X (_type_): Features
+        y (_type_): Target
+        folds (np.ndarray): Fold of every row
+
+    Returns:
+        str: Hex digest
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    for values in [np.ascontiguousarray(X), np.asarray(y), folds]:
+        digest.update(str(values.shape).encode())
+        digest.update(np.ascontiguousarray(values).view(np.uint8))
+    return digest.hexdigest()
+
+
+def fit_base_learners(X, y, folds, learners=None, weight=1., n_cpus=None,
+                      threads=None, cache=None):
+    """Out-of-fold predictions and full fits of the base learners. Cached
+    learners are loaded, the fits of the others run in parallel under the
+    CPU budget.
+
+    Args:
+        X (np.ndarray): Scaled features
+        y (np.ndarray): Target
+        folds (np.ndarray): Fold of every row
+        learners (dict, optional): Base learners by name, factory and
+            parameters. Defaults to None (BASE_LEARNERS).
+        weight (float, optional): Weight of the failures. Defaults to 1.
+        n_cpus (int, optional): Cores of the budget. Defaults to None (all
+            cores).
+        threads (int, optional): Threads per fit. Defaults to None.
+        cache (data_cache, optional): Cache of the predictions and models.
+            Defaults to None.
+
+    Returns:
+        pd.DataFrame, dict: Out-of-fold probabilities per learner and the
+            fitted models
+    """
+    learners = BASE_LEARNERS if learners is None else learners
+    data = data_key(X, y, folds)
+    n_folds = folds.max() + 1
+    oof, models, keys = {}, {}, {}
+    for name, (factory, params) in learners.items():
+        keys[name] = hashlib.blake2b(json.dumps(
+            {"stage": "oof", "learner": name, "params": params,
+             "weight": weight, "data": data,
+             "code": code_version((factory.__module__,))}, sort_keys=True,
+            default=str).encode(), digest_size=16).hexdigest()
+        if cache is not None:
+            frames = cache.load(keys[name])
+            model = cache.load_object(f"{keys[name]}_model")
+            if frames is not None and model is not None:
+                logger.info(f"Loaded {name} from the cache")
+                oof[name], models[name] = frames["oof"][name].values, model
+    missing = [name for name in learners if name not in oof]
+    tasks = [(name, fold) for name in missing
+             for fold in list(range(n_folds)) + [None]]
+    results = []
+    if tasks:
+        n_workers, n_threads = plan_budget(len(tasks), n_cpus, threads)
+        logger.info(f"Fitting {len(tasks)} models on {n_workers} workers "
+                    f"with {n_threads} threads each")
+        results = Parallel(n_jobs=n_workers)(
+            delayed(__fit_task)(
+                learners[name][0], learners[name][1], weight, n_threads, X,
+                y, np.flatnonzero(folds != fold) if fold is not None
+                else np.arange(len(y)),
+                np.flatnonzero(folds == fold) if fold is not None else None)
+            for name, fold in tasks)
+    for name in missing:
+        oof[name] = np.empty(len(y))
+    for (name, fold), result in zip(tasks, results):
+        if fold is None:
+            models[name] = result
+        else:
+            oof[name][folds == fold] = result
+    for name in missing:
+        if cache is not None:
+            cache.save(keys[name], {"oof": pd.DataFrame({name: oof[name]})})
+            cache.save_object(f"{keys[name]}_model", models[name])
+    return (pd.DataFrame({name: oof[name] for name in learners}),
+            {name: models[name] for name in learners})
+
+
+def fit_stacked(X, y, groups, learners=None, final_estimator=None,
+                n_splits=5, seed=RSEED, n_cpus=None, threads=None,
+                cache=None) -> stacked_classifier:
+    """Fit the stacked model of run_training with drive-grouped folds and
+    cached out-of-fold predictions.
+
+    Args:
+        X (pd.DataFrame): Features
+        y (pd.Series): Target
+        groups (_type_): Serial number of every row
+        learners (dict, optional): Base learners by name, factory and
+            parameters. Defaults to None (BASE_LEARNERS).
+        final_estimator (_type_, optional): Final classifier. Defaults to
+            None (LogisticRegression of run_training).
+        n_splits (int, optional): Number of folds. Defaults to 5.
+        seed (int, optional): Seed of the folds. Defaults to RSEED.
+        n_cpus (int, optional): Cores of the budget. Defaults to None (all
+            cores).
+        threads (int, optional): Threads per fit. Defaults to None.
+        cache (data_cache, optional): Cache of the predictions and models.
+            Defaults to None.
+
+    Returns:
+        stacked_classifier: Fitted model
+    """
+    weight = 0.4 * len(y) / y.sum()
+    if final_estimator is None:
+        final_estimator = LogisticRegression(class_weight={0: 1.0,
+                                                           1: weight})
+    scaling = Pipeline([('scaler_log', log_transformer(offset=1)),
+                        ('scaler_minmax ', MinMaxScaler())])
+    X = scaling.fit_transform(X).astype(np.float32)
+    y = np.asarray(y, dtype=np.int8)
+    folds = drive_hash_kfold(n_splits, seed=seed).folds(groups)
+    oof, models = run_stage("base_learners", fit_base_learners, X, y, folds,
+                            learners=learners, weight=weight, n_cpus=n_cpus,
+                            threads=threads, cache=cache)
+    final = clone(final_estimator).fit(oof.values, y)
+    return stacked_classifier(scaling, list(models.values()), final)
+
+
+def __get_grouped_data(cache=None):
+    """Train and test data of run_training with the serial numbers of the
+    train rows."""
+    X, y = load_preprocess_data(days=30, filename="ST4000DM000_history_total",
+                                path=os.getcwd(), partition=True,
+                                cache=cache)
+    X_train, X_test, y_train, y_test = train_test_splitter(
+        X, y, test_size=0.30, random_state=RSEED)
+    # The features keep the drive-sorted row order of the drive_frame
+    groups = np.asarray(X_train.data.serial_number)
+    preprocessor = hdd_preprocessor(days=30, trigger=0.05)
+    return (preprocessor.fit_transform(X_train), preprocessor.transform(
+        X_test), y_train, y_test, groups)
+
+
+def compare_with_stacking_classifier(X, y, groups, learners=None,
+                                     n_cpus=None) -> pd.DataFrame:
+    """Wall-clock time of the StackingClassifier of run_training against
+    fit_stacked, cold and with the cached base learners for a new final
+    estimator.
+
+    Args:
+        X (pd.DataFrame): Features
+        y (pd.Series): Target
+        groups (_type_): Serial number of every row
+        learners (dict, optional): Base learners. Defaults to None
+            (BASE_LEARNERS).
+        n_cpus (int, optional): Cores of the budget. Defaults to None (all
+            cores).
+
+    Returns:
+        pd.DataFrame: Seconds per run
+    """
+    import tempfile
+
+    from sklearn.ensemble import StackingClassifier
+
+    learners = BASE_LEARNERS if learners is None else learners
+    weight = 0.4 * len(y) / y.sum()
+    results = []
+    start = time.perf_counter()
+    Pipeline([('scaling', Pipeline([('scaler_log', log_transformer(offset=1)),
+                                    ('scaler_minmax ', MinMaxScaler())])),
+              ('stacking', StackingClassifier(
+                  estimators=[(name, factory(None, weight, **params))
+                              for name, (factory, params)
+                              in learners.items()],
+                  final_estimator=LogisticRegression(
+                      class_weight={0: 1.0, 1: weight}),
+                  n_jobs=-1))]).fit(X, y)
+    results.append({"run": "StackingClassifier",
+                    "seconds": time.perf_counter() - start})
+    with tempfile.TemporaryDirectory() as path:
+        cache = data_cache(path)
+        for run, final in [("fit_stacked cold", None),
+                           ("fit_stacked cached, new final estimator",
+                            LogisticRegression(C=0.1))]:
+            start = time.perf_counter()
+            fit_stacked(X, y, groups, learners=learners,
+                        final_estimator=final, n_cpus=n_cpus, cache=cache)
+            results.append({"run": run,
+                            "seconds": time.perf_counter() - start})
+    return pd.DataFrame(results)
+
+
+def run_stacked_training(use_cache=True, n_cpus=None):
+    """Version of run_training with drive-grouped, cached out-of-fold
+    predictions. The model is saved for deployment.
+
+    Args:
+        use_cache (bool, optional): Reuse the cached data preparation and
+            base learners of previous runs. Defaults to True.
+        n_cpus (int, optional): Cores of the budget. Defaults to None (all
+            cores).
+    """
+    from mlflow.sklearn import save_model
+
+    cache = data_cache() if use_cache else None
+    logger.info("Getting the data")
+    X_train, _, y_train, _, groups = __get_grouped_data(cache)
+    logger.info("Fitting in progress")
+    model = run_stage("fit", fit_stacked, X_train, y_train, groups,
+                      n_cpus=n_cpus, cache=cache)
+    logger.info("Saving model in the models folder")
+    save_model(sk_model=model, path="models/deployment_stacked_oof")
+
+
+if __name__ == "__main__":
+    import argparse
+    import logging
+
+    from src.hdd_instrumentation import add_sink, log_sink
+
+    logger = logging.getLogger()
+    logging.basicConfig(format="%(asctime)s: %(message)s")
+    logger.setLevel(logging.INFO)
+    add_sink(log_sink())
+
+    parser = argparse.ArgumentParser(description="Train the stacked model")
+    parser.add_argument("--cpus", type=int, default=None)
+    parser.add_argument("--no-cache", action="store_true")
+    args = parser.parse_args()
+
+    run_stacked_training(use_cache=not args.no_cache, n_cpus=args.cpus)
@@ -0,0 +1,394 @@
+from logging import getLogger
+import os
+import tempfile
+
+import numpy as np
+import pandas as pd
+import xgboost
+from sklearn.linear_model import SGDClassifier
+from sklearn.pipeline import Pipeline
+from sklearn.preprocessing import MinMaxScaler
+from xgboost import XGBClassifier
+
+from src.hdd_preprocessing import (read_drive_stats, load_preprocess_data,
+                                   drive_hash)
+from src.hdd_feature_engineering import create_features, log_transformer
+
+logger = getLogger(__name__)
+
+RSEED = 42
+
+
+def __count_rows(file: str, block_size=2**24) -> int:
+    """Number of data rows of a csv file, counted in blocks of bytes
+    without parsing.
+
+    Args:
+        file (str): Path of the csv file
+        block_size (int, optional): Bytes read at once. Defaults to 2**24.
+
+    Returns:
+        int: Number of rows without the header
+    """
+    n_lines, last = 0, b"\n"
+    with open(file, "rb") as f:
+        while block := f.read(block_size):
+            n_lines += block.count(b"\n")
+            last = block[-1:]
+    # The last line may lack the line break
+    return n_lines + (last != b"\n") - 1
+
+
+def write_feature_chunks(filename="ST4000DM000_history_total",
+                         path=os.getcwd(), out="data/chunks", n_buckets=None,
+                         days=30, trigger=0.05, test_size=0.3, seed=RSEED,
+                         chunksize=500000) -> dict:
+    """Engineer the features out of core and store them in chunk files.
+
+    The raw file is streamed once and every row is appended to one of
+    n_buckets bucket files, chosen by the hash of the serial number, so
+    that every bucket holds the complete history of its drives. Every
+    bucket is then preprocessed, feature engineered and split by the hash
+    split on its own. By default there is a bucket per chunksize rows of
+    the raw file, so peak memory is bounded by the chunk size and not by
+    the size of the dataset.
+
+    Args:
+        filename (str, optional): Name of the csv file. Defaults to
+            "ST4000DM000_history_total".
+        path (_type_, optional): Path of the repo. Defaults to os.getcwd().
+        out (str, optional): Folder of the chunk files. Defaults to
+            "data/chunks".
+        n_buckets (int, optional): Number of buckets. Defaults to None
+            (rows of the raw file divided by chunksize).
+        days (int, optional): Time interval of target and EMA. Defaults to
+            30.
+        trigger (float, optional): Trigger of smart_999. Defaults to 0.05.
+        test_size (float, optional): Share of test drives. Defaults to 0.3.
+        seed (int, optional): Seed of the hash split. Defaults to RSEED.
+        chunksize (int, optional): Rows read at once and expected rows per
+            bucket. Defaults to 500000.
+
+    Returns:
+        dict: Paths of the train and test chunk files
+    """
+    if n_buckets is None:
+        n_rows = __count_rows(f"{path}/data/raw/{filename}.csv")
+        n_buckets = max(1, int(np.ceil(n_rows / chunksize)))
+    os.makedirs(f"{out}/data/raw", exist_ok=True)
+    buckets = [f"bucket_{i}" for i in range(n_buckets)]
+    for bucket in buckets:
+        if os.path.exists(f"{out}/data/raw/{bucket}.csv"):
+            os.remove(f"{out}/data/raw/{bucket}.csv")
+    # Distribute the rows to the buckets by drive
+    for chunk in read_drive_stats(filename, path, chunksize=chunksize):
+        chunk["serial_number"] = chunk.serial_number.astype(str)
+        bucket_of_row = (drive_hash(chunk.serial_number.values, seed=seed + 1)
+                         * n_buckets).astype(int)
+        for i, rows in chunk.groupby(bucket_of_row):
+            file = f"{out}/data/raw/{buckets[i]}.csv"
+            rows.to_csv(file, mode="a", header=not os.path.exists(file),
+                        index=False)
+    files = {"train": [], "test": []}
+    for bucket in buckets:
+        if not os.path.exists(f"{out}/data/raw/{bucket}.csv"):
+            continue
+        X, y = load_preprocess_data(bucket, out, days=days)
+        X = create_features(X, days=days, trigger=trigger)
+        X["target"] = y.values
+        in_test = drive_hash(X.serial_number.values, seed=seed) < test_size
+        for subset, rows in [("train", X[~in_test]), ("test", X[in_test])]:
+            file = f"{out}/{subset}_{bucket}.parquet"
+            rows.reset_index(drop=True).to_parquet(file)
+            files[subset].append(file)
+        os.remove(f"{out}/data/raw/{bucket}.csv")
+        logger.info(f"Features of {bucket}: {len(X)} rows")
+    return files
+
+
+def read_chunks(files, columns=None):
+    """Read chunk files one by one.
+
+    Args:
+        files (list): Paths of the chunk files
+        columns (list, optional): Columns to read. Defaults to None (all).
+
+    Yields:
+        pd.DataFrame, pd.Series: Features without serial number and target
+    """
+    for file in files:
+        chunk = pd.read_parquet(file, columns=columns)
+        y = chunk.pop("target")
+        chunk = chunk.drop("serial_number", axis=1, errors="ignore")
+        yield chunk, y
+
+
+def fit_streaming_scaler(files, offset=1):
+    """Fit the log and minmax scaling in one streaming pass over the chunk
+    files and count the rows and failures.
+
+    Args:
+        files (list): Paths of the train chunk files
+        offset (int, optional): Offset of the log transformation. Defaults
+            to 1.
+
+    Returns:
+        Pipeline, int, int: Fitted scaling pipeline, number of rows and
+            number of positive targets
+    """
+    log = log_transformer(offset=offset).fit(None)
+    minmax = MinMaxScaler()
+    n_rows, n_positive = 0, 0
+    for X, y in read_chunks(files):
+        minmax.partial_fit(log.transform(X))
+        n_rows += len(y)
+        n_positive += int(y.sum())
+    scaling = Pipeline([('scaler_log', log), ('scaler_minmax ', minmax)])
+    return scaling, n_rows, n_positive
+
+
+class feature_iterator(xgboost.DataIter):
+    """XGBoost data iterator over the scaled chunk files. With a cache
+    prefix, XGBoost builds an external memory DMatrix and keeps only one
+    chunk in memory.
+
+    Args:
+        files (list): Paths of the chunk files
+        scaling (Pipeline): Fitted scaling pipeline
+        cache_prefix (str, optional): Prefix of the XGBoost cache files.
+            Defaults to None.
+    """
+
+    def __init__(self, files, scaling, cache_prefix=None):
+        self.files = files
+        self.scaling = scaling
+        self.position = 0
+        super().__init__(cache_prefix=cache_prefix)
+
+    def next(self, input_data):
+        if self.position == len(self.files):
+            return 0
+        X, y = next(read_chunks(self.files[self.position:]))
+        input_data(data=self.scaling.transform(X), label=y.values)
+        self.position += 1
+        return 1
+
+    def reset(self):
+        self.position = 0
+
+
+def batch_generator(files, scaling, batch_size=40000, epochs=None,
+                    shuffle=True, seed=RSEED):
+    """Batches of the scaled chunk files for Keras. The chunks are visited
+    in random order and shuffled within.
+
+    Args:
+        files (list): Paths of the chunk files
+        scaling (Pipeline): Fitted scaling pipeline
+        batch_size (int, optional): Rows per batch. Defaults to 40000.
+        epochs (int, optional): Passes over the files. Defaults to None
+            (endless, as expected by keras fit with steps_per_epoch).
+        shuffle (bool, optional): Shuffle chunks and rows. Defaults to True.
+        seed (int, optional): Seed of the shuffling. Defaults to RSEED.
+
+    Yields:
+        np.ndarray, np.ndarray: Features and target of a batch
+    """
+    rng = np.random.default_rng(seed)
+    epoch = 0
+    while epochs is None or epoch < epochs:
+        order = rng.permutation(len(files)) if shuffle else range(len(files))
+        for X, y in read_chunks([files[i] for i in order]):
+            X = scaling.transform(X).astype(np.float32)
+            y = y.values.astype(np.float32)
+            rows = rng.permutation(len(y)) if shuffle else np.arange(len(y))
+            for start in range(0, len(rows), batch_size):
+                batch = rows[start:start + batch_size]
+                yield X[batch], y[batch]
+        epoch += 1
+
+
+def fit_xgb_external(files, scaling, scale_pos_weight=1., n_estimators=50,
+                     **params) -> XGBClassifier:
+    """Train the XGBoost model with external memory.
+
+    Args:
+        files (list): Paths of the train chunk files
+        scaling (Pipeline): Fitted scaling pipeline
+        scale_pos_weight (float, optional): Weight of the failures. Defaults
+            to 1.
+        n_estimators (int, optional): Number of trees. Defaults to 50.
+        **params: Further XGBoost parameters
+
+    Returns:
+        XGBClassifier: Fitted model
+    """
+    params = {"objective": "binary:logistic", "tree_method": "hist",
+              "scale_pos_weight": scale_pos_weight, **params}
+    with tempfile.TemporaryDirectory() as folder:
+        iterator = feature_iterator(files, scaling,
+                                    cache_prefix=f"{folder}/cache")
+        dtrain = xgboost.DMatrix(iterator)
+        booster = xgboost.train(params, dtrain, num_boost_round=n_estimators)
+        # Release the cache files before the folder is removed
+        del dtrain, iterator
+        # Wrap the booster for the sklearn interface
+        booster.save_model(f"{folder}/model.json")
+        model = XGBClassifier(n_estimators=n_estimators, **params)
+        model.load_model(f"{folder}/model.json")
+    return model
+
+
+def fit_ann_streaming(files, scaling, epochs=150, batch_size=40000,
+                      class_weight=None, input_dim=19):
+    """Train the ANN from a batch generator.
+
+    Args:
+        files (list): Paths of the train chunk files
+        scaling (Pipeline): Fitted scaling pipeline
+        epochs (int, optional): Number of epochs. Defaults to 150.
+        batch_size (int, optional): Rows per batch. Defaults to 40000.
+        class_weight (dict, optional): Weights of the classes. Defaults to
+            None.
+        input_dim (int, optional): Number of features. Defaults to 19.
+
+    Returns:
+        _type_: Fitted Keras model
+    """
+    from src.train import __create_ann_model__
+
+    model = __create_ann_model__(input_dim=input_dim)
+    # Batches do not span chunks, so every chunk may add a partial batch
+    steps = sum(int(np.ceil(len(pd.read_parquet(file, columns=["target"]))
+                            / batch_size)) for file in files)
+    model.fit(batch_generator(files, scaling, batch_size=batch_size),
+              steps_per_epoch=steps, epochs=epochs,
+              class_weight=class_weight, verbose=0)
+    return model
+
+
+class stacked_classifier:
+    """Stacking of models trained out of core: the scaled features go to
+    the base models, their probabilities to the final estimator.
+
+    Args:
+        scaling (Pipeline): Fitted scaling pipeline
+        estimators (list): Fitted base models, sklearn classifiers or Keras
+            models with a sigmoid output
+        final_estimator (_type_): Fitted final classifier
+    """
+
+    def __init__(self, scaling, estimators, final_estimator):
+        self.scaling = scaling
+        self.estimators = estimators
+        self.final_estimator = final_estimator
+
+    def base_predictions(self, X, scaled=False) -> np.ndarray:
+        """Probabilities of the base models, the input of the final
+        estimator."""
+        X = X if scaled else self.scaling.transform(X)
+        columns = []
+        for estimator in self.estimators:
+            if hasattr(estimator, "predict_proba"):
+                columns.append(estimator.predict_proba(X)[:, 1])
+            else:
+                columns.append(estimator.predict(X, verbose=0)[:, 0])
+        return np.column_stack(columns)
+
+    def predict_proba(self, X) -> np.ndarray:
+        return self.final_estimator.predict_proba(self.base_predictions(X))
+
+    def predict(self, X) -> np.ndarray:
+        return self.final_estimator.predict(self.base_predictions(X))
+
+
+def fit_streaming(files, holdout=0.2, use_ann=True, epochs=150,
+                  batch_size=40000, seed=RSEED) -> stacked_classifier:
+    """Fit the stacked model of run_training out of core. The base models
+    are trained on the train chunks without the holdout drives, the final
+    estimator is trained incrementally on the base model predictions for
+    the holdout drives.
+
+    Args:
+        files (list): Paths of the train chunk files
+        holdout (float, optional): Share of drives for the final estimator.
+            Defaults to 0.2.
+        use_ann (bool, optional): Include the ANN. Defaults to True.
+        epochs (int, optional): Epochs of the ANN. Defaults to 150.
+        batch_size (int, optional): Batch size of the ANN. Defaults to
+            40000.
+        seed (int, optional): Seed of the holdout split. Defaults to RSEED.
+
+    Returns:
+        stacked_classifier: Fitted model
+    """
+    # Split every chunk into base and holdout drives
+    folder = os.path.dirname(files[0])
+    base_files, holdout_files = [], []
+    for file in files:
+        chunk = pd.read_parquet(file)
+        in_holdout = drive_hash(chunk.serial_number.values,
+                                seed=seed + 2) < holdout
+        name = os.path.basename(file)
+        for subset, rows, names in [("base", chunk[~in_holdout], base_files),
+                                    ("holdout", chunk[in_holdout],
+                                     holdout_files)]:
+            names.append(f"{folder}/{subset}_{name}")
+            rows.to_parquet(names[-1])
+    logger.info("Fitting the scaling")
+    scaling, n_rows, n_positive = fit_streaming_scaler(base_files)
+    weight = 0.4 * n_rows / max(n_positive, 1)
+    logger.info("Fitting XGBoost with external memory")
+    estimators = [fit_xgb_external(
+        base_files, scaling, scale_pos_weight=weight, colsample_bytree=0.4,
+        subsample=0.3, eta=0.01, gamma=1, max_depth=6, n_estimators=50,
+        min_child_weight=2, reg_lambda=0.7, reg_alpha=1)]
+    if use_ann:
+        logger.info("Fitting the ANN from batches")
+        estimators.append(fit_ann_streaming(
+            base_files, scaling, epochs=epochs,
+            batch_size=batch_size, class_weight={0: 1.0, 1: weight}))
+    logger.info("Fitting the final estimator")
+    model = stacked_classifier(scaling, estimators, None)
+    final = SGDClassifier(loss="log_loss", random_state=seed)
+    for X, y in read_chunks(holdout_files):
+        final.partial_fit(model.base_predictions(X), y.values,
+                          classes=np.array([False, True]))
+    model.final_estimator = final
+    for file in base_files + holdout_files:
+        os.remove(file)
+    return model
+
+
+def run_streaming_training(filename="ST4000DM000_history_total",
+                           out="data/chunks", n_buckets=None):
+    """Out-of-core version of run_training: engineer the features into
+    chunk files, fit the stacked model from them and save it for
+    deployment.
+
+    Args:
+        filename (str, optional): Name of the csv file. Defaults to
+            "ST4000DM000_history_total".
+        out (str, optional): Folder of the chunk files. Defaults to
+            "data/chunks".
+        n_buckets (int, optional): Number of chunks. Defaults to None
+            (one per 500000 rows of the raw file).
+    """
+    from mlflow.sklearn import save_model
+
+    logger.info("Engineering the features into chunks")
+    files = write_feature_chunks(filename, os.getcwd(), out=out,
+                                 n_buckets=n_buckets)
+    model = fit_streaming(files["train"])
+    logger.info("Saving model in the models folder")
+    save_model(sk_model=model, path="models/deployment_streamed")
+
+
+if __name__ == "__main__":
+    import logging
+
+    logger = logging.getLogger()
+    logging.basicConfig(format="%(asctime)s: %(message)s")
+    logger.setLevel(logging.INFO)
+
+    run_streaming_training()